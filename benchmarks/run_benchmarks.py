@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+   Benchmarks of the processing chain, on synthetic inputs at several sizes (see synthetic.py).
+
+   Usage:
+        python benchmarks/run_benchmarks.py [--quick] [--filter TEXT] [--output results.json]
+                                            [--compare baseline.json] [--threshold 1.25]
+
+   Each benchmark is timed with timeit: the number of calls per measurement is calibrated to
+   last at least 0.2 s, and the min, median, mean and standard deviation of the time per call
+   over --repeat measurements are written to the JSON output, with the versions and commit.
+   --compare prints the ratio of the medians to a baseline output, and exits with 1 if one of
+   them is above --threshold. The synthetic inputs are generated once, in --data.
+   Benchmarks whose dependencies are missing (e.g. GDAL) are reported as skipped.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import timeit
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.dirname(os.path.abspath(__file__)), ROOT, os.path.join(ROOT, 'data_preparation')]
+import synthetic
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.data')
+BENCHMARKS = []
+
+
+class Skipped(Exception):
+    pass
+
+
+def benchmark(name, sizes, quick_sizes = None):
+    """ Register setup(size, data) as a benchmark. setup prepares the inputs for one size and
+        returns the function to time, without arguments.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, list(sizes), list(quick_sizes or sizes[:1]), setup))
+        return setup
+    return register
+
+
+def _product():
+    try:
+        import PrecipitableWaterProduct
+    except ImportError as e:
+        raise Skipped(str(e))
+    return PrecipitableWaterProduct
+
+
+def _clear_granule_caches():
+    import geoIndex
+    import PrecipitableWaterProduct
+    geoIndex._geo_indices.clear()
+    PrecipitableWaterProduct._georef_grids.clear()
+
+
+# ------------------------------------------------------------------------------------------
+# Granules
+# ------------------------------------------------------------------------------------------
+
+@benchmark('product.construct', sizes=[0.25, 1.0], quick_sizes=[0.25])
+def bench_construct(scale, data):
+    """ Locating the roi in a granule, without the index caches of earlier granules. """
+    PrecipitableWaterProduct = _product()
+    path = synthetic.make_granules(os.path.join(data, 'granules-{0}'.format(scale)), 1, scale)[0]
+
+    def run():
+        _clear_granule_caches()
+        PrecipitableWaterProduct.PrecipitableWaterProduct(path)
+    return run
+
+
+@benchmark('product.extractByName', sizes=[50, 200], quick_sizes=[50])
+def bench_extract_by_name(roi_width_km, data):
+    """ Reading the Cloud_Mask_QA of a roi of roi_width_km. """
+    PrecipitableWaterProduct = _product()
+    path = synthetic.make_granules(os.path.join(data, 'granules-1.0'), 1, 1.0)[0]
+    product = PrecipitableWaterProduct.PrecipitableWaterProduct(path, roi_width_km=roi_width_km)
+
+    def run():
+        product.clearCache()
+        product.extractByName('Cloud_Mask_QA (8-bit integer)')
+    return run
+
+
+@benchmark('product.qa_flags', sizes=[50, 200], quick_sizes=[50])
+def bench_qa_flags(roi_width_km, data):
+    """ Reading and decoding all the Cloud_Mask_QA flags of a roi. """
+    PrecipitableWaterProduct = _product()
+    path = synthetic.make_granules(os.path.join(data, 'granules-1.0'), 1, 1.0)[0]
+    product = PrecipitableWaterProduct.PrecipitableWaterProduct(path, roi_width_km=roi_width_km)
+
+    def run():
+        product.clearCache()
+        product.extractCloudMaskQA_QualityFlag()
+        product.extractCloudMaskQA_LandCoverFlag()
+        product.extractCloudMaskQA_CloudMaskFlag_1k()
+    return run
+
+
+@benchmark('decode.qa_flags', sizes=['51x51', '2030x1354'], quick_sizes=['51x51'])
+def bench_decode(shape, data):
+    """ Decoding the flags of Cloud_Mask_QA bytes, of a roi or a full swath. """
+    from cloudMaskDecoder import CLOUD_MASK_QA_FIELDS, decode_bit_fields
+    rows, cols = [int(n) for n in shape.split('x')]
+    packed = np.random.default_rng(0).integers(-128, 128, (rows, cols)).astype(np.int8)
+    return lambda: decode_bit_fields(packed, CLOUD_MASK_QA_FIELDS)
+
+
+@benchmark('geo.closest_point', sizes=['81x81', '406x270'], quick_sizes=['81x81'])
+def bench_closest_point(shape, data):
+    """ Building the index of a 5 km grid and finding the closest pixel of 100 locations, in one
+        GeoIndex.query, as locateSites does.
+    """
+    from geoIndex import GeoIndex
+    rows, cols = [int(n) for n in shape.split('x')]
+    r, c = np.mgrid[0:rows, 0:cols]
+    grid = np.dstack((1.3 + 0.045 * (r - rows // 2), 103.7 + 0.045 * (c - cols // 2)))
+    points = np.column_stack((np.random.default_rng(0).uniform(grid[..., 0].min(), grid[..., 0].max(), 100),
+                              np.random.default_rng(1).uniform(grid[..., 1].min(), grid[..., 1].max(), 100)))
+
+    return lambda: GeoIndex(grid).query(points)
+
+
+@benchmark('geo.closest_point_legacy', sizes=['81x81', '406x270'], quick_sizes=['81x81'])
+def bench_closest_point_legacy(shape, data):
+    """ utility.closest_point(grid, point), the brute force search, for the same 100 locations. """
+    try:
+        from utility import closest_point
+    except ImportError as e:
+        raise Skipped(str(e))
+    rows, cols = [int(n) for n in shape.split('x')]
+    r, c = np.mgrid[0:rows, 0:cols]
+    grid = np.dstack((1.3 + 0.045 * (r - rows // 2), 103.7 + 0.045 * (c - cols // 2)))
+    points = np.column_stack((np.random.default_rng(0).uniform(grid[..., 0].min(), grid[..., 0].max(), 100),
+                              np.random.default_rng(1).uniform(grid[..., 1].min(), grid[..., 1].max(), 100)))
+    return lambda: [closest_point(grid, point) for point in points]
+
+
+# ------------------------------------------------------------------------------------------
+# Sky camera coverage and matching
+# ------------------------------------------------------------------------------------------
+
+def _coverage(data, days):
+    return synthetic.make_coverage_archive(os.path.join(data, 'coverage-{0}'.format(days)), days)
+
+
+@benchmark('coverage.readingCOVERAGE', sizes=[30, 365, 1095], quick_sizes=[30])
+def bench_reading_coverage(days, data):
+    """ The notebook's loop: readingCOVERAGE on every daily file, lists concatenated. """
+    from readCoverage import coverageFiles, readingCOVERAGE
+    files = coverageFiles(_coverage(data, days))
+
+    def run():
+        datetime_series, COV_series = [], []
+        for one_file in files:
+            (datetime_COV, COV_values) = readingCOVERAGE(one_file)
+            datetime_series.extend(datetime_COV)
+            COV_series.extend(COV_values)
+    return run
+
+
+@benchmark('coverage.bulk', sizes=[30, 365, 1095], quick_sizes=[30])
+def bench_coverage_bulk(days, data):
+    from readCoverage import readingCOVERAGE_bulk
+    folder = _coverage(data, days)
+    return lambda: readingCOVERAGE_bulk(folder)
+
+
+@benchmark('coverage.cached', sizes=[30, 365, 1095], quick_sizes=[30])
+def bench_coverage_cached(days, data):
+    """ readingCOVERAGE_cached once the cache is built, as in the notebook after the first run. """
+    from readCoverage import readingCOVERAGE_cached
+    folder = _coverage(data, days)
+    readingCOVERAGE_cached(folder)
+    return lambda: readingCOVERAGE_cached(folder)
+
+
+@benchmark('nearest.loop', sizes=[1000, 10000], quick_sizes=[1000])
+def bench_nearest_loop(count, data):
+    """ nearest() for every MODIS observation, against one year of coverage. """
+    from nearest import nearest
+    from readCoverage import readingCOVERAGE_cached
+    times, _ = readingCOVERAGE_cached(_coverage(data, 365))
+    times = sorted(times.astype(datetime.datetime))
+    queries, _ = synthetic.modis_times(count, 365)
+    return lambda: [nearest(query, times) for query in queries]
+
+
+@benchmark('nearest.batch', sizes=[1000, 10000], quick_sizes=[1000])
+def bench_nearest_batch(count, data):
+    from nearest import nearest_batch
+    from readCoverage import readingCOVERAGE_cached
+    times, _ = readingCOVERAGE_cached(_coverage(data, 365))
+    queries, _ = synthetic.modis_times(count, 365)
+    queries = np.array(queries, dtype='datetime64[s]')
+    return lambda: nearest_batch(queries, times, 900)
+
+
+@benchmark('nearest.events', sizes=[1000, 100000], quick_sizes=[1000])
+def bench_nearest_events(count, data):
+    """ Rain events (one minute series over a year, 1% non-zero) nearest to count MODIS times. """
+    from nearest import nearest_events
+    rng = np.random.default_rng(0)
+    times = np.datetime64('2015-01-01T00:00', 's') + np.arange(0, 365 * 86400, 60).astype('timedelta64[s]')
+    rain = np.where(rng.uniform(size=len(times)) < 0.01, rng.uniform(0.1, 5, len(times)), 0.)
+    queries, _ = synthetic.modis_times(count, 365)
+    queries = np.array(queries, dtype='datetime64[s]')
+    return lambda: nearest_events(queries, rain, times, 'either', tolerance=3600)
+
+
+@benchmark('normalize_array', sizes=[1000, 100000, 1000000], quick_sizes=[1000])
+def bench_normalize_array(count, data):
+    from normalize_array import normalize_array
+    values = np.random.default_rng(0).uniform(0, 192, count)
+    return lambda: normalize_array(values)
+
+
+@benchmark('binning.loop', sizes=[1000, 100000], quick_sizes=[1000])
+def bench_binning_loop(count, data):
+    """ The notebook's binning of the coverage per cloud mask bin, with a Python loop. """
+    rng = np.random.default_rng(0)
+    mask100, coverage = rng.uniform(0, 100, count), rng.uniform(0, 1, count)
+
+    def run():
+        box_mask = [[] for _ in range(4)]
+        for i, item in enumerate(mask100):
+            box_mask[min(int(item / 25), 3)].append(coverage[i])
+        return box_mask
+    return run
+
+
+@benchmark('binning.bin_statistics', sizes=[1000, 100000, 1000000], quick_sizes=[1000])
+def bench_binning(count, data):
+    from binStatistics import bin_statistics
+    rng = np.random.default_rng(0)
+    mask100, coverage = rng.uniform(0, 100, count), rng.uniform(0, 1, count)
+    return lambda: bin_statistics(mask100, coverage, np.linspace(0, 100, 5), whis=5)
+
+
+@benchmark('binning.streaming', sizes=[1000000], quick_sizes=[1000])
+def bench_binning_streaming(count, data):
+    """ StreamingBinStatistics over chunks of 100000 pairs. """
+    from binStatistics import StreamingBinStatistics
+    rng = np.random.default_rng(0)
+    mask100, coverage = rng.uniform(0, 100, count), rng.uniform(0, 1, count)
+
+    def run():
+        statistics = StreamingBinStatistics(np.linspace(0, 100, 5), whis=5)
+        for start in range(0, count, 100000):
+            statistics.update(mask100[start:start + 100000], coverage[start:start + 100000])
+        return statistics.result()
+    return run
+
+
+@benchmark('match.update_match_table', sizes=[1000, 5000], quick_sizes=[1000])
+def bench_match(count, data):
+    """ The notebook's matching step on a new result file, against one year of coverage. """
+    from matchCoverage import update_match_table
+    folder = _coverage(data, 365)
+    queries, cmask = synthetic.modis_times(count, 365)
+    table = os.path.join(data, 'match-{0}.txt'.format(count))
+
+    def run():
+        for name in (table, table + '.state'):
+            if os.path.isfile(name):
+                os.remove(name)
+        update_match_table(table, 'MOD', queries, cmask, folder, tolerance=900)
+    return run
+
+
+@benchmark('match.update_match_table_unchanged', sizes=[1000, 5000], quick_sizes=[1000])
+def bench_match_unchanged(count, data):
+    """ Running the matching step again, with no new observation nor coverage file. """
+    from matchCoverage import update_match_table
+    folder = _coverage(data, 365)
+    queries, cmask = synthetic.modis_times(count, 365)
+    table = os.path.join(data, 'match-unchanged-{0}.txt'.format(count))
+    update_match_table(table, 'MOD', queries, cmask, folder, tolerance=900)
+    return lambda: update_match_table(table, 'MOD', queries, cmask, folder, tolerance=900)
+
+
+# ------------------------------------------------------------------------------------------
+# Timing and reports
+# ------------------------------------------------------------------------------------------
+
+def measure(function, repeat = 5, min_time = 0.2):
+    """ Time per call of function: min, median, mean and standard deviation over repeat measurements. """
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 10 if number < 1000 else 2
+    times = np.array(timer.repeat(repeat, number)) / number
+    return {'min': float(times.min()), 'median': float(np.median(times)), 'mean': float(times.mean()),
+            'stdev': float(times.std()), 'number': number, 'repeat': repeat}
+
+
+def run(names = None, quick = False, repeat = 5, data = None):
+    """ Run the benchmarks whose name contains one of names (all by default). Returns the report. """
+    data = data or DATA
+    if not os.path.isdir(data):
+        os.makedirs(data)
+    results = {}
+    for name, sizes, quick_sizes, setup in BENCHMARKS:
+        if names and not any(text in name for text in names):
+            continue
+        for size in (quick_sizes if quick else sizes):
+            key = '{0}[{1}]'.format(name, size)
+            try:
+                result = measure(setup(size, data), repeat)
+                print('{0:<50} {1:>12.6f} s'.format(key, result['median']))
+            except Skipped as e:
+                result = {'skipped': str(e)}
+                print('{0:<50} {1:>12}   ({2})'.format(key, 'skipped', e))
+            result.update({'name': name, 'size': size})
+            results[key] = result
+    return {'meta': _meta(quick, repeat), 'results': results}
+
+
+def _meta(quick, repeat):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'date': datetime.datetime.utcnow().isoformat(), 'commit': commit, 'quick': quick, 'repeat': repeat,
+            'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def compare(report, baseline, threshold = 1.25):
+    """ Print the ratio of the median times to the baseline. Returns the keys slower than threshold. """
+    regressions = []
+    print('{0:<50} {1:>12} {2:>12} {3:>8}'.format('benchmark', 'baseline', 'current', 'ratio'))
+    for key, result in sorted(report['results'].items()):
+        old = baseline['results'].get(key)
+        if old is None or 'median' not in old or 'median' not in result:
+            continue
+        ratio = result['median'] / old['median']
+        flag = ' <-- slower' if ratio > threshold else ''
+        print('{0:<50} {1:>12.6f} {2:>12.6f} {3:>8.2f}{4}'.format(key, old['median'], result['median'], ratio, flag))
+        if ratio > threshold:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the processing chain on synthetic data.')
+    parser.add_argument('--quick', action='store_true', help='smallest size of each benchmark only')
+    parser.add_argument('--filter', action='append', help='run the benchmarks whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=1.25, help='ratio of the medians reported as a regression')
+    parser.add_argument('--data', help='folder of the synthetic inputs, benchmarks/.data by default')
+    parser.add_argument('--clean', action='store_true', help='generate the synthetic inputs again')
+    args = parser.parse_args(argv)
+
+    if args.clean and os.path.isdir(args.data or DATA):
+        shutil.rmtree(args.data or DATA)
+    report = run(args.filter, args.quick, args.repeat, args.data)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print('{0} regression(s): {1}'.format(len(regressions), ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+   Synthetic inputs for the benchmarks, at the sizes of the real data:
+        granules    NetCDF files with the subdatasets of a MOD05_L2 granule used by
+                    PrecipitableWaterProduct (Latitude, Longitude, Solar_Zenith at 5 km,
+                    Cloud_Mask_QA at 1 km), opened by GDAL like the HDF4 products
+        coverage    daily sky camera coverage files, as in coverage_data/, over several years
+        MODIS times the acquisition times of the observations, as in the notebook
+   Everything is generated from a seed, so that two runs time the same inputs.
+"""
+import datetime
+import os
+import numpy as np
+from scipy.io import netcdf_file
+
+# Swath of a 5 minutes MODIS granule
+SWATH_5K = (406, 270)
+SWATH_1K = (2030, 1354)
+# Centre of the synthetic swaths, close to the sky camera of Singapore
+CENTER = (1.342966, 103.680594)
+
+
+def granule_name(date, hhmm, platform = 'MOD'):
+    """ MOD05_L2.A<YYYYDDD>.<HHMM>.006.<production>.nc, as the products of the grabber. """
+    return '{0}05_L2.A{1}.{2}.006.2015000000000.nc'.format(platform, date.strftime('%Y%j'), hhmm)
+
+
+def make_granule(path, scale = 1.0, seed = 0, center = CENTER):
+    """ Write a synthetic granule. scale shrinks (< 1) or grows the swath; the 1 km grid is
+        5 times the 5 km one, plus 4 columns, as in the products. Returns the path.
+    """
+    rng = np.random.default_rng(seed)
+    rows5k, cols5k = max(int(SWATH_5K[0] * scale), 8), max(int(SWATH_5K[1] * scale), 8)
+    rows1k, cols1k = 5 * rows5k, 5 * cols5k + 4
+
+    # Rows go north with a small across track tilt, columns east, 5 km apart
+    r = np.arange(rows5k)[:, None] - rows5k // 2
+    c = np.arange(cols5k)[None, :] - cols5k // 2
+    latitude = center[0] + 0.045 * r + 0.004 * c
+    longitude = center[1] + 0.045 * c - 0.003 * r + 0.00002 * c ** 2
+
+    with netcdf_file(path, 'w') as f:
+        f.createDimension('Cell_Along_Swath_5km', rows5k)
+        f.createDimension('Cell_Across_Swath_5km', cols5k)
+        f.createDimension('Cell_Along_Swath_1km', rows1k)
+        f.createDimension('Cell_Across_Swath_1km', cols1k)
+        swath5k = ('Cell_Along_Swath_5km', 'Cell_Across_Swath_5km')
+        swath1k = ('Cell_Along_Swath_1km', 'Cell_Across_Swath_1km')
+        f.createVariable('Latitude', 'f', swath5k)[:] = latitude.astype(np.float32)
+        f.createVariable('Longitude', 'f', swath5k)[:] = longitude.astype(np.float32)
+        f.createVariable('Solar_Zenith', 'h', swath5k)[:] = rng.integers(0, 9000, (rows5k, cols5k)).astype(np.int16)
+        f.createVariable('Cloud_Mask_QA', 'b', swath1k)[:] = rng.integers(-128, 128, (rows1k, cols1k)).astype(np.int8)
+    return path
+
+
+def make_granules(folder, count, scale = 1.0, date = datetime.date(2015, 1, 2)):
+    """ count granules of the day in folder, 5 minutes apart from 02:00. Returns their paths. """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    paths = []
+    for k in range(count):
+        start = datetime.datetime(date.year, date.month, date.day, 2) + datetime.timedelta(minutes=5 * k)
+        path = os.path.join(folder, granule_name(date, start.strftime('%H%M')))
+        if not os.path.isfile(path):
+            make_granule(path, scale, seed=k)
+        paths.append(path)
+    return paths
+
+
+def make_coverage_archive(folder, days, images_per_day = 360, start = datetime.date(2015, 1, 1), seed = 0):
+    """ Daily coverage files of the sky camera, one image every 2 minutes from 07:00 local time,
+        with some missing images, in the format of coverage_data/. Returns the folder.
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    rng = np.random.default_rng(seed)
+    for day in range(days):
+        date = start + datetime.timedelta(days=day)
+        path = os.path.join(folder, 'undistort-coverage-data-{0}.txt'.format(date.isoformat()))
+        if os.path.isfile(path):
+            continue
+        seconds = np.sort(rng.choice(12 * 3600, images_per_day, replace=False)) + 7 * 3600
+        coverage = np.clip(rng.normal(0.5, 0.3, images_per_day), 0, 1)
+        with open(path, 'w') as f:
+            f.write('Image, Date, Time, Cloud_Coverage \n')
+            for second, value in zip(seconds, coverage):
+                hh, mm, ss = second // 3600, second // 60 % 60, second % 60
+                f.write('{0}-{1:02d}-{2:02d}-{3:02d}.jpg,{4},{1:02d}:{2:02d}:{3:02d},{5:g}\n'.format(
+                    date.isoformat(), hh, mm, ss, date.strftime('%Y:%m:%d'), value))
+    return folder
+
+
+def modis_times(count, days, start = datetime.date(2015, 1, 1), seed = 0):
+    """ count acquisition times over days, between 10:00 and 18:00 local time, sorted. Returns
+        the times as datetime objects and the cloud mask averages, as in the notebook.
+    """
+    rng = np.random.default_rng(seed)
+    origin = datetime.datetime(start.year, start.month, start.day)
+    day = rng.integers(0, days, count)
+    minute = rng.integers(10 * 60, 18 * 60, count)
+    times = sorted(origin + datetime.timedelta(days=int(d), minutes=int(m)) for d, m in zip(day, minute))
+    return times, rng.uniform(0, 192, count)
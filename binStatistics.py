@@ -0,0 +1,322 @@
+import numpy as np
+
+
+
+# Quantiles drawn by the boxes: first quartile, median, third quartile
+BOX_QUANTILES = (0.25, 0.5, 0.75)
+
+
+
+def assign_bins(x, edges, clip = True):
+
+    # Bin of each value of x for the increasing `edges` (n_bins + 1 values).
+    # Bins are [edges[i], edges[i+1]), the last one also holds edges[-1], as
+    # the notebook's int(item/(100/NO_OF_BINS)). Values outside of the edges
+    # go to the first or last bin if clip, otherwise (and NaN) to bin -1.
+    x = np.asarray(x, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.float64)
+    bins = np.digitize(x, edges[1:-1])
+    if not clip:
+        bins[~((x >= edges[0]) & (x <= edges[-1]))] = -1
+    return bins
+
+
+
+def _moments(bins, n_bins, x, y):
+
+    # Count, means, sums of squared deviations and co-moment of x and y per
+    # bin, from centred sums (two passes) so that they can also be merged.
+    n = np.bincount(bins, minlength=n_bins).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mx = np.bincount(bins, weights=x, minlength=n_bins) / n
+        my = np.bincount(bins, weights=y, minlength=n_bins) / n
+    dx = x - mx[bins]
+    dy = y - my[bins]
+    return {'n': n, 'mx': mx, 'my': my,
+            'm2x': np.bincount(bins, weights=dx * dx, minlength=n_bins),
+            'm2y': np.bincount(bins, weights=dy * dy, minlength=n_bins),
+            'cxy': np.bincount(bins, weights=dx * dy, minlength=n_bins)}
+
+
+
+def _merge_moments(a, b):
+
+    # Moments of the union of two sets, see _moments (Chan et al.)
+    n = a['n'] + b['n']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wb = np.where(n > 0, b['n'] / n, 0.)
+    weight = a['n'] * wb
+    delta_x = np.nan_to_num(b['mx'] - a['mx'])
+    delta_y = np.nan_to_num(b['my'] - a['my'])
+    return {'n': n,
+            'mx': np.where(b['n'] == 0, a['mx'], np.where(a['n'] == 0, b['mx'], a['mx'] + delta_x * wb)),
+            'my': np.where(b['n'] == 0, a['my'], np.where(a['n'] == 0, b['my'], a['my'] + delta_y * wb)),
+            'm2x': a['m2x'] + b['m2x'] + delta_x * delta_x * weight,
+            'm2y': a['m2y'] + b['m2y'] + delta_y * delta_y * weight,
+            'cxy': a['cxy'] + b['cxy'] + delta_x * delta_y * weight}
+
+
+
+def _moment_statistics(moments):
+
+    # Count, mean, (population) standard deviation of y and Pearson
+    # correlation of x and y, NaN where undefined.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {'count': moments['n'].astype(np.int64),
+                'mean': np.where(moments['n'] > 0, moments['my'], np.nan),
+                'std': np.where(moments['n'] > 0, np.sqrt(moments['m2y'] / moments['n']), np.nan),
+                'pearson': moments['cxy'] / np.sqrt(moments['m2x'] * moments['m2y'])}
+
+
+
+def _sorted_quantiles(values, starts, counts, quantiles):
+
+    # Quantiles of the groups values[starts[k]:starts[k] + counts[k]], each
+    # sorted, with the linear interpolation of np.quantile. NaN for empty groups.
+    position = np.asarray(quantiles, dtype=np.float64)[None, :] * np.maximum(counts - 1, 0)[:, None]
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    last = max(len(values) - 1, 0)
+    padded = values if len(values) else np.zeros(1)
+    low = padded[np.minimum(starts[:, None] + lower, last)]
+    high = padded[np.minimum(starts[:, None] + upper, last)]
+    result = low + (position - lower) * (high - low)
+    result[counts == 0] = np.nan
+    return result
+
+
+
+def _average_ranks(values, order):
+
+    # Ranks (from 1) of values, sorted by order, ties get their average rank
+    # as in scipy.stats.rankdata.
+    sorted_values = values[order]
+    first = np.flatnonzero(np.concatenate([[True], sorted_values[1:] != sorted_values[:-1]]))
+    ties = np.diff(np.append(first, len(values)))
+    ranks = np.empty(len(values))
+    ranks[order] = np.repeat(first + (ties + 1) / 2., ties)
+    return ranks
+
+
+
+def _correlation(x, y, y_order):
+
+    # Pearson and Spearman correlations of x and y; y_order sorts y.
+    n = len(x)
+    pearson = _moment_statistics(_moments(np.zeros(n, dtype=np.int64), 1, x, y))['pearson'][0]
+    if n < 2:
+        return {'count': n, 'pearson': pearson, 'spearman': np.nan}
+    rx = _average_ranks(x, np.argsort(x))
+    ry = _average_ranks(y, y_order)
+    spearman = _moment_statistics(_moments(np.zeros(n, dtype=np.int64), 1, rx, ry))['pearson'][0]
+    return {'count': n, 'pearson': pearson, 'spearman': spearman}
+
+
+
+def _whiskers(q1, q3, whis):
+
+    # Whisker limits of plt.boxplot: whis times the interquartile range
+    # beyond the quartiles.
+    iqr = q3 - q1
+    return q1 - whis * iqr, q3 + whis * iqr
+
+
+
+def _box_statistics(edges, moments, quantiles, quantile_values, whislo, whishi, data_min, data_max, fliers, correlation):
+
+    statistics = _moment_statistics(moments)
+    box = np.asarray(quantile_values)
+    statistics.update({'edges': np.asarray(edges, dtype=np.float64), 'quantiles': np.asarray(quantiles),
+                       'quantile_values': box[:, len(BOX_QUANTILES):],
+                       'q1': box[:, 0], 'median': box[:, 1], 'q3': box[:, 2],
+                       'whislo': whislo, 'whishi': whishi, 'min': data_min, 'max': data_max,
+                       'fliers': fliers, 'correlation': correlation})
+    return statistics
+
+
+
+def _bin_statistics(x, y, y_order, edges, quantiles, whis, clip, correlation):
+
+    bins = assign_bins(x, edges, clip)
+    n_bins = len(edges) - 1
+    # y sorted within each bin: stable sort (radix for small integers) of the bins of the y-sorted values
+    keys = bins[y_order].astype(np.int16 if n_bins < 2 ** 15 else np.int64)
+    order = y_order[np.argsort(keys, kind='stable')]
+    order = order[bins[order] >= 0]
+    sorted_bins = bins[order]
+    sorted_y = y[order]
+
+    counts = np.bincount(sorted_bins, minlength=n_bins)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    quantile_values = _sorted_quantiles(sorted_y, starts, counts, tuple(BOX_QUANTILES) + tuple(quantiles))
+    q1, q3 = quantile_values[:, 0], quantile_values[:, 2]
+
+    data_min = np.full(n_bins, np.nan)
+    data_max = np.full(n_bins, np.nan)
+    whislo = np.full(n_bins, np.nan)
+    whishi = np.full(n_bins, np.nan)
+    nonempty = counts > 0
+    if nonempty.any():
+        data_min[nonempty] = sorted_y[starts[nonempty]]
+        data_max[nonempty] = sorted_y[starts[nonempty] + counts[nonempty] - 1]
+        low, high = _whiskers(q1, q3, whis)
+        # Most extreme values within the limits, or the quartile if none is beyond it
+        whishi[nonempty] = np.maximum.reduceat(np.where(sorted_y <= high[sorted_bins], sorted_y, -np.inf),
+                                               starts[nonempty])
+        whislo[nonempty] = np.minimum.reduceat(np.where(sorted_y >= low[sorted_bins], sorted_y, np.inf),
+                                               starts[nonempty])
+        whishi = np.maximum(whishi, q3)
+        whislo = np.minimum(whislo, q1)
+
+    outside = (sorted_y < whislo[sorted_bins]) | (sorted_y > whishi[sorted_bins])
+    fliers = np.split(sorted_y[outside], np.cumsum(np.bincount(sorted_bins[outside], minlength=n_bins))[:-1])
+
+    if correlation is None:
+        # Over the binned pairs only; their y order is that of all the pairs, restricted
+        inside = bins >= 0
+        subset = np.cumsum(inside) - 1
+        correlation = _correlation(x[inside], y[inside], subset[y_order[inside[y_order]]])
+
+    return _box_statistics(edges, _moments(sorted_bins, n_bins, x[order], sorted_y), quantiles, quantile_values,
+                           whislo, whishi, data_min, data_max, fliers, correlation)
+
+
+
+def bin_statistics(x, y, edges, quantiles = (), whis = 1.5, clip = True):
+
+    # Distribution of y in the bins of x, e.g. of the sky camera coverage per
+    # bin of the MODIS cloud mask. Pairs with a NaN are ignored.
+    #   edges:     increasing bin edges of x, see assign_bins, or a dict
+    #              {name: edges} to compute several binnings at once (y is
+    #              sorted once for all of them)
+    #   quantiles: extra quantiles of y, e.g. (0.05, 0.95)
+    #   whis:      whisker length, in interquartile ranges, as in plt.boxplot
+    # Returns, per bin, arrays of count, mean, std, min, max, q1, median, q3,
+    # whislo and whishi, quantile_values (n_bins x len(quantiles)), pearson
+    # (correlation of x and y within the bin) and fliers (list of arrays),
+    # plus correlation: {'count', 'pearson', 'spearman'} over all the binned
+    # pairs. For a dict of binnings, {name: statistics}.
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    valid = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[valid], y[valid]
+    y_order = np.argsort(y)
+    # With clip, all the pairs are binned whatever the edges: one correlation for all the binnings
+    correlation = _correlation(x, y, y_order) if clip else None
+
+    if isinstance(edges, dict):
+        return dict((name, _bin_statistics(x, y, y_order, np.asarray(e, dtype=np.float64), quantiles, whis, clip, correlation))
+                    for name, e in edges.items())
+    return _bin_statistics(x, y, y_order, np.asarray(edges, dtype=np.float64), quantiles, whis, clip, correlation)
+
+
+
+class StreamingBinStatistics:
+
+    # bin_statistics over data read in chunks, for archives too large to be
+    # held in memory. Call update(x, y) for each chunk, then result().
+    # Count, mean, std and the Pearson correlations are exact (merged
+    # moments). Quantiles and whiskers are approximate: they are interpolated
+    # in a histogram of y per bin, with `resolution` buckets over value_range
+    # (y beyond it is counted in the first or last bucket), so the error is at
+    # most one bucket width. No fliers are kept and spearman is NaN.
+
+    def __init__(self, edges, value_range = (0., 1.), resolution = 1000, quantiles = (), whis = 1.5, clip = True):
+
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.n_bins = len(self.edges) - 1
+        self.buckets = np.linspace(value_range[0], value_range[1], resolution + 1)
+        self.resolution = resolution
+        self.quantiles = tuple(quantiles)
+        self.whis = whis
+        self.clip = clip
+
+        empty = np.zeros(0)
+        self.moments = _moments(np.zeros(0, dtype=np.int64), self.n_bins + 1, empty, empty)
+        self.histogram = np.zeros((self.n_bins, resolution), dtype=np.int64)
+        self.min = np.full(self.n_bins, np.inf)
+        self.max = np.full(self.n_bins, -np.inf)
+
+    def update(self, x, y):
+
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        valid = ~(np.isnan(x) | np.isnan(y))
+        x, y = x[valid], y[valid]
+        bins = assign_bins(x, self.edges, self.clip)
+        inside = bins >= 0
+        x, y, bins = x[inside], y[inside], bins[inside]
+
+        # The bins, and the whole chunk as an extra bin for the overall correlation
+        chunk = _moments(np.concatenate([bins, np.full(len(bins), self.n_bins)]), self.n_bins + 1,
+                         np.concatenate([x, x]), np.concatenate([y, y]))
+        self.moments = _merge_moments(self.moments, chunk)
+
+        bucket = np.clip(np.searchsorted(self.buckets, y, side='right') - 1, 0, self.resolution - 1)
+        self.histogram += np.bincount(bins * self.resolution + bucket,
+                                      minlength=self.n_bins * self.resolution).reshape(self.n_bins, self.resolution)
+        np.minimum.at(self.min, bins, y)
+        np.maximum.at(self.max, bins, y)
+        return self
+
+    def _quantiles(self, quantiles):
+
+        # Rank q * (n - 1) between the values of ranks floor and ceil, as
+        # np.quantile. Each of them is located in the cumulative histogram,
+        # linearly interpolated within its bucket and bounded by the data range.
+        counts = self.histogram.sum(axis=1)
+        cumulative = np.cumsum(self.histogram, axis=1)
+        rank = np.asarray(quantiles, dtype=np.float64)[None, :] * np.maximum(counts - 1, 0)[:, None]
+        width = self.buckets[1] - self.buckets[0]
+        ranked = []
+        for r in (np.floor(rank), np.ceil(rank)):
+            bucket = np.minimum((cumulative[:, None, :] <= r[:, :, None]).sum(axis=2), self.resolution - 1)
+            before = np.take_along_axis(np.pad(cumulative, ((0, 0), (1, 0))), bucket, axis=1)
+            in_bucket = np.take_along_axis(self.histogram, bucket, axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ranked.append(np.clip(self.buckets[bucket] + (r - before + 0.5) / in_bucket * width,
+                                      self.min[:, None], self.max[:, None]))
+        values = ranked[0] + (rank - np.floor(rank)) * (ranked[1] - ranked[0])
+        values[counts == 0] = np.nan
+        return values
+
+    def result(self):
+
+        # Same statistics as bin_statistics, see the accuracy above
+        quantile_values = self._quantiles(tuple(BOX_QUANTILES) + self.quantiles)
+        q1, q3 = quantile_values[:, 0], quantile_values[:, 2]
+        nonempty = self.histogram.sum(axis=1) > 0
+        data_min = np.where(nonempty, self.min, np.nan)
+        data_max = np.where(nonempty, self.max, np.nan)
+        low, high = _whiskers(q1, q3, self.whis)
+
+        # Extreme occupied buckets within the limits, bounded by the limits and the data
+        occupied = self.histogram > 0
+        lower_edges, upper_edges = self.buckets[:-1], self.buckets[1:]
+        highest = np.where(occupied & (lower_edges[None, :] <= high[:, None]), upper_edges[None, :], -np.inf).max(axis=1)
+        lowest = np.where(occupied & (upper_edges[None, :] >= low[:, None]), lower_edges[None, :], np.inf).min(axis=1)
+        whishi = np.maximum(np.minimum(np.minimum(highest, high), data_max), q3)
+        whislo = np.minimum(np.maximum(np.maximum(lowest, low), data_min), q1)
+
+        bins = dict((key, value[:self.n_bins]) for key, value in self.moments.items())
+        overall = _moment_statistics(dict((key, value[self.n_bins:]) for key, value in self.moments.items()))
+        correlation = {'count': int(overall['count'][0]), 'pearson': overall['pearson'][0], 'spearman': np.nan}
+        fliers = [np.empty(0) for _ in range(self.n_bins)]
+        return _box_statistics(self.edges, bins, self.quantiles, quantile_values, whislo, whishi,
+                               data_min, data_max, fliers, correlation)
+
+
+
+def boxplot_stats(statistics, labels = None):
+
+    # Boxes of bin_statistics (or StreamingBinStatistics.result) for
+    # matplotlib's Axes.bxp, which draws them like plt.boxplot would.
+    boxes = []
+    for k in range(len(statistics['count'])):
+        box = {'med': statistics['median'][k], 'q1': statistics['q1'][k], 'q3': statistics['q3'][k],
+               'whislo': statistics['whislo'][k], 'whishi': statistics['whishi'][k],
+               'fliers': statistics['fliers'][k], 'mean': statistics['mean'][k]}
+        if labels is not None:
+            box['label'] = labels[k]
+        boxes.append(box)
+    return boxes
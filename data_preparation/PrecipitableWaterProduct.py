@@ -1,7 +1,13 @@
 #!/usr/bin/env ipython3
 import gdal
+import os
 import numpy as np
-from utility import *
+from scipy import interpolate
+from geoIndex import geo_index, refine_closest_point
+from cache import LRUCache
+from cloudMaskDecoder import CLOUD_MASK_QA_FIELDS, decode_bit_fields
+from neighbourhood import class_statistics
+from instrumentation import count, timer
 
 # WARNING : There exist two versions of the products. For example, for the solar zenith it is:
  #('HDF4_SDS:UNKNOWN:"_data/data-2014-10-14/MOD05_L2.A2014287.0320.006.2015077151203.hdf":3',
@@ -12,23 +18,63 @@ from utility import *
 #I took the first one. I guess there are the same.
 
 
+def _clip_window(row0, row1, col0, col1, shape):
+    """ Window (first row, last row + 1, first column, last column + 1) clipped to shape. """
+    return (int(max(row0, 0)), int(min(row1, shape[0])), int(max(col0, 0)), int(min(col1, shape[1])))
+
+
+def _read_window(sub_ds, window):
+    """ Read only the window (row0, row1, col0, col1) of a subdataset. GDAL offsets are
+        (x, y) = (column, row); multi band subdatasets come as (band, row, column).
+    """
+    row0, row1, col0, col1 = _clip_window(window[0], window[1], window[2], window[3],
+                                          [sub_ds.RasterYSize, sub_ds.RasterXSize])
+    return sub_ds.ReadAsArray(col0, row0, col1 - col0, row1 - row0)
+
+
+def _granule_key(filename):
+    """ Platform, date and time of a granule, e.g. ('MOD', 'A2014287', '0320') for
+        MOD05_L2.A2014287.0320.006.2015077151203.hdf. The MOD05, MOD06 and MOD35 of a granule share it.
+    """
+    parts = os.path.basename(filename).split('.')
+    if len(parts) < 3:
+        return filename
+    return (parts[0][:3], parts[1], parts[2])
+
+
+# Interpolated georeferencing by granule and roi, see PrecipitableWaterProduct.georef_grid1k
+_georef_grids = LRUCache(maxsize=16)
+
+
 class PrecipitableWaterProduct:
+    # Decimation of the 5k georeferencing used to locate the roi before reading it
+    COARSE_STEP = 8
+    # Number of opened subdatasets and of extracted roi arrays kept per granule
+    HANDLE_CACHE_SIZE = 8
+    ARRAY_CACHE_SIZE = 8
+
     def __init__(self, filename, roi_lat = 1.342966, roi_long = 103.680594, roi_width_km = 100):
     #def __init__(self, filename, roi_lat = 30.5313889, roi_long = 114.3572222, roi_width_km = 100):
         self.filename = filename
         try:
-            self.data_set = gdal.Open(filename)
+            with timer('gdal_open'):
+                self.data_set = gdal.Open(filename)
+            # Subdataset name by description without the size prefix, e.g. 'Solar_Zenith (16-bit integer)'
+            self.subdataset_list = self.data_set.GetSubDatasets()
+            self.subdatasets = dict((descr.split('] ', 1)[-1], sd) for sd, descr in reversed(self.subdataset_list))
+            self.handles = LRUCache(self.HANDLE_CACHE_SIZE)
+            self.arrays = LRUCache(self.ARRAY_CACHE_SIZE)
             self.center = [roi_lat, roi_long]
+            self.roi_width_km = roi_width_km
+            # Sites left out by the last locateSites or extractSites, {name: reason}
+            self.skipped_sites = {}
             
             self.size5k = None
-            self.georef_grid1k = None
         
-            # Extract the georeferencing
-            sub_lat_set = gdal.Open([sd for sd, descr in self.data_set.GetSubDatasets() if descr.endswith('Latitude (32-bit floating-point)')][0])
-            sub_long_set = gdal.Open([sd for sd, descr in self.data_set.GetSubDatasets() if descr.endswith('Longitude (32-bit floating-point)')][0])
-            self.georef_grid = np.dstack((sub_lat_set.ReadAsArray(), sub_long_set.ReadAsArray()))
-            sub_lat_set = None
-            sub_long_set = None
+            # Georeferencing subdatasets. Only the roi window is read from them, see geoSubSample
+            self.lat_sds = self.findSubDataset('Latitude (32-bit floating-point)')
+            self.long_sds = self.findSubDataset('Longitude (32-bit floating-point)')
+            self.swath5k = []
             self.size5k = []
             self.size1k = []
             
@@ -37,63 +83,254 @@ class PrecipitableWaterProduct:
             self.lrcrnY = 0
             self.ulcrnX = 0          # Upper Left corner
             self.ulcrnY = 0 
-            self.geoSubSample(roi_lat, roi_long, roi_width_km)
+            if roi_lat is None:
+                # No roi yet, it is set later by locateSites()
+                sub_lat_set = self.openSubDataset(self.lat_sds)
+                self.swath5k = [sub_lat_set.RasterYSize, sub_lat_set.RasterXSize]
+            else:
+                self.geoSubSample(roi_lat, roi_long, roi_width_km)
 
         except:
             print("Error when reading file. Either file does not exist, or is not a valid MOD06 product")
             raise
         
     def geoSubSample(self, center_lat, center_long, width_km):
+        """ Locate the roi and read the 5k georeferencing of the roi only. The center is first
+            searched on a decimated grid, then refined on full resolution windows around it, widened
+            until the closest pixel is inside of one (see geoIndex.refine_closest_point).
+        """
         assert width_km % 10 == 0, "The size of the roi must be a multiple of 10"
         
         center = np.array([center_lat, center_long])
-        grid_center = closest_point(self.georef_grid, center)
+        sub_lat_set = self.openSubDataset(self.lat_sds)
+        sub_long_set = self.openSubDataset(self.long_sds)
+        self.swath5k = [sub_lat_set.RasterYSize, sub_lat_set.RasterXSize]
+        
+        step = self.COARSE_STEP
+        coarse_size = [-(-self.swath5k[0] // step), -(-self.swath5k[1] // step)]
+        with timer('sds_read'):
+            coarse_grid = np.dstack([sds.ReadAsArray(0, 0, self.swath5k[1], self.swath5k[0],
+                                                     buf_xsize=coarse_size[1], buf_ysize=coarse_size[0])
+                                     for sds in (sub_lat_set, sub_long_set)])
+        with timer('closest_point'):
+            coarse_center = geo_index((self.filename, '5k-coarse'), coarse_grid).closest_point(center)
+        # Pixel of the full grid picked by GDAL for the decimated one
+        approx_center = [int((coarse_center[i] + 0.5) * self.swath5k[i] / coarse_size[i]) for i in range(2)]
         
+        def read_refine_window(window):
+            with timer('sds_read'):
+                return np.dstack([_read_window(sds, window) for sds in (sub_lat_set, sub_long_set)])
+        grid_center = refine_closest_point(read_refine_window, self.swath5k, center, approx_center, step)[:2]
+        sub_lat_set = None
+        sub_long_set = None
         
-        self.georef_grid = self.georef_grid[grid_center[0] - width_km/10 : grid_center[0] + width_km/10 + 1, \
-                                            grid_center[1] - width_km/10 : grid_center[1] + width_km/10 + 1, :]
-        grid_center = np.multiply(grid_center, 5)   # Coordinates to center the 1k dataset
-
-        self.ulcrnX = grid_center[0] - width_km/2
-        self.ulcrnY = grid_center[1] - width_km/2
-        self.lrcrnX = grid_center[0] + width_km/2 + 1
-        self.lrcrnY = grid_center[1] + width_km/2 + 1
+        self.setRoi5k(_clip_window(grid_center[0] - width_km//10, grid_center[0] + width_km//10 + 1,
+                                   grid_center[1] - width_km//10, grid_center[1] + width_km//10 + 1, self.swath5k))
+        
+    def setRoi5k(self, window5k):
+        """ Use the 5k window (first row, last row + 1, first column, last column + 1) as roi. The
+            1k roi is the part of the 1k grid it covers: 5k pixel (i, j) is 1k pixel (5i, 5j).
+        """
+        self.window5k = window5k
+        with timer('sds_read'):
+            self.georef_grid = np.dstack([_read_window(self.openSubDataset(sds), window5k)
+                                          for sds in (self.lat_sds, self.long_sds)])
+        self.ulcrnX = 5 * window5k[0]
+        self.lrcrnX = 5 * (window5k[1] - 1) + 1
+        self.ulcrnY = 5 * window5k[2]
+        self.lrcrnY = 5 * (window5k[3] - 1) + 1
         
         # Update size
         self.size5k = [self.georef_grid.shape[0], self.georef_grid.shape[1]]
-        self.size1k = [width_km + 1, width_km + 1]
-        # Update derived products
-        self.__interpolateGeoreferencing()    
+        self.size1k = [self.lrcrnX - self.ulcrnX, self.lrcrnY - self.ulcrnY]
+        # The derived 1k and 250m georeferencing are interpolated on first access
         
+    def closestPixels1k(self, points):
+        """ Closest pixels of the 1k roi grid for a list of [lat, lon]. Returns the row and column
+            indices and the distance in km. The KD-tree of the grid is cached for the granule.
+        """
+        key = (self.filename, '1k', self.ulcrnX, self.ulcrnY, self.lrcrnX, self.lrcrnY)
+        grid = self.georef_grid1k
+        with timer('closest_point'):
+            return geo_index(key, grid).query(points)
+
+    def locateSites(self, sites, max_size):
+        """ Locate many sites with one query on the 5k grid and set the roi to the window covering
+            those inside of the swath, with room for boxes of max_size 1k pixels around them. A site is
+            inside if it is within half the diagonal of its closest 5k pixel, which grows towards the
+            swath edge; the others are recorded in skipped_sites with their distance.
+            Returns the indices in sites of the located sites and their rows and columns in the 1k roi.
+        """
+        self.skipped_sites = {}
+        points = np.array([[site[1], site[2]] for site in sites], dtype=np.float64).reshape(-1, 2)
+        if len(points) == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+        full_grid = lambda: np.dstack([self.openSubDataset(sds).ReadAsArray() for sds in (self.lat_sds, self.long_sds)])
+        with timer('closest_point'):
+            index = geo_index((self.filename, '5k'), full_grid)
+            rows, cols, distance = index.query(points)
+            max_distance = index.half_diagonal(rows, cols)
+        inside = np.flatnonzero(distance <= max_distance)
+        for k in np.setdiff1d(np.arange(len(sites)), inside):
+            self.skipped_sites[sites[k][0]] = 'outside of the swath: {0:.1f} km from the closest 5k pixel, limit {1:.1f} km'.format(
+                distance[k], max_distance[k])
+        if len(inside) == 0:
+            return inside, inside, inside
+
+        margin = max_size // 10 + 2     # 5k pixels around the sites, for the boxes and the spline
+        self.setRoi5k(_clip_window(rows[inside].min() - margin, rows[inside].max() + margin + 1,
+                                   cols[inside].min() - margin, cols[inside].max() + margin + 1, self.swath5k))
+        rows1k, cols1k, _ = self.closestPixels1k(points[inside])
+        return inside, rows1k, cols1k
+
+    def extractSites(self, sites):
+        """ Boxes of the cloud mask quality flag around many sites, in one pass over the granule.
+            sites: list of (name, lat, lon, window size), see sites.py. All the sites are located on
+            the 5k grid with one query, those outside of the swath are skipped. The roi is then set
+            to the window covering the remaining sites, whose Cloud_Mask_QA is read and decoded once.
+            Returns {name: box} for the sites whose box is inside of the swath, the others are in
+            skipped_sites with the reason.
+        """
+        return self.extractSitesWithStatistics(sites, ())[0]
+
+    def extractSiteStatistics(self, sites, sizes = (3, 5, 11, None)):
+        """ Cloud fraction and counts of each quality flag class around many sites, for all the window
+            sizes at once, from integral images of the decoded Cloud_Mask_QA (see neighbourhood.py).
+            sizes: window sizes in 1k pixels; None stands for the roi, a box of roi_width_km + 1 pixels.
+            Returns {name: {size: statistics}} for the sites inside of the swath, with for each size
+            counts (cloud, 66%, 95%, 99% clear), n_pixels, complete, cloud_fraction and mean, see
+            neighbourhood.class_statistics. Windows cut by the swath edge are kept with complete False.
+        """
+        return self.extractSitesWithStatistics(sites, sizes, boxes=False)[1]
+
+    def extractSitesWithStatistics(self, sites, sizes = (3, 5, 11, None), boxes = True):
+        """ extractSites and extractSiteStatistics from one roi: the sites are located once, with
+            room for the largest box and window, and Cloud_Mask_QA is read and decoded once for both.
+            Returns ({name: box}, {name: {size: statistics}}), the statistics being empty if sizes is.
+        """
+        if len(sites) == 0:
+            return {}, {}
+        box_sizes = np.array([int(site[3]) for site in sites])
+        window_sizes = [self.roi_width_km + 1 if size is None else int(size) for size in sizes]
+        inside, rows1k, cols1k = self.locateSites(sites, max([box_sizes.max() if boxes else 0] + window_sizes))
+        if len(inside) == 0:
+            return {}, {}
+        flags = self.extractCloudMaskQA_Flags()
+
+        site_boxes = {}
+        if boxes:
+            quality = flags['quality_flag'] << 6
+            for size in np.unique(box_sizes[inside]):
+                group = np.flatnonzero(box_sizes[inside] == size)
+                box_rows = rows1k[group][:, None] + np.arange(size) - size // 2
+                box_cols = cols1k[group][:, None] + np.arange(size) - size // 2
+                complete = ((box_rows.min(axis=1) >= 0) & (box_rows.max(axis=1) < quality.shape[0]) &
+                            (box_cols.min(axis=1) >= 0) & (box_cols.max(axis=1) < quality.shape[1]))
+                values = quality[np.clip(box_rows, 0, quality.shape[0] - 1)[:, :, None],
+                                 np.clip(box_cols, 0, quality.shape[1] - 1)[:, None, :]]
+                for k in np.flatnonzero(complete):
+                    site_boxes[sites[inside[group[k]]][0]] = values[k]
+                for k in np.flatnonzero(~complete):
+                    self.skipped_sites[sites[inside[group[k]]][0]] = 'box of {0} pixels cut by the swath edge'.format(size)
+
+        results = {}
+        if window_sizes:
+            statistics = class_statistics(flags['quality_flag'], rows1k, cols1k, set(window_sizes))
+            for k, site in enumerate(inside):
+                results[sites[site][0]] = dict((size, dict((name, value[k]) for name, value in statistics[window].items()))
+                                               for size, window in zip(sizes, window_sizes))
+        return site_boxes, results
+
+    def findSubDataset(self, description):
+        """ Name of the first subdataset whose description ends with description. """
+        if description in self.subdatasets:
+            return self.subdatasets[description]
+        for sd, descr in self.subdataset_list:
+            if descr.endswith(description):
+                return sd
+        raise KeyError(description)
+
+    def openSubDataset(self, sd):
+        """ Opened subdataset, kept in the handle cache of the granule. """
+        sub_ds = self.handles.get(sd)
+        if sub_ds is None:
+            with timer('gdal_open'):
+                sub_ds = self.handles.put(sd, gdal.Open(sd))
+        return sub_ds
+
+    def clearCache(self, description = None):
+        """ Evict the cached roi arrays and subdataset handles, of one product or of all of them. """
+        if description is None:
+            self.arrays.clear()
+            self.handles.clear()
+            return
+        for key in [key for key in self.arrays.entries if key[0] == description]:
+            self.arrays.evict(key)
+        self.handles.evict(self.findSubDataset(description))
+
     def extractByName(self, description):
+        """ Roi of the product. The array is cached per roi and is read-only, copy it to modify it. """
+        key = (description, self.ulcrnX, self.lrcrnX, self.ulcrnY, self.lrcrnY)
+        data = self.arrays.get(key)
+        if data is not None:
+            return data
         try:
-            sub_ds = gdal.Open([sd for sd, descr in self.data_set.GetSubDatasets() if descr.endswith(description)][0])
-            return sub_ds.ReadAsArray()[self.ulcrnX:self.lrcrnX, self.ulcrnY:self.lrcrnY]
+            sub_ds = self.openSubDataset(self.findSubDataset(description))
+            with timer('sds_read'):
+                if [sub_ds.RasterYSize, sub_ds.RasterXSize] == self.swath5k:
+                    data = _read_window(sub_ds, self.window5k)     # 5k product
+                else:
+                    data = _read_window(sub_ds, (self.ulcrnX, self.lrcrnX, self.ulcrnY, self.lrcrnY))
+            count('sds_read_bytes', data.nbytes)
         except:
             print("Error while extracting product. Either file sub dataset does not exist,\
  or is not a valid MOD06 product")
             raise
+        data.flags.writeable = False
+        return self.arrays.put(key, data)
     
-    def __interpolateGeoreferencing(self):
+    @property
+    def georef_grid1k(self):
+        """ Latitude and longitude of the 1k roi grid, interpolated from the 5k grid on first access. """
+        return self.__interpolatedGeoreferencing(self.size1k)
+
+    @property
+    def georef_grid250m(self):
+        """ Latitude and longitude of the 250m roi grid, interpolated from the 5k grid on first access. """
+        return self.__interpolatedGeoreferencing([4 * (n - 1) + 1 for n in self.size1k])
+
+    def __interpolatedGeoreferencing(self, size):
+        """ Interpolated grid of the given size, shared through _georef_grids by all the products
+            (MOD05, MOD06, MOD35...) of the same granule and roi.
+        """
+        key = (_granule_key(self.filename), self.window5k, tuple(size))
+        grid = _georef_grids.get(key)
+        if grid is None:
+            with timer('interpolation'):
+                grid = self.__interpolateGeoreferencing(size)
+            grid.flags.writeable = False
+            _georef_grids.put(key, grid)
+        return grid
+
+    def __interpolateGeoreferencing(self, size):
         """ Interpolate the georeferencing 5k grid included in the product for 1k and 250m array. This has not
             be test in regard of MOD03 9? (contains 1k grid by NASA) but consistenty of result has been assessed.
             IMP: For this function to work correctly, the roi must contains at least more than 3 element,
             so we can safely interpolate a second dregree spline. 
         """
-        latitude = np.dsplit(self.georef_grid, 2)[0]
-        longitude = np.dsplit(self.georef_grid, 2)[1]
-        from scipy import interpolate
-        ## 1k interpolation
-        # Indices for the 1k grid
+        latitude = self.georef_grid[:, :, 0]
+        longitude = self.georef_grid[:, :, 1]
+        # Indices for the interpolated grid
         x = np.arange(latitude.shape[0])
         y = np.arange(latitude.shape[1])
-        xx = np.linspace(x.min(), x.max(), self.size1k[0])
-        yy = np.linspace(y.min(), y.max(), self.size1k[1])
-        # Create the 1k grid : Latitude and longitude
-        lat_1k = interpolate.RectBivariateSpline(x, y, latitude)(xx, yy)
-        long_1k = interpolate.RectBivariateSpline(x, y, longitude)(xx, yy)
+        xx = np.linspace(x.min(), x.max(), size[0])
+        yy = np.linspace(y.min(), y.max(), size[1])
+        # Create the grid : Latitude and longitude
+        lat_grid = interpolate.RectBivariateSpline(x, y, latitude)(xx, yy)
+        long_grid = interpolate.RectBivariateSpline(x, y, longitude)(xx, yy)
         # Merge
-        self.georef_grid1k = np.dstack((lat_1k, long_1k))
+        return np.dstack((lat_grid, long_grid))
    
     def extractSolarZenith_5k(self):
         """ Solar Zenith Angle, Cell to Sun. in degrees. """
@@ -120,17 +357,35 @@ class PrecipitableWaterProduct:
         return np.multiply(self.extractByName('Water_Vapor_Correction_Factors (16-bit integer)'), scale_factor)
         
   
+    def extractCloudMaskQA_Flags(self):
+        """ All the flags of 'Cloud_Mask_QA', decoded in one pass over the bytes. Returns a structured
+            array with one uint8 field per flag of cloudMaskDecoder.CLOUD_MASK_QA_FIELDS, cached per roi.
+        """
+        key = ('Cloud_Mask_QA flags', self.ulcrnX, self.lrcrnX, self.ulcrnY, self.lrcrnY)
+        flags = self.arrays.get(key)
+        if flags is None:
+            qa = self.extractByName('Cloud_Mask_QA (8-bit integer)')
+            with timer('qa_decode'):
+                flags = decode_bit_fields(qa, CLOUD_MASK_QA_FIELDS)
+            flags.flags.writeable = False
+            self.arrays.put(key, flags)
+        return flags
+
+    def extractCloudMask_35(self, fields = None):
+        """ Flags of the 6 bytes 'Cloud_Mask' of MOD35/MYD35, bytes first: [6 x rows x cols].
+            fields: names of cloudMaskDecoder.CLOUD_MASK_FIELDS or dict of (byte, first bit, number of bits),
+            all the named fields by default. Returns a structured array with one uint8 field per flag.
+        """
+        mask = self.extractByName('Cloud_Mask (8-bit integer)')
+        with timer('qa_decode'):
+            return decode_bit_fields(mask, fields, byte_axis=0)
+
     def extractCloudMaskQA_CloudMaskFlag_1k(self):
         """ MODIS Cloud Mask and Spectral Test Results: Cloud Mask Flag from bit 1.
            Cloud Mask Flag                      0 = not determined
                                                 1 = determined
         """
-        cloudMaskQA = self.extractByName('Cloud_Mask_QA (8-bit integer)')
-        print(cloudMaskQA.shape)
-        byte = np.unpackbits(cloudMaskQA)
-        byte = byte.reshape(byte.size/8, 8).reshape(self.size1k[0], self.size1k[1], 8)
-        cm_flag = byte[:,:,7]
-        return cm_flag
+        return self.extractCloudMaskQA_Flags()['cloud_mask_flag'].copy()
 
     def extractCloudMaskQA_QualityFlag(self):
         """Return a numpy array for the 'Cloud_Mask Unobstructed FOV Quality Flag' from bit 2,1
@@ -138,13 +393,9 @@ class PrecipitableWaterProduct:
                                               01 = 66% prob. clear
                                               10 = 95% prob. clear
                                               11 = 99% prob. clear
+           The two bits are returned as the high bits of a byte (0, 64, 128, 192), as before.
         """
-        cloudMaskQA = self.extractByName('Cloud_Mask_QA (8-bit integer)')
-        byte = np.unpackbits(cloudMaskQA)
-        byte = byte.reshape(byte.size/8, 8).reshape(self.size1k[0], self.size1k[1], 8)
-        q_flag = byte[:, :, 5:7]
-        q_flag = np.squeeze(np.packbits(q_flag, axis=-1), axis=(2,)) # Reconstruct the array for Quality Flag
-        return q_flag
+        return self.extractCloudMaskQA_Flags()['quality_flag'] << 6
 
     def extractCloudMaskQA_LandCoverFlag(self):
         """Return a numpy array for the 'Land or Water Path' from bit 7,6. 
@@ -152,77 +403,25 @@ class PrecipitableWaterProduct:
                                         01 = Coastal
                                         10 = Desert
                                         11 = Land
+           The two bits are returned as the high bits of a byte (0, 64, 128, 192), as before.
         """
-        cloudMaskQA = self.extractByName('Cloud_Mask_QA (8-bit integer)')
-        byte = np.unpackbits(cloudMaskQA)
-        byte = byte.reshape(byte.size/8, 8).reshape(self.size1k[0], self.size1k[1], 8)
-        lc_flag = byte[:,:,0:2]
-        lc_flag = np.squeeze(np.packbits(lc_flag, axis=-1), axis=(2,))
-        return lc_flag
-
-    def dispayOnMap(self, product):
-        """ Template function for displaying on a map. Not meant to be used as it is. Present
-            a reference layout """
-        import matplotlib.pyplot as plt
-        import matplotlib.image as mpimg
-        from matplotlib import colors
-        from mpl_toolkits.basemap import Basemap
-        import matplotlib as mpl
-
-
-        fig, ax = plt.subplots()
-        fig.set_facecolor('white')
-        mpl.rc('font', family='sans-serif')
-        mpl.rc('font', serif='Oxygen-Sans')
-        mpl.rc('text', usetex='false')
-        mpl.rcParams.update({'font.size': 11})
-
-        # Basemap ('lcc' = lambert conformal conic).
-        map = Basemap(projection = 'lcc', resolution='h', area_thresh=0.1,
-            llcrnrlon=103, llcrnrlat=1,                     # A bit bigger area
-            urcrnrlon=105, urcrnrlat=2,
-            #llcrnrlon=103.529044, llcrnrlat=1.132124,      # Bounding box
-            #urcrnrlon=104.160634, urcrnrlat=1.546439,
-            lat_0 = 1.342966, lon_0 = 103.680594
-            )
-        ## Appearance
-        map.drawcoastlines()
-        
-        if (product == 'LC'):
-            cmap_bg = colors.ListedColormap(['blue', 'palegreen','red','green']) # red for desert, palegreen for coastal
-            bounds_bg = [0, 64, 128, 192, 256]
-            norm_bg = colors.BoundaryNorm(bounds_bg, cmap_bg.N)
-            cax = map.pcolormesh(self.georef_grid1k[:, :, 1],
-                                 self.georef_grid1k[:, :, 0],
-                                 self.extractCloudMaskQA_LandCoverFlag(),
-                                 shading='flat', cmap=cmap_bg, norm=norm_bg, latlon=True)
-            ax.set_title('.'.join(self.filename.split('/')[-1].split('.')[0:-2]) + ' \n Land Cover Flag')
-            cbar = fig.colorbar(cax, ticks=[32, 96, 160, 224])
-            cbar.ax.set_yticklabels(['Water', 'Coastal', 'Desert', 'Land'])
-            
-        elif (product == 'CM_subsample'):
-            "ax.set_title('.'.join(self.filename.split('/')[-1].split('.')[0:-2]) + ' \n Cloud Mask')"
-            cmap = colors.ListedColormap(['gray','green','red', 'blue'])
-            bounds =[0, 64, 128, 192, 256]
-            norm = colors.BoundaryNorm(bounds, cmap.N)
-            cax = map.pcolormesh(self.georef_grid1k[:, :, 1],
-                                 self.georef_grid1k[:, :, 0],
-                                 self.extractCloudMaskQA_QualityFlag(),
-                                 shading='flat', cmap=cmap, norm=norm, latlon=True)
-            cbar = fig.colorbar(cax, ticks=[32, 96, 160, 224])
-            cbar.ax.set_yticklabels(['100% clouds', '60% cloud free', '92% cloud free', '98% cloud free'])
-        elif (product == 'CM'):
-            ax.set_title('.'.join(self.filename.split('/')[-1].split('.')[0:-2]) + ' \n Cloud Mask')
-            cmap = colors.ListedColormap(['gray','green','red', 'blue'])
-            bounds =[0, 64, 128, 192, 256]
-            norm = colors.BoundaryNorm(bounds, cmap.N)
-            cax = map.pcolormesh(self.georef_grid1k[:, :, 1],
-                                 self.georef_grid1k[:, :, 0],
-                                 self.extractCloudMaskQA_QualityFlag(),
-                                 shading='flat', cmap=cmap, norm=norm, latlon=True)
-            cbar = fig.colorbar(cax, ticks=[32, 96, 160, 224])
-            cbar.ax.set_yticklabels(['100% clouds', '60% cloud free', '92% cloud free', '98% cloud free'])
-        # Point for WSI position
-        map.scatter(self.center[1], self.center[0], s=100, facecolor='none', edgecolors='g', latlon = True, alpha=1)
-        fig.tight_layout()
-        plt.show()
+        return self.extractCloudMaskQA_Flags()['land_water'] << 6
+
+    def dispayOnMap(self, product, path = None):
+        """ Display the roi of product ('CM', 'CM_subsample' or 'LC') on a map around the roi center,
+            or save it as path (e.g. a PNG) without opening a window. The map is built once per process
+            and the decoded flags of the roi are reused; see quicklook.py to render many granules.
+        """
+        from quicklook import LAYERS, QuickLook, granule_name, site_map
+
+        layer = 'CM' if product == 'CM_subsample' else product
+        site = ('roi', self.center[0], self.center[1])
+        figure = None
+        if path is None:
+            import matplotlib.pyplot as plt
+            figure = plt.figure()
+        quick_look = QuickLook(site_map(site), site, layer, figure=figure)
+        quick_look.render(self.georef_grid1k[:, :, 1], self.georef_grid1k[:, :, 0], getattr(self, LAYERS[layer][0])(),
+                          granule_name(self.filename), path)
+        if path is None:
+            plt.show()
@@ -0,0 +1,39 @@
+"""
+   Small bounded cache shared by the product classes. Entries are dropped in
+   least recently used order once the cache is full, or explicitly with evict().
+"""
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize = 16):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key, default = None):
+        """ Return the cached value and mark it as the most recently used. """
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        """ Store a value, evicting the least recently used entries above maxsize. """
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def evict(self, key):
+        """ Drop one entry. Returns the evicted value, None if it was not cached. """
+        return self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
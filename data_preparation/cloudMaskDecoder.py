@@ -0,0 +1,54 @@
+"""
+   Bitwise decoding of the MODIS cloud mask bytes. All the requested bit fields are extracted
+   with shifts and masks in one pass over the bytes, without expanding them to bits.
+
+   The layout follows the MOD35/MYD35 Cloud_Mask SDS (6 bytes per pixel, bytes first:
+   [6 x rows x cols]). The Cloud_Mask_QA of MOD05/MOD06 holds the first byte only. Other
+   layouts, such as the 10 byte Quality_Assurance SDS ([rows x cols x 10]), are decoded by
+   passing their own fields and byte_axis.
+"""
+import numpy as np
+
+# name: (byte, first bit, number of bits)
+CLOUD_MASK_FIELDS = {
+    'cloud_mask_flag':        (0, 0, 1),   # 0 = not determined, 1 = determined
+    'quality_flag':           (0, 1, 2),   # Unobstructed FOV: 00 = cloud, 01 = 66% clear, 10 = 95% clear, 11 = 99% clear
+    'day_night':              (0, 3, 1),   # 0 = night, 1 = day
+    'sunglint':               (0, 4, 1),   # 0 = yes, 1 = no
+    'snow_ice':               (0, 5, 1),   # 0 = yes, 1 = no
+    'land_water':             (0, 6, 2),   # 00 = water, 01 = coastal, 10 = desert, 11 = land
+    'non_cloud_obstruction':  (1, 0, 1),   # Heavy aerosol, 0 = yes, 1 = no
+    'thin_cirrus_solar':      (1, 1, 1),   # 0 = yes, 1 = no
+    'shadow':                 (1, 2, 1),   # 0 = yes, 1 = no
+    'thin_cirrus_infrared':   (1, 3, 1),   # 0 = yes, 1 = no
+}
+
+# Fields held by the one byte Cloud_Mask_QA of MOD05/MOD06
+CLOUD_MASK_QA_FIELDS = [name for name, (byte, _, _) in CLOUD_MASK_FIELDS.items() if byte == 0]
+
+
+def decode_bit_fields(packed, fields = None, byte_axis = None):
+    """ Decode bit fields of packed cloud mask bytes.
+        packed:    8-bit array. One byte per pixel if byte_axis is None, otherwise the bytes of
+                   each pixel are along byte_axis (0 for Cloud_Mask, -1 for Quality_Assurance).
+        fields:    names of CLOUD_MASK_FIELDS, or a dict name: (byte, first bit, number of bits).
+                   Defaults to all the fields available in packed.
+        Returns a structured array with one uint8 field per flag, with the shape of the pixels.
+    """
+    packed = np.asarray(packed)
+    packed = packed.view(np.uint8) if packed.dtype == np.int8 else packed.astype(np.uint8, copy=False)
+    n_bytes = 1 if byte_axis is None else packed.shape[byte_axis]
+
+    if fields is None:
+        fields = dict((name, spec) for name, spec in CLOUD_MASK_FIELDS.items() if spec[0] < n_bytes)
+    elif not isinstance(fields, dict):
+        fields = dict((name, CLOUD_MASK_FIELDS[name]) for name in fields)
+
+    pixel_shape = packed.shape if byte_axis is None else np.delete(packed.shape, byte_axis)
+    decoded = np.empty(tuple(pixel_shape), dtype=[(name, np.uint8) for name in fields])
+    for name, (byte, first_bit, n_bits) in fields.items():
+        if byte >= n_bytes:
+            raise ValueError("Field {0} is in byte {1}, the array has {2} byte(s) per pixel".format(name, byte, n_bytes))
+        plane = packed if byte_axis is None else np.take(packed, byte, axis=byte_axis)
+        decoded[name] = (plane >> first_bit) & ((1 << n_bits) - 1)
+    return decoded
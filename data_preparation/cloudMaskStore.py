@@ -0,0 +1,234 @@
+"""
+   Append-only columnar store for the extracted cloud mask time series. A store is a folder:
+        meta.json            window size of the store, and the index of the parts
+        part-<n>.npz         one file per append (or per compaction), rows sorted by site and time
+   Columns:
+        satellite  'MOD' or 'MYD'
+        site       name of the site, at most SITE_LENGTH characters
+        time       UTC acquisition time, datetime64[s]
+        window     N-by-N Cloud_Mask_QA quality flag values (0, 64, 128, 192) around the site, float32
+        mean       cloud fraction of the window, the share of its pixels flagged cloudy (0 to 1), float32
+        centre     1 if the pixel of the site is flagged cloudy, 0 otherwise, float32
+   mean and centre are in the unit of the .mat files of cloud_mask and of the notebook, see
+   cloud_fraction(). The index keeps the number of rows and the first and last site and time of
+   each part, so that loading only reads the parts that can hold the requested sites and time
+   range, and filters their rows with binary searches. Once there are more than max_parts parts,
+   the small ones (less than part_rows rows) are merged, so that a multi-year archive stays a
+   few files; compact() merges them all.
+"""
+import glob
+import json
+import os
+import numpy as np
+
+COLUMNS = ['satellite', 'site', 'time', 'window', 'mean', 'centre']
+SITE_LENGTH = 32
+CLOUDY = 0          # Quality flag of the cloudy pixels
+
+
+def cloud_fraction(window, axis = None):
+    """ Share of the pixels of the window flagged cloudy, NaN (padding) pixels excluded. """
+    window = np.asarray(window, dtype=np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((window == CLOUDY).sum(axis=axis) / np.isfinite(window).sum(axis=axis)).astype(np.float32)
+
+
+class CloudMaskStore:
+    def __init__(self, path, window_size = 3, max_parts = 64, part_rows = 1 << 18):
+        """ Open the store in folder path, creating it if needed. The window size of an existing
+            store is read from it. The parts missing from the index (e.g. after an interrupted
+            append) are indexed again.
+        """
+        self.path = path
+        self.max_parts = max_parts
+        self.part_rows = part_rows
+        meta_file = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            self.window_size = meta['window_size']
+            self.index = meta.get('parts', {})
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.window_size = window_size
+            self.index = {}
+        names = [os.path.basename(part) for part in self.parts()]
+        if not os.path.isfile(meta_file) or set(names) != set(self.index):
+            # Parts merged by an interrupted compaction are removed, the others indexed
+            merged = set(name for entry in self.index.values() for name in entry.get('merged', []))
+            for name in set(names) & merged - set(self.index):
+                os.remove(os.path.join(path, name))
+            self.index = dict((name, self.index.get(name) or _part_index(_read_part(os.path.join(path, name))))
+                              for name in names if name not in merged or name in self.index)
+            self._save_meta()
+
+    def parts(self):
+        return sorted(glob.glob(os.path.join(self.path, 'part-*.npz')))
+
+    def append(self, satellite, site, time, window, mean = None, centre = None):
+        """ Append rows. satellite, site and time are sequences (or scalars, repeated), window
+            an array (rows, N, N) of quality flag values. mean and centre default to the cloud
+            fraction of the window and of its centre pixel, see cloud_fraction().
+            Returns the number of rows appended.
+        """
+        window = np.asarray(window, dtype=np.float32).reshape(-1, self.window_size, self.window_size)
+        n = len(window)
+        if n == 0:
+            return 0
+        site = np.asarray(site, dtype=str)
+        if site.size and np.char.str_len(site).max() > SITE_LENGTH:
+            raise ValueError("Site names are limited to {0} characters: {1}".format(
+                SITE_LENGTH, ', '.join(sorted(set(name for name in site.ravel() if len(name) > SITE_LENGTH)))))
+        if mean is None:
+            mean = cloud_fraction(window, axis=(1, 2))
+        if centre is None:
+            centre = cloud_fraction(window[:, self.window_size // 2, self.window_size // 2, None], axis=1)
+        columns = {'satellite': np.broadcast_to(np.asarray(satellite, dtype='U3'), (n,)),
+                   'site': np.broadcast_to(site.astype('U{0}'.format(SITE_LENGTH)), (n,)),
+                   'time': np.broadcast_to(np.asarray(time, dtype='datetime64[s]'), (n,)),
+                   'window': window,
+                   'mean': np.broadcast_to(np.asarray(mean, dtype=np.float32), (n,)),
+                   'centre': np.broadcast_to(np.asarray(centre, dtype=np.float32), (n,))}
+        self._write_part(_sorted(columns))
+        if len(self.index) > self.max_parts:
+            small = [name for name, entry in self.index.items() if entry['rows'] < self.part_rows]
+            if len(small) > 1:
+                self.compact(small)
+        return n
+
+    def _write_part(self, columns, merged = ()):
+        parts = self.parts()
+        number = int(os.path.basename(parts[-1])[5:-4]) + 1 if parts else 0
+        name = 'part-{0:06d}.npz'.format(number)
+        part_file = os.path.join(self.path, name)
+        # Written under a temporary name, so that readers never see half a part
+        with open(part_file + '.tmp', 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(part_file + '.tmp', part_file)
+        self.index[name] = _part_index(columns)
+        if merged:
+            self.index[name]['merged'] = list(merged)
+        self._save_meta()
+        return part_file
+
+    def _save_meta(self):
+        meta_file = os.path.join(self.path, 'meta.json')
+        with open(meta_file + '.tmp', 'w') as f:
+            json.dump({'window_size': self.window_size, 'parts': self.index}, f, sort_keys=True)
+        os.replace(meta_file + '.tmp', meta_file)
+
+    def load(self, start = None, end = None, sites = None, satellites = None):
+        """ Rows with start <= time < end, of the given sites and satellites (all by default).
+            sites and satellites are names or lists of names. Returns a dict of columns, sorted
+            by site and time.
+        """
+        if isinstance(sites, str):
+            sites = [sites]
+        if isinstance(satellites, str):
+            satellites = [satellites]
+        start = np.datetime64(start, 's') if start is not None else None
+        end = np.datetime64(end, 's') if end is not None else None
+        wanted = np.unique(np.asarray(sites, dtype=str)) if sites is not None else None
+
+        tables = []
+        for name in sorted(self.index):
+            entry = self.index[name]
+            if start is not None and np.datetime64(entry['last_time'], 's') < start:
+                continue
+            if end is not None and np.datetime64(entry['first_time'], 's') >= end:
+                continue
+            if wanted is not None and (np.searchsorted(wanted, entry['first_site'], side='left') ==
+                                       np.searchsorted(wanted, entry['last_site'], side='right')):
+                continue
+            tables.append(_select(_read_part(os.path.join(self.path, name)), start, end, wanted, satellites))
+        return _sorted(_concatenate(tables, self.window_size))
+
+    def compact(self, names = None):
+        """ Merge parts into one, all of them by default. Returns the number of rows merged. """
+        if names is None:
+            names = list(self.index)
+        names = sorted(names)
+        if len(names) < 2:
+            return sum(self.index[name]['rows'] for name in names)
+        table = _sorted(_concatenate([_read_part(os.path.join(self.path, name)) for name in names], self.window_size))
+        for name in names:
+            del self.index[name]
+        # The index lists the merged parts until they are removed, see __init__
+        part_file = self._write_part(table, names)
+        for name in names:
+            os.remove(os.path.join(self.path, name))
+        del self.index[os.path.basename(part_file)]['merged']
+        self._save_meta()
+        return len(table['time'])
+
+    def __len__(self):
+        return sum(entry['rows'] for entry in self.index.values())
+
+
+def _read_part(part_file):
+    with np.load(part_file) as part:
+        return dict((name, part[name]) for name in COLUMNS)
+
+
+def _part_index(table):
+    """ Index entry of a part sorted by site and time: rows, first and last site and time. """
+    if len(table['time']) == 0:
+        return {'rows': 0, 'first_site': '', 'last_site': '', 'first_time': None, 'last_time': None}
+    return {'rows': len(table['time']),
+            'first_site': str(table['site'][0]), 'last_site': str(table['site'][-1]),
+            'first_time': str(table['time'].min()), 'last_time': str(table['time'].max())}
+
+
+def _select(table, start, end, sites, satellites):
+    """ Rows of a part sorted by site and time: binary searches on the site, then on its times. """
+    if sites is None:
+        sites = np.unique(table['site'])
+    selected = []
+    for site in sites:
+        first = np.searchsorted(table['site'], site, side='left')
+        last = np.searchsorted(table['site'], site, side='right')
+        times = table['time'][first:last]
+        lo = np.searchsorted(times, start, side='left') if start is not None else 0
+        hi = np.searchsorted(times, end, side='left') if end is not None else len(times)
+        selected.append(np.arange(first + lo, first + hi))
+    rows = np.concatenate(selected) if selected else np.empty(0, dtype=int)
+    if satellites is not None:
+        rows = rows[np.isin(table['satellite'][rows], satellites)]
+    return dict((name, table[name][rows]) for name in COLUMNS)
+
+
+def _concatenate(tables, window_size):
+    if not tables:
+        return {'satellite': np.empty(0, dtype='U3'), 'site': np.empty(0, dtype='U{0}'.format(SITE_LENGTH)),
+                'time': np.empty(0, dtype='datetime64[s]'),
+                'window': np.empty((0, window_size, window_size), dtype=np.float32),
+                'mean': np.empty(0, dtype=np.float32), 'centre': np.empty(0, dtype=np.float32)}
+    return dict((name, np.concatenate([table[name] for table in tables])) for name in COLUMNS)
+
+
+def _sorted(table):
+    order = np.lexsort((table['time'], table['site']))
+    return dict((name, np.ascontiguousarray(table[name][order])) for name in COLUMNS)
+
+
+def import_mat(store, mat_file, satellite, site, year, utc_offset = 8):
+    """ Append a hand-assembled CloudMask_<year>_<MOD|MYD>.mat file, whose DATA matrix holds
+        day of year, hour, minute, average and centre values. The times are local, utc_offset
+        hours ahead of UTC (8 for the Singapore files of cloud_mask), and are stored in UTC.
+        The values are cloud fractions of a 3 x 3 window (multiples of 1/9) and 0 or 1, already
+        the unit of the mean and centre columns; they are checked to be in [0, 1]. The window is
+        not in these files and is stored as NaN. Returns the number of rows appended.
+    """
+    import scipy.io as sio
+    data = sio.loadmat(mat_file, squeeze_me=True, struct_as_record=False)['DATA']
+    data = np.atleast_2d(data)
+    values = data[:, 3:5].astype(np.float64)
+    if np.any((values < 0) | (values > 1)):
+        raise ValueError("{0}: the average and centre values are not cloud fractions in [0, 1]".format(mat_file))
+    time = (np.datetime64('{0}-01-01'.format(year), 's')
+            + ((data[:, 0].astype(np.int64) - 1) * 86400 + data[:, 1].astype(np.int64) * 3600
+               + data[:, 2].astype(np.int64) * 60).astype('timedelta64[s]')
+            - np.timedelta64(int(round(utc_offset * 3600)), 's'))
+    window = np.full((len(data), store.window_size, store.window_size), np.nan, dtype=np.float32)
+    return store.append(satellite, site, time, window, values[:, 0], values[:, 1])
@@ -5,35 +5,30 @@ Created on Mon Apr 13 12:14:15 2015
 @author: SHILPA005
 """
 
-# -*- coding: utf-8 -*-
-"""
-Created on Fri Apr 10 17:13:55 2015
-
-@author: SHILPA005
-"""
-
-# -*- coding: utf-8 -*-
-"""
-Created on Tue Mar 31 14:09:31 2015
-
-@author: SHILPA005
-"""
-
 #!/usr/bin/env ipython3
 """
-   Perform an operation on a whole database, crawling through subfolders. This
-   is a skeleton, it does nothing.
+   Extract the cloud mask around the sites of a catalogue (see sites.py) from every granule of
+   the database, crawling through the day subfolders. Each granule is opened and decoded once
+   for all its sites. The granules are spread over a pool of processes. The
+   extracted values are streamed, in blocks, to one CloudMaskStore (see cloudMaskStore.py),
+   and the granules that could not be processed are recorded, with the reason, in a CSV file.
+   Optionally, the cloud fraction and the counts of each quality flag class are computed for
+   several window sizes at once (see neighbourhood.py) and written to another CSV file.
+   The stage timers and counters of every granule (GDAL open, SDS read, QA decode...) and of the
+   whole run are written as JSON lines to metrics_file, see instrumentation.py.
 """
 
-"""
-+   Perform an operation on a whole database, crawling through subfolders. This
-+   is a skeleton, it does nothing.
-+"""
-
+import csv
+import datetime
 import glob
-from utility import *
-from PrecipitableWaterProduct import PrecipitableWaterProduct
+import multiprocessing
+import os
+import time
 import numpy as np
+import instrumentation
+from PrecipitableWaterProduct import PrecipitableWaterProduct
+from cloudMaskStore import CloudMaskStore, cloud_fraction
+from sites import read_sites
 
 products = ['05']
 satellites = ['MOD']
@@ -42,48 +37,194 @@ extension = '.hdf'
 
 roi_size = 50
 
-location = [1.342541, 103.681085] ## Singapore
-#location = [50.3641667, 30.4966667] ### Ukraine
-#location = [13.7358333, 100.5338889]  ## for Thailand
-#location = [30.5313889,114.3572222]  ## for Wuhaan
-#location = [31.8238889,130.5994444] # for Japan
-#location = [40.2452778,116.2238889] # for Beijing
-sel = 3# Save a 3-by-3 box around the selected point
+# Sites of sites.csv to extract, with the size of the box saved around each of them.
+# Use read_sites() for all of them.
+sites = read_sites(names=['Singapore'])
+#sites = read_sites(names=['Singapore', 'Ukraine', 'Thailand', 'Wuhan', 'Japan', 'Beijing'])
 
 #mask_path = 'data/data-*' 
 mask_path = 'data/data-2015-*-*' 
-days = []
-one_month = []
-for day in glob.glob(mask_path):
-    for satellite in satellites:
-        s1 = day + '/' + satellite
-        for product in products:
-            s2 = s1 + product + '*' + extension
-            for files in glob.glob(s2):
-                try:
-                    print('Processing File: ', files)
-                    seed = '-'.join(files.split('.')[1:3])
-                    
-                    precipitableWaterProduct = PrecipitableWaterProduct(files, location[0], location[1], roi_size)
-                    georef = precipitableWaterProduct.georef_grid1k
-                    data = precipitableWaterProduct.extractCloudMaskQA_QualityFlag()
-                
-                    grid_location = closest_point(georef, location)
-                    # Subsample data
-                    data = data[grid_location[0]-sel//2 : grid_location[0]+sel//2+1 ,
-                                grid_location[1]-sel//2 : grid_location[1]+sel//2+1 ]
-                    #georef = georef[grid_location[0]-sel//2 : grid_location[0]+sel//2+1 
-                                    #grid_location[1]-sel//2 : grid_location[1]+sel//2+1, : ]
-                    #data = np.reshape(data,(5,5))
-                    print(data)
-                except:
-                    print('ERROR:', files)
+
+# Window sizes (1k pixels) of the cloud fraction statistics, None for the whole roi. [] to skip them
+scales = [3, 5, 11, None]
+
+store_path = 'cloudmask_store'
+statistics_file = 'cloudmask_scales.csv'
+failures_file = 'cloudmask_failures.csv'
+processes = None    # Number of worker processes, None for one per core
+metrics_file = 'cloudmask_metrics.jsonl'
+profile_dir = None  # Folder of the cProfile statistics of each granule (<granule>.prof), None to skip
+
+
+def find_granules(mask_path, satellites, products, extension):
+    """ Files of the products, for the satellites, in the day folders matching mask_path. """
+    files = []
+    for day in glob.glob(mask_path):
+        for satellite in satellites:
+            for product in products:
+                files.extend(glob.glob(day + '/' + satellite + product + '*' + extension))
+    return sorted(files)
+
+
+def granule_datetime(path):
+    """ Acquisition time of a granule, from the A<YYYYDDD>.<HHMM> part of its name. """
+    name = os.path.basename(path).split('.')
+    day = datetime.datetime.strptime(name[1][1:], '%Y%j')
+    return day + datetime.timedelta(hours=int(name[2][:2]), minutes=int(name[2][2:]))
+
+
+def extract_granule(path, sites, roi_size, scales = ()):
+    """ Boxes of the cloud mask quality flag around the sites of the granule, {name: box}, the
+        statistics at the given scales, {name: {size: statistics}}, and the sites left out, with the
+        reason, {name: reason}. The sites are located once and the flag is read and decoded once
+        for both, see extractSitesWithStatistics.
+    """
+    precipitableWaterProduct = PrecipitableWaterProduct(path, None, None, roi_size)
+    boxes, statistics = precipitableWaterProduct.extractSitesWithStatistics(sites, scales)
+    return boxes, statistics, precipitableWaterProduct.skipped_sites
+
+
+def store_window(sites):
+    """ Window size of the store: the largest box of the sites. """
+    if len(sites) == 0:
+        raise ValueError("No sites to extract, see sites.csv and read_sites(names=...)")
+    return max(site[3] for site in sites)
+
+
+def open_store(store_path, sites):
+    """ The CloudMaskStore at store_path, created with the window of the sites if new. An existing
+        store keeps its window size: it must hold the largest box of the sites, the smaller boxes
+        being padded, otherwise ValueError is raised before anything is extracted.
+    """
+    window = store_window(sites)
+    store = CloudMaskStore(store_path, window)
+    if store.window_size < window:
+        raise ValueError("The store {0} holds {1}x{1} windows, too small for the {2}x{2} boxes of the sites: "
+                         "use another store_path, or smaller boxes".format(store_path, store.window_size, window))
+    return store
+
+
+def extract_task(task):
+    """ Run by the workers: never raises, failures are returned with their reason. The task is
+        (path, sites, roi_size, scales, profile_dir); returns (path, result, reason, metrics),
+        metrics being the snapshot of the stage timers and counters of the granule.
+    """
+    path, sites, roi_size, scales, profile_dir = task
+    profile_file = os.path.join(profile_dir, os.path.basename(path) + '.prof') if profile_dir else None
+    with instrumentation.recording() as metrics, instrumentation.profiled(profile_file):
+        try:
+            with metrics.timer('extract'):
+                result = extract_granule(path, sites, roi_size, scales)
+            return (path, result, None, metrics.snapshot())
+        except Exception as e:
+            return (path, None, '{0}: {1}'.format(type(e).__name__, e), metrics.snapshot())
+
+
+def granule_record(path, result, reason, metrics):
+    """ JSON record of an extracted granule, from the result of extract_task. """
+    record = dict(metrics, type='granule', granule=os.path.basename(path), status='failed' if reason else 'ok')
+    if reason:
+        record['reason'] = reason
+    else:
+        record['sites'] = len(result[0])
+        if result[2]:
+            record['skipped_sites'] = result[2]
+    return record
+
+
+STATISTICS_HEADER = ['satellite', 'site', 'time', 'window', 'n_pixels', 'complete',
+                     'cloud', 'clear_66', 'clear_95', 'clear_99', 'cloud_fraction', 'mean']
+
+
+def statistics_rows(path, statistics):
+    satellite, time = os.path.basename(path)[:3], granule_datetime(path)
+    for name, scales in statistics.items():
+        for size, values in scales.items():
+            yield ([satellite, name, time.isoformat(), 'roi' if size is None else size,
+                    int(values['n_pixels']), int(values['complete'])] + [int(n) for n in values['counts']] +
+                   ['{0:.6f}'.format(values['cloud_fraction']), '{0:.6f}'.format(values['mean'])])
+
+
+def run_batch(files, sites, roi_size = 50, processes = None, store_path = 'cloudmask_store',
+              failures_file = 'cloudmask_failures.csv', block_size = 256, scales = (),
+              statistics_file = 'cloudmask_scales.csv', metrics_file = None, profile_dir = None):
+    """ Extract all the files with a pool of processes. The boxes are appended to the store at
+        store_path as they arrive, block_size boxes at a time, with their satellite, site and time.
+        The store window is the largest box, smaller boxes are centred in it and padded with NaN; an
+        existing store with smaller windows is refused, see open_store.
+        If scales are given, the statistics at these window sizes go to statistics_file.
+        If metrics_file is given, one JSON record per granule and one for the run are appended to it.
+        If profile_dir is given, each granule is profiled with cProfile to <profile_dir>/<granule>.prof.
+        Returns the number of extracted boxes and of failed granules.
+    """
+    if profile_dir and not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    tasks = [(path, sites, roi_size, list(scales), profile_dir) for path in files]
+    store = open_store(store_path, sites)
+    block = []
+    n_done, n_failed = 0, 0
+    start = time.time()
+    instrumentation.open_records(metrics_file)
+    pool = multiprocessing.Pool(processes)
+    try:
+        with open(failures_file, 'w', newline='') as failures, \
+             open(statistics_file if scales else os.devnull, 'w', newline='') as statistics_out:
+            failures_writer = csv.writer(failures)
+            failures_writer.writerow(['granule', 'reason'])
+            statistics_writer = csv.writer(statistics_out)
+            statistics_writer.writerow(STATISTICS_HEADER)
+
+            for path, result, reason, metrics in pool.imap_unordered(extract_task, tasks):
+                instrumentation.RUN.merge(metrics)
+                instrumentation.emit(granule_record(path, result, reason, metrics))
+                if reason is None:
+                    boxes, statistics, _ = result
+                    with instrumentation.timer('output_write'):
+                        statistics_writer.writerows(statistics_rows(path, statistics))
+                    for name, box in boxes.items():
+                        block.append((os.path.basename(path)[:3], name, granule_datetime(path), box))
+                    n_done += len(boxes)
                 else:
-                    one_month.append(data)
-                    #print(data)
-#                    save_as_mat('georef-' + seed, georef)
-                    #save_as_mat('MOD' + seed, data)
-                    
-                    #save_as_mat('Feb_2013', one_month)                    
-                    save_as_mat('MOD_CloudMask-' + seed,data)
-#save_as_mat('mask',one_month)
+                    failures_writer.writerow([path, reason])
+                    failures.flush()
+                    n_failed += 1
+                if len(block) >= block_size:
+                    append_block(store, block)
+                    block = []
+            append_block(store, block)
+    finally:
+        pool.close()
+        pool.join()
+        instrumentation.emit(dict(instrumentation.RUN.snapshot(), type='run', script='cloudmask', granules=len(files),
+                                  boxes=n_done, failed=n_failed, seconds=round(time.time() - start, 3)))
+        instrumentation.close_records()
+    return n_done, n_failed
+
+
+def append_block(store, block):
+    if not block:
+        return
+    with instrumentation.timer('output_write'):
+        _append_block(store, block)
+
+
+def _append_block(store, block):
+    size = store.window_size
+    windows = np.full((len(block), size, size), np.nan, dtype=np.float32)
+    for k, (_, _, _, box) in enumerate(block):
+        offset = (size - box.shape[0]) // 2
+        windows[k, offset:offset + box.shape[0], offset:offset + box.shape[1]] = box
+    satellite, site, time, boxes = zip(*block)
+    # Quality flag boxes, mean and centre as cloud fractions (the unit of the store)
+    store.append(satellite, site, np.array(time, dtype='datetime64[s]'), windows,
+                 [cloud_fraction(box) for box in boxes],
+                 [cloud_fraction(box[box.shape[0] // 2, box.shape[1] // 2]) for box in boxes])
+
+
+if __name__ == '__main__':
+    files = find_granules(mask_path, satellites, products, extension)
+    print('Processing {0} files'.format(len(files)))
+    n_done, n_failed = run_batch(files, sites, roi_size, processes, store_path, failures_file,
+                                 scales=scales, statistics_file=statistics_file, metrics_file=metrics_file,
+                                 profile_dir=profile_dir)
+    print('Done: {0} boxes extracted, {1} granules failed (see {2})'.format(n_done, n_failed, failures_file))
@@ -0,0 +1,109 @@
+"""
+   Nearest pixel search on swath geolocation grids. The (lat, lon) grid is
+   indexed once with a KD-tree on 3-D unit-sphere coordinates, so that many
+   locations are looked up in one call, without the distortion of a plain
+   lat/lon distance near the poles or across the date line.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+from cache import LRUCache
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def latlon_to_xyz(lat, lon):
+    """ Convert latitudes and longitudes in degrees to points on the unit sphere. """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    return np.stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)), axis=-1)
+
+
+class GeoIndex:
+    def __init__(self, georef_grid):
+        """ georef_grid: array of shape (rows, cols, 2) holding latitude and longitude, as
+            PrecipitableWaterProduct.georef_grid. Pixels with fill values are not indexed.
+        """
+        georef_grid = np.asarray(georef_grid, dtype=np.float64)
+        self.shape = georef_grid.shape[:2]
+        latitude = georef_grid[:, :, 0].ravel()
+        longitude = georef_grid[:, :, 1].ravel()
+        valid = (np.abs(latitude) <= 90) & (np.abs(longitude) <= 180)
+        self.pixels = np.flatnonzero(valid)
+        self.tree = cKDTree(latlon_to_xyz(latitude[valid], longitude[valid]))
+
+    def query(self, points):
+        """ Closest pixel for each (lat, lon) of points. Returns the row and column indices
+            and the great circle distance to the pixel centre in km.
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        chord, k = self.tree.query(latlon_to_xyz(points[:, 0], points[:, 1]))
+        rows, cols = np.unravel_index(self.pixels[k], self.shape)
+        return rows, cols, _chord_km(chord)
+
+    def half_diagonal(self, rows, cols):
+        """ Half the diagonal of the pixels (rows, cols) in km: the farthest a location covered by a
+            pixel can be from its centre. The pixel size along each axis is the distance to the
+            previous or the next pixel, the larger of the two, as the pixels grow to twice their size
+            at nadir or more towards the swath edge. NaN for a pixel without valid neighbours.
+        """
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        centre = self._pixel_xyz(rows, cols)
+        sizes = [np.fmax(_chord_km(np.linalg.norm(centre - self._pixel_xyz(rows - d_row, cols - d_col), axis=-1)),
+                         _chord_km(np.linalg.norm(centre - self._pixel_xyz(rows + d_row, cols + d_col), axis=-1)))
+                 for d_row, d_col in ((1, 0), (0, 1))]
+        return np.hypot(*sizes) / 2
+
+    def _pixel_xyz(self, rows, cols):
+        """ Unit sphere coordinates of the pixels, NaN outside of the grid and for fill values. """
+        on_grid = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        flat = np.ravel_multi_index((rows, cols), self.shape, mode='clip')
+        k = np.minimum(np.searchsorted(self.pixels, flat), len(self.pixels) - 1)
+        valid = on_grid & (self.pixels[k] == flat)
+        return np.where(valid[..., None], self.tree.data[k], np.nan)
+
+    def closest_point(self, point):
+        """ Row and column of the closest pixel of a single [lat, lon], as an array. """
+        rows, cols, _ = self.query([point])
+        return np.array([rows[0], cols[0]])
+
+
+def _chord_km(chord):
+    """ Great circle distance in km of a chord of the unit sphere. """
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / 2, 1.0))
+
+
+def refine_closest_point(read_window, shape, point, guess, radius):
+    """ Closest pixel of the [lat, lon] point on a grid of the given shape, of which only windows
+        are read: read_window((first row, last row + 1, first column, last column + 1)) returns the
+        (rows, cols, 2) grid of a window within shape. The search starts radius pixels around the
+        guess (row, column), e.g. found on a decimated grid, and the window is doubled as long as
+        the closest pixel lies on its border, other than the edge of the grid: near the swath edge
+        the pixels are much larger and the guess can be off by more than radius. Returns the row,
+        column and distance in km.
+    """
+    while True:
+        window = (max(guess[0] - radius, 0), min(guess[0] + radius + 1, shape[0]),
+                  max(guess[1] - radius, 0), min(guess[1] + radius + 1, shape[1]))
+        rows, cols, distance = GeoIndex(read_window(window)).query([point])
+        row, col = rows[0] + window[0], cols[0] + window[2]
+        on_border = ((row == window[0] > 0) or (row == window[1] - 1 and window[1] < shape[0]) or
+                     (col == window[2] > 0) or (col == window[3] - 1 and window[3] < shape[1]))
+        if not on_border:
+            return row, col, distance[0]
+        radius *= 2
+
+
+# Indices of the granules processed recently, keyed by the caller (filename, grid, ...)
+_geo_indices = LRUCache(maxsize=32)
+
+
+def geo_index(key, georef_grid):
+    """ Return the GeoIndex cached under key, building it from georef_grid if needed. georef_grid
+        may be a function returning the grid, so that it is only read when the index is built.
+    """
+    index = _geo_indices.get(key)
+    if index is None:
+        if callable(georef_grid):
+            georef_grid = georef_grid()
+        index = _geo_indices.put(key, GeoIndex(georef_grid))
+    return index
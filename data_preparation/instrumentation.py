@@ -0,0 +1,152 @@
+"""
+   Lightweight instrumentation of the grabber and of the extraction: stage timers, counters,
+   JSON records and an optional cProfile hook.
+
+        with timer('sds_read'):            time a stage, added to the current metrics
+        count('download_bytes', n)         add to a counter
+        emit({'type': 'granule', ...})     write one JSON line to the records file, if opened
+
+   The current metrics are those of the thread's recording() block, e.g. one granule in an
+   extraction worker, or else the process wide RUN metrics. A timer or counter that is not
+   recorded costs a perf_counter call and a dictionary update, so it is always on.
+"""
+import cProfile
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}        # stage: [calls, seconds]
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds, calls = 1):
+        with self.lock:
+            entry = self.timers.setdefault(stage, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, snapshot):
+        """ Add the timers and counters of a snapshot, e.g. of a granule extracted in a worker. """
+        for stage, entry in snapshot['timers'].items():
+            self.add_time(stage, entry['seconds'], entry['calls'])
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+
+    def snapshot(self):
+        """ {'timers': {stage: {'calls': n, 'seconds': s}}, 'counters': {name: value}}, JSON serialisable. """
+        with self.lock:
+            return {'timers': dict((stage, {'calls': calls, 'seconds': round(seconds, 6)})
+                                   for stage, (calls, seconds) in self.timers.items()),
+                    'counters': dict(self.counters)}
+
+    def reset(self):
+        with self.lock:
+            self.timers.clear()
+            self.counters.clear()
+
+
+# Metrics of the whole run, in this process
+RUN = Metrics()
+_local = threading.local()
+
+
+def current():
+    return getattr(_local, 'metrics', None) or RUN
+
+
+@contextlib.contextmanager
+def recording(metrics = None):
+    """ Record the timers and counters of this thread in metrics (a new Metrics by default),
+        instead of RUN, within the block.
+    """
+    metrics = metrics or Metrics()
+    previous = getattr(_local, 'metrics', None)
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+
+
+def timer(stage):
+    return current().timer(stage)
+
+
+def count(name, value = 1):
+    current().count(name, value)
+
+
+class JsonRecords:
+    """ Append-only file of JSON records, one per line, each stamped with its UTC time. """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.file = open(path, 'a')
+
+    def write(self, record):
+        line = json.dumps(dict(record, time=datetime.datetime.utcnow().isoformat()), sort_keys=True)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+_records = None
+
+
+def open_records(path):
+    """ Send the records emitted from now on to path (None to discard them). The RUN metrics are reset. """
+    global _records
+    close_records()
+    RUN.reset()
+    _records = JsonRecords(path) if path else None
+    return _records
+
+
+def close_records():
+    global _records
+    if _records is not None:
+        _records.close()
+    _records = None
+
+
+def emit(record):
+    if _records is not None:
+        _records.write(record)
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """ Run the block under cProfile and dump the statistics to path, see pstats. No-op if path is None. """
+    if path is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
@@ -1,4 +1,4 @@
-#!/usr/bin/env ipython2
+#!/usr/bin/env ipython3
 """ File: modisGrabber.py. 
     Author: Joseph Lemaitre <joseph.lemaitre@epfl.ch>
     Compagny: Illinois@Singapore Pte. Ldt
@@ -21,28 +21,35 @@
        wish.
        3. Run the script. What it does,
             For each date**:
-                 * Create a directory: _data/data-{DATE}/. If the directory exist, it *wipes* it !!!!!
+                 * Create a directory: _data/data-{DATE}/, or re-use it if it exists.
                  * Download geolocalisation dataset. Parse the file to find when AQUA and/or TERRA was above the bounding box.
                  * Then select the right products, download them.
-                 * Once the download of all the product is done, it put a flag. A flag is a file into the directory 
-                     _data/data-{DATE}/. 
-                        If this file name is FAILURE, do not use what was downloaded and re-launch the grabber
-                            for this day.
-                        If this file name is SUCCESS, you can move the folder (i.e day) to data/, and use the products
-                        If there is no file, then probably the download isn't finished yet.
-                   The file contains a timestamp, along the reason of the failure if it didn't work, along with the name
-                   of the products concerned.
+                 * The state of the download is kept in the manifest _data/data-{DATE}/manifest.json: the expected
+                   granules, with their size and status (pending, complete or failed, with the reason).
+                        If its state is "complete", you can move the folder (i.e day) to data/, and use the products
+                        Otherwise, re-launch the grabber for this day: the complete files are kept, the partial
+                            ones (.part) are resumed where they stopped, and only the missing ones are downloaded.
+            Several days are processed at the same time (max_days), and the granules are downloaded concurrently
+            over a pool of at most max_connections FTP connections, re-used between transfers. A transfer that
+            fails is retried on another connection, after a growing delay (retries, backoff).
+       4. The time spent in each stage (geoMeta fetch, listing, download) and the bytes downloaded are written
+          to metrics_file, as JSON lines: one record per downloaded file, with its throughput, and one for the run.
+       5. grab() can also be imported and pointed to another server (address, port), e.g. a local pyftpdlib
+          server serving the same directory layout, for testing.
 """
     
 from __future__ import print_function # We need the print function and not the print statement
 from ftplib import FTP
-import datetime, csv, re, os, shutil, sys, ftplib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import datetime, csv, json, os, sys, ftplib, threading, time
+import numpy as np
+import instrumentation
 
 # -------------------------------------------------------------------------------------------
 # *********************************   PARAMETERS  *******************************************
 # -------------------------------------------------------------------------------------------
 
-# Dates to download. This is either a command line argument, or a string.
+# Dates to download. This is either a command line argument, or the string below.
 # Format: 
 #       * One number D : a number of day before today's date. Example: "7" -> 7 days ago
 #       * A date YYYY-MM-DD: download this date only. Example: "2015-2-3" -> the 3rd february 2015
@@ -50,17 +57,22 @@ import datetime, csv, re, os, shutil, sys, ftplib
 #           separated by the double-dash "--". Example: 2015-2-3--2015-2-6 -> 2015-2-3, 2015-2-4, 2015-2-5, 2015-2-6
 #       * A date range and an increment YYYY-MM-DD--YYYY-MM-DD:I : Download every I day between the two dates. Increment
 #           is separated by a dash. Example: 2015-2-3--2015-3-1:7 -> 2015-2-3, 2015-2-10, 2015-2-17, 2015-2-24 (i.e every Thursday)
-if (len(sys.argv) > 1):
-    input_date = sys.argv[1]
-else:
-    #input_date = "2015-2-3--2015-3-17"         # <--- Specify the date here.
-    input_date = "2015-01-02" 
+#input_date = "2015-2-3--2015-3-17"         # <--- Specify the date here.
+input_date = "2015-01-02" 
 # FTP Server to get the data from.
 ftp_address = 'ladsweb.nascom.nasa.gov'
 # Prefix to the directory where the products are stored, we download from the latest collection: 6.
 ftp_prefix = '/allData/6/'
 
 
+# Sites of sites.csv to download: the granules over a box of +/- site_margin degrees around any of them
+# are selected. Leave empty to use bounding_box instead.
+sites = []
+#from sites import read_sites; sites = read_sites(names=['Singapore', 'Ukraine', 'Thailand', 'Wuhan', 'Japan', 'Beijing'])
+site_margin = 0.2
+# Test the sites against the GRing polygon of the granules rather than their bounding box
+use_gring = False
+
 # Bounding box for our area of interest, see the bounding box directory for more information.
 bounding_box = {'north_lat' : 1.546439,
                 'south_lat' : 1.132124,
@@ -117,147 +129,581 @@ product_list = [
 # False: Then we download only the products above singapore between 10 and 18 SGT (i.e 0200 and 1000 UTC), when the WSI is up.       [Default]
 # True : All products in the bounding box, regardless of time. Warning : may download lots of data, where Singapore is on the border of the event. !
 download_all_hours = False
+# UTC hours (first, last) of the granules start time, when download_all_hours is False
+time_window = (2, 10)
+
+# Concurrency. Every FTP command goes through a pool of at most max_connections logged-in
+# connections, shared by all the days; up to max_days days are prepared (geolocation, listings)
+# at the same time, and their granules are downloaded by max_connections threads.
+max_connections = 4
+max_days = 2
+# A failed transfer is retried on a fresh connection, after backoff, 2 * backoff, 4 * backoff... seconds
+retries = 3
+backoff = 2.0
+
+# Where the days are downloaded
+data_root = "../_data/"
+# Listings of the product directories are cached there, and re-used for listing_ttl seconds. 0 to always list.
+listing_cache_dir = "../_data/.listings/"
+listing_ttl = 24 * 3600
+# The geoMeta files are kept there, with their parsed arrays. Those of the last days are fetched again after listing_ttl.
+geometa_cache_dir = "../_data/.geoMeta/"
+# Stage timers, counters and per-file throughput (JSON lines), None to skip them
+metrics_file = "../_data/grabber_metrics.jsonl"
 
 # -------------------------------------------------------------------------------------------
 # ***************************************  CODE  *********************************************
 # -------------------------------------------------------------------------------------------
 
-if ('-' in input_date):         # User input a date or a date range
-    data_time = datetime.date(int(input_date.split('-')[0]), int(input_date.split('-')[1]), int(input_date.split('-')[2]))
-else:                           # User input a number of day from today
-    data_time = datetime.datetime.utcnow() + datetime.timedelta(-int(input_date))
-
-final_date = data_time
-date_increment = 1
-if ('--' in input_date):       # User specify a date range
-    final_date = input_date.split('--')[1].split(':')[0]
-    final_date = datetime.date(int(final_date.split('-')[0]), int(final_date.split('-')[1]), int(final_date.split('-')[2]))
-if(':' in input_date):
-    date_increment = int(input_date.split(':')[-1])
-date_increment = datetime.timedelta(days=date_increment)
-
-while (data_time <= final_date):
-    try:
-        current_date = data_time.timetuple()
-        print("MG: ========================================================================================")
-        print("MG: Downloading products {0}, at date {1}-{2}-{3} [{4} th day of the year]".format(product_list, current_date.tm_year,
-                                                                                                  current_date.tm_mon, current_date.tm_mday, current_date.tm_yday))
-        # Prepare the downloading directory TODO: Long if several products
-        dir_name = "../_data/data-{0}-{1}-{2}/".format(current_date.tm_year,current_date.tm_mon, current_date.tm_mday)
-        
-        print (dir_name)
-        
-        print("MG: Wiping Directory {0}".format(dir_name))
-        if os.path.exists(dir_name):
-            shutil.rmtree(dir_name)
-        os.makedirs(dir_name)
-        
-        print("MG: Initializing connection")
-        # Start a connection to the ftp
-        ftp_server = FTP(ftp_address)
-        ftp_server.login()
-
-        # We need the MOD03, the Geolocalisation Data Set, to know which frame to download. We could also download them all
-        # but our connection is slow. We uses the server .txt files.
-        print("MG: Downloading Geolocalisation Data Set")
-
-        ftp_server.cwd('/geoMeta/6/AQUA/' + str(current_date.tm_year))
-        geo_filename = 'MYD03_' + str(current_date.tm_year) + '-' + str(current_date.tm_mon).zfill(2) \
-                    + '-' + str(current_date.tm_mday).zfill(2) + '.txt'
-        ftp_server.retrbinary('RETR ' + geo_filename , open(dir_name + geo_filename, 'wb').write)
-
-        # Parse Geolocalisation Data Set to obtains the frame that consitute our bounding box
-        good_frame_aqua = []
-        
-        print (dir_name + geo_filename)
-        f = open(dir_name + geo_filename, 'r')
-        #for line in f[1:]:
-        #    print (line)
-        
-        #with open(dir_name + geo_filename) as csvfile:
-
-        #    read_data = csvfile.read()
-        #    print (type(read_data))
-        #    print (read_data)
-                            
-                            
-        with open(dir_name + geo_filename) as csvfile:
-
-            csvfile.readline()       # Delete the fist two lines so the dictionary contains the right values.
-            #csvfile.readline()
-            reader = csv.DictReader(csvfile, fieldnames = ["GranuleID","StartDateTime","ArchiveSet","OrbitNumber","DayNightFlag","EastBoundingCoord","NorthBoundingCoord","SouthBoundingCoord","WestBoundingCoord","GRingLongitude1","GRingLongitude2","GRingLongitude3","GRingLongitude4","GRingLatitude1","GRingLatitude2","GRingLatitude3","GRingLatitude4"])
-            
-            #for row in reader:
-            #    print (row)
-            for row in reader:
-
-                if (float(row['SouthBoundingCoord']) <= bounding_box['north_lat'] and
-                    float(row['NorthBoundingCoord']) >= bounding_box['south_lat'] and
-                    float(row['WestBoundingCoord']) <= bounding_box['east_long'] and
-                    float(row['EastBoundingCoord']) >= bounding_box['west_long']):
-                    print ('printing bounding box')
-                    print (float(row['SouthBoundingCoord']) , bounding_box['north_lat'])                   
-                    if (2 <= int(row['StartDateTime'][-5:-3]) <= 10):
-                            good_frame_aqua.append(row['GranuleID'])
-
-        ftp_server.cwd('/geoMeta/6/TERRA/' + str(current_date.tm_year))
-        geo_filename = 'MOD03_' + str(current_date.tm_year) + '-' + str(current_date.tm_mon).zfill(2) \
-                    + '-' + str(current_date.tm_mday).zfill(2) + '.txt'
-        ftp_server.retrbinary('RETR ' + geo_filename , open(dir_name + geo_filename, 'wb').write)
-
-        good_frame_terra = []
-        with open(dir_name + geo_filename) as csvfile:
-            #csvfile.next()          # Delete the fist two lines so the dictionary contains the right values.
-            csvfile.readline()
-            reader = csv.DictReader(csvfile, fieldnames = ["GranuleID","StartDateTime","ArchiveSet","OrbitNumber","DayNightFlag","EastBoundingCoord","NorthBoundingCoord","SouthBoundingCoord","WestBoundingCoord","GRingLongitude1","GRingLongitude2","GRingLongitude3","GRingLongitude4","GRingLatitude1","GRingLatitude2","GRingLatitude3","GRingLatitude4"])
-            for row in reader:
-                if (float(row['SouthBoundingCoord']) <= bounding_box['north_lat'] and
-                    float(row['NorthBoundingCoord']) >= bounding_box['south_lat'] and
-                    float(row['WestBoundingCoord']) <= bounding_box['east_long'] and
-                    float(row['EastBoundingCoord']) >= bounding_box['west_long']):
-                    if (download_all_hours or 2 <= int(row['StartDateTime'][-5:-3]) <= 10):
-                        good_frame_terra.append(row['GranuleID'])
-
-        # Strip to optain the re-usable form of the name. We remove 
-        # Name format spec : http://modis-atmos.gsfc.nasa.gov/products_filename.html
-        good_frame_aqua = ['.'.join(x.rsplit('.')[1:4]) for x in good_frame_aqua]
-        good_frame_terra = ['.'.join(x.rsplit('.')[1:4]) for x in good_frame_terra]
-        
-        print (good_frame_aqua)
-        print (good_frame_terra)
-        
-        print("MG: Will download frames:\n    TERRA : {0}\n    AQUA : {1}".format(good_frame_terra, good_frame_aqua))
-
-        # Extraction of the products
-        for product in product_list:
-            # We use zfill for zero-padding
-            data_path = ftp_prefix + product + "/" + str(current_date.tm_year) + "/" + str(current_date.tm_yday).zfill(3)
-            ftp_server.cwd(data_path)
-            if (product.find('MYD') >= 0):
-                good_frame = good_frame_aqua
+MANIFEST_FILE = 'manifest.json'
+
+GEOMETA_FIELDS = ["GranuleID","StartDateTime","ArchiveSet","OrbitNumber","DayNightFlag","EastBoundingCoord","NorthBoundingCoord","SouthBoundingCoord","WestBoundingCoord","GRingLongitude1","GRingLongitude2","GRingLongitude3","GRingLongitude4","GRingLatitude1","GRingLatitude2","GRingLatitude3","GRingLatitude4"]
+
+
+def parse_dates(input_date):
+    """ Dates described by input_date, see the PARAMETERS section for the format. """
+    if ('-' in input_date):         # User input a date or a date range
+        data_time = datetime.date(int(input_date.split('-')[0]), int(input_date.split('-')[1]), int(input_date.split('-')[2]))
+    else:                           # User input a number of day from today
+        data_time = (datetime.datetime.utcnow() + datetime.timedelta(-int(input_date))).date()
+
+    final_date = data_time
+    date_increment = 1
+    if ('--' in input_date):       # User specify a date range
+        final_date = input_date.split('--')[1].split(':')[0]
+        final_date = datetime.date(int(final_date.split('-')[0]), int(final_date.split('-')[1]), int(final_date.split('-')[2]))
+    if(':' in input_date):
+        date_increment = int(input_date.split(':')[-1])
+    date_increment = datetime.timedelta(days=date_increment)
+
+    dates = []
+    while (data_time <= final_date):
+        dates.append(data_time)
+        data_time = data_time + date_increment
+    return dates
+
+
+class LocalFileError(Exception):
+    """ Failure of a local file operation during a transfer (disk full, no permission on the
+        .part file...). Unlike the ftplib errors, an OSError too, it is not retried.
+    """
+
+
+class FTPPool:
+    """ Bounded pool of reusable FTP connections. At most size connections are open at the same
+        time; a thread asking for one while they are all in use waits for one to be released.
+        Connections are opened lazily and kept logged in between transfers.
+    """
+    def __init__(self, address, size = 4, port = 21, user = '', passwd = '', timeout = 60):
+        self.address = address
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        try:
+            ftp_server = FTP(timeout=self.timeout)
+            ftp_server.connect(self.address, self.port)
+            ftp_server.login(self.user, self.passwd)
+            return ftp_server
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, ftp_server, broken = False):
+        """ Give a connection back. A broken connection is closed instead of being reused. """
+        if broken:
+            try:
+                ftp_server.close()
+            except Exception:
+                pass
+        else:
+            with self.lock:
+                self.idle.append(ftp_server)
+        self.slots.release()
+
+    def run(self, action, retries = 3, backoff = 2.0):
+        """ Call action(ftp_server) with a connection of the pool. On a transient error the action is
+            retried after an exponential backoff; the connection is dropped unless the server just
+            answered with a 4xx reply. Permanent (5xx) errors are not retried, nor other errors such
+            as LocalFileError, after which the connection is dropped.
+        """
+        for attempt in range(retries + 1):
+            ftp_server = None
+            try:
+                ftp_server = self.acquire()
+                result = action(ftp_server)
+            except ftplib.all_errors as e:
+                if ftp_server is not None:
+                    self.release(ftp_server, broken=not isinstance(e, (ftplib.error_temp, ftplib.error_perm)))
+                if attempt == retries or isinstance(e, ftplib.error_perm):
+                    raise
+                print("MG: (WW) FTP error: {0}, retrying in {1} s".format(e, backoff * 2 ** attempt))
+                time.sleep(backoff * 2 ** attempt)
+            except Exception:
+                if ftp_server is not None:
+                    self.release(ftp_server, broken=True)
+                raise
             else:
-                good_frame = good_frame_terra
-            for frame in good_frame:
-                regex = "{0}.{1}.*.hdf".format(product,frame)
-                print("MG: Downloading: product: " + product + ", frame: " + frame)
-                for filename in ftp_server.nlst():
-                    if(re.search(regex, filename)):
-                        with open(dir_name + filename, "wb") as file:
-                            ftp_server.retrbinary('RETR %s' % filename, file.write)
-                            
-    except ftplib.all_errors as e:
-        print("MG: (EE) FTP Connection error: {0}\n MG: Download Aborded, Sorry :/".format(e))
-        # Create a file to indicate error
-        file = open(dir_name + "FAILURE", 'a')
-        file.write("TIMESTAMP: {0} UTC\n".format(datetime.datetime.utcnow()))
-        file.write("PRODUCTS: {0}\n".format(product_list))
-        file.write("MODIS GRABBER EXCEPTION: {0}\n".format(e))
-        file.close()
+                self.release(ftp_server)
+                return result
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for ftp_server in idle:
+            try:
+                ftp_server.quit()
+            except ftplib.all_errors:
+                ftp_server.close()
+
+
+def download_file(pool, remote_path, local_path, size = None, retries = 3, backoff = 2.0):
+    """ Download remote_path to local_path with a connection of the pool. The file is written to
+        local_path + '.part' and renamed once complete. An existing .part file, left by an earlier
+        attempt or run, is resumed from its end with a REST offset. size, when known, is checked.
+        The failures of the .part file raise LocalFileError at once, they are not retried.
+    """
+    part = local_path + '.part'
+    # Over all the attempts: bytes and time of the transfers, without waiting for a connection
+    transfer = {'bytes': 0, 'seconds': 0.0, 'resumed_from': None}
+
+    def local(operation, *args):
+        try:
+            return operation(*args)
+        except OSError as e:
+            raise LocalFileError('{0}: {1}'.format(part, e))
+
+    def retrieve(ftp_server):
+        offset = local(os.path.getsize, part) if os.path.exists(part) else 0
+        if size is not None and offset > size:
+            offset = 0
+        if transfer['resumed_from'] is None:
+            transfer['resumed_from'] = offset
+        if size is None or offset < size:
+            start = time.time()
+            try:
+                f = local(open, part, 'ab' if offset else 'wb')
+                try:
+                    def write(block):
+                        local(f.write, block)
+                        transfer['bytes'] += len(block)
+                    ftp_server.retrbinary('RETR ' + remote_path, write, rest=offset or None)
+                finally:
+                    local(f.close)
+            except ftplib.error_perm:
+                if not offset:
+                    raise
+                local(os.remove, part)  # The server does not resume this file, start it again
+                raise ftplib.error_temp('Cannot resume {0}, restarting it'.format(remote_path))
+            finally:
+                transfer['seconds'] += time.time() - start
+        if size is not None and local(os.path.getsize, part) != size:
+            raise ftplib.error_temp('Incomplete transfer of {0}: {1} of {2} bytes'.format(remote_path, os.path.getsize(part), size))
+
+    pool.run(retrieve, retries, backoff)
+    os.replace(part, local_path)
+    seconds = transfer['seconds']
+    instrumentation.current().add_time('download', seconds)
+    instrumentation.count('download_bytes', transfer['bytes'])
+    instrumentation.count('downloads')
+    instrumentation.emit(dict(transfer, type='download', file=os.path.basename(local_path), seconds=round(seconds, 3),
+                              throughput_mb_s=round(transfer['bytes'] / seconds / 1e6, 3) if seconds > 0 else None))
+    return local_path
+
+
+def list_directory(pool, remote_path, retries = 3, backoff = 2.0):
+    """ Files of a remote directory, {name: size in bytes}. The sizes come from MLSD; servers
+        without it are listed with NLST, and the sizes are then None.
+    """
+    def listing(ftp_server):
+        try:
+            return dict((name, int(facts['size']) if 'size' in facts else None)
+                        for name, facts in ftp_server.mlsd(remote_path, facts=['type', 'size'])
+                        if facts.get('type', 'file') == 'file')
+        except ftplib.error_perm:
+            return dict((os.path.basename(name), None) for name in ftp_server.nlst(remote_path))
+    with instrumentation.timer('listing'):
+        return pool.run(listing, retries, backoff)
+
+
+def frame_key(filename):
+    """ Acquisition key A<YYYYDDD>.<HHMM> of a granule or frame name, e.g. 'A2015002.0300' for
+        MOD05_L2.A2015002.0300.006.2015010101010.hdf, or for the frame A2015002.0300.006.
+    """
+    parts = filename.split('.')
+    return '.'.join(parts[1:3] if not parts[0].startswith('A') else parts[0:2])
+
+
+def index_listing(listing):
+    """ Granules (.hdf) of a directory listing {name: size}, grouped by frame key: {key: [name, ...]}. """
+    index = {}
+    for name in sorted(listing):
+        if name.endswith('.hdf'):
+            index.setdefault(frame_key(name), []).append(name)
+    return index
+
+
+class ListingCache:
+    """ Directory listings {name: size} stored on disk, one JSON file per remote directory, and
+        re-used while younger than ttl seconds. The listings of past days do not change, so a
+        date range, or a second run, does not list the server again.
+    """
+    def __init__(self, path, ttl = 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        if ttl > 0 and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def file_name(self, remote_path):
+        return os.path.join(self.path, remote_path.strip('/').replace('/', '_') + '.json')
+
+    def get(self, pool, remote_path, retries = 3, backoff = 2.0):
+        file_name = self.file_name(remote_path)
+        if self.ttl > 0 and os.path.isfile(file_name) and time.time() - os.path.getmtime(file_name) < self.ttl:
+            instrumentation.count('listing_cache_hits')
+            with open(file_name) as f:
+                return json.load(f)
+        listing = list_directory(pool, remote_path, retries, backoff)
+        if self.ttl > 0:
+            with open(file_name + '.tmp', 'w') as f:
+                json.dump(listing, f)
+            os.replace(file_name + '.tmp', file_name)
+        return listing
+
+
+def read_geometa(geo_file):
+    """ Parse a geoMeta file (MOD03/MYD03 .txt) into arrays: granule (GranuleID), start
+        (datetime64[m]), east, north, south, west (bounding coordinates), gring_lon and
+        gring_lat (n x 4 GRing vertices).
+    """
+    rows = []
+    with open(geo_file) as csvfile:
+        for row in csv.reader(csvfile):
+            if row and not row[0].startswith('#') and row[0] != 'GranuleID':
+                rows.append(row)
+    table = np.array(rows, dtype=object).reshape(-1, len(GEOMETA_FIELDS))
+    column = lambda name: table[:, GEOMETA_FIELDS.index(name)]
+    number = lambda name: column(name).astype(np.float64)
+    return {'granule': column('GranuleID').astype(str),
+            'start': column('StartDateTime').astype(str).astype('datetime64[m]'),
+            'east': number('EastBoundingCoord'), 'north': number('NorthBoundingCoord'),
+            'south': number('SouthBoundingCoord'), 'west': number('WestBoundingCoord'),
+            'gring_lon': np.stack([number('GRingLongitude%d' % k) for k in range(1, 5)], axis=-1),
+            'gring_lat': np.stack([number('GRingLatitude%d' % k) for k in range(1, 5)], axis=-1)}
+
+
+class GeoMetaCache:
+    """ geoMeta files of the server, kept on disk with their parsed arrays (.npz). A day that is
+        cached is never fetched again, except for the last days, which may still be completed on
+        the server and are fetched again when older than ttl seconds.
+    """
+    RECENT_DAYS = 3
+
+    def __init__(self, path, ttl = 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def file_name(self, platform, date):
+        prefix = 'MYD' if platform == 'AQUA' else 'MOD'
+        return os.path.join(self.path, platform, str(date.year), '{0}03_{1}.txt'.format(prefix, date.strftime('%Y-%m-%d')))
+
+    def get(self, pool, platform, date, retries = 3, backoff = 2.0):
+        """ Parsed geoMeta of the platform ('AQUA' or 'TERRA') for the date, see read_geometa. It is
+            fetched with a connection of pool if needed: ValueError if pool is None.
+        """
+        geo_file = self.file_name(platform, date)
+        recent = (datetime.datetime.utcnow().date() - date).days < self.RECENT_DAYS
+        if not os.path.isfile(geo_file) or (recent and time.time() - os.path.getmtime(geo_file) > self.ttl):
+            if pool is None:
+                raise ValueError("The geoMeta of {0} for {1} is not in {2}, a pool of FTP connections is needed "
+                                 "to fetch it".format(platform, date, self.path))
+            if not os.path.isdir(os.path.dirname(geo_file)):
+                os.makedirs(os.path.dirname(geo_file))
+            with instrumentation.timer('geometa_fetch'):
+                download_file(pool, '/geoMeta/6/' + platform + '/' + str(date.year) + '/' + os.path.basename(geo_file),
+                              geo_file, retries=retries, backoff=backoff)
+        else:
+            instrumentation.count('geometa_cache_hits')
+
+        arrays_file = geo_file[:-4] + '.npz'
+        with self.lock:
+            if os.path.isfile(arrays_file) and os.path.getmtime(arrays_file) >= os.path.getmtime(geo_file):
+                with np.load(arrays_file) as arrays:
+                    return dict(arrays)
+            with instrumentation.timer('geometa_parse'):
+                geometa = read_geometa(geo_file)
+            with open(arrays_file + '.tmp', 'wb') as f:
+                np.savez(f, **geometa)
+            os.replace(arrays_file + '.tmp', arrays_file)
+            return geometa
+
+
+def site_boxes(sites, margin = 0.2):
+    """ Boxes [south, north, west, east] of +/- margin degrees around the (name, lat, lon, ...) sites. """
+    points = np.array([[site[1], site[2]] for site in sites], dtype=np.float64).reshape(-1, 2)
+    return np.column_stack((points[:, 0] - margin, points[:, 0] + margin, points[:, 1] - margin, points[:, 1] + margin))
+
+
+def bounding_box_array(bounding_box):
+    """ The bounding_box dictionary as a box [south, north, west, east], whatever the order of its values. """
+    lat = sorted([bounding_box['south_lat'], bounding_box['north_lat']])
+    lon = sorted([bounding_box['west_long'], bounding_box['east_long']])
+    return np.array([[lat[0], lat[1], lon[0], lon[1]]])
+
+
+def _inside_gring(gring_lat, gring_lon, lat, lon):
+    """ Whether the points (lat, lon) are inside of the GRing quadrilaterals, for all the granules
+        and points at once: (granules, points). Longitudes are taken relative to the point, so
+        that granules crossing the date line are handled.
+    """
+    x = (gring_lon[:, None, :] - lon[None, :, None] + 180) % 360 - 180
+    y = gring_lat[:, None, :] - lat[None, :, None]
+    x_next, y_next = np.roll(x, -1, axis=-1), np.roll(y, -1, axis=-1)
+    cross = x * y_next - x_next * y         # Sign of the origin (the point) with respect to each edge
+    return np.all(cross >= 0, axis=-1) | np.all(cross <= 0, axis=-1)
+
+
+def select_granules(geometa, boxes, hours = (2, 10), use_gring = False):
+    """ Granules of the parsed geoMeta over the boxes [south, north, west, east], for all the
+        boxes at once. hours: (first, last) UTC hour of the start time, None for all the hours.
+        With use_gring, the centre of the boxes is tested against the GRing polygon of the
+        granules rather than their bounding box. Returns a boolean array (granules, boxes).
+    """
+    boxes = np.atleast_2d(boxes)
+    if use_gring:
+        selected = _inside_gring(geometa['gring_lat'], geometa['gring_lon'],
+                                 boxes[:, :2].mean(axis=1), boxes[:, 2:].mean(axis=1))
     else:
-        print("MG: Download success for this day :)")
-        file = open(dir_name + "SUCCESS", 'a')
-        file.write("TIMESTAMP: {0} UTC\n".format(datetime.datetime.utcnow()))
-        file.write("PRODUCTS: {0}\n".format(product_list))
-        file.close()
-        
-    data_time = data_time + date_increment
+        south, north = geometa['south'][:, None], geometa['north'][:, None]
+        west, east = geometa['west'][:, None], geometa['east'][:, None]
+        latitude = (south <= boxes[None, :, 1]) & (north >= boxes[None, :, 0])
+        # A granule crossing the date line has west > east: it covers [west, 180] and [-180, east]
+        longitude = np.where(west <= east,
+                             (west <= boxes[None, :, 3]) & (east >= boxes[None, :, 2]),
+                             (west <= boxes[None, :, 3]) | (east >= boxes[None, :, 2]))
+        selected = latitude & longitude
+    if hours is not None:
+        start = geometa['start']
+        hour = (start - start.astype('datetime64[D]')).astype('timedelta64[h]').astype(int)
+        selected &= ((hour >= hours[0]) & (hour <= hours[1]))[:, None]
+    return selected
+
+
+def select_frames(geometa, boxes, hours = (2, 10), use_gring = False):
+    """ Frames (e.g. A2015002.0300.006) of the granules over any of the boxes. """
+    selected = select_granules(geometa, boxes, hours, use_gring).any(axis=1)
+    # Strip to optain the re-usable form of the name.
+    # Name format spec : http://modis-atmos.gsfc.nasa.gov/products_filename.html
+    return ['.'.join(x.rsplit('.')[1:4]) for x in geometa['granule'][selected]]
+
+
+def plan(dates, boxes, hours = (2, 10), use_gring = False, geometa_cache = None, pool = None,
+         retries = 3, backoff = 2.0):
+    """ Frames to download for every date: {date: {'MYD': frames, 'MOD': frames}}. The geoMeta
+        files already cached are not fetched again, so a backfill of cached days is planned
+        without the network (pool may then be None, a day that is not cached raises ValueError).
+    """
+    geometa_cache = geometa_cache or GeoMetaCache(geometa_cache_dir)
+    frames = {}
+    for date in dates:
+        frames[date] = dict((prefix, select_frames(geometa_cache.get(pool, platform, date, retries, backoff), boxes, hours, use_gring))
+                            for platform, prefix in (('AQUA', 'MYD'), ('TERRA', 'MOD')))
+    return frames
+
+
+def day_directory(data_root, date):
+    """ Download directory of a day, data-{YEAR}-{MONTH}-{DAY}/ without zero padding. """
+    return os.path.join(data_root, "data-{0}-{1}-{2}/".format(date.year, date.month, date.day))
+
+
+def prepare_day(pool, date, dir_name, product_list, boxes, hours, retries = 3, backoff = 2.0,
+                listings = None, geometa_cache = None, use_gring = False):
+    """ Select the frames over the boxes from the geolocation files of the day, and list the
+        granules to download to dir_name. Each product directory is listed once, through the
+        listings cache if given. Returns a list of (remote path, local path, size).
+    """
+    current_date = date.timetuple()
+    # We need the MOD03, the Geolocalisation Data Set, to know which frame to download. We could also download them all
+    # but our connection is slow. We uses the server .txt files.
+    print("MG: Selecting frames from the Geolocalisation Data Set")
+    good_frames = plan([date], boxes, hours, use_gring, geometa_cache, pool, retries, backoff)[date]
+
+    print("MG: Will download frames:\n    TERRA : {0}\n    AQUA : {1}".format(good_frames['MOD'], good_frames['MYD']))
+
+    transfers = []
+    for product in product_list:
+        # We use zfill for zero-padding
+        data_path = ftp_prefix + product + "/" + str(current_date.tm_year) + "/" + str(current_date.tm_yday).zfill(3)
+        good_frame = good_frames['MYD' if product.find('MYD') >= 0 else 'MOD']
+        if not good_frame:
+            continue
+        if listings is not None:
+            listing = listings.get(pool, data_path, retries, backoff)
+        else:
+            listing = list_directory(pool, data_path, retries, backoff)
+        granules = index_listing(listing)
+        for frame in good_frame:
+            for filename in granules.get(frame_key(frame), []):
+                if filename.startswith(product + '.' + frame + '.'):
+                    transfers.append((data_path + "/" + filename, dir_name + filename, listing[filename]))
+    return transfers
+
+
+class DayManifest:
+    """ State of the download of one day, kept in dir_name/manifest.json and rewritten after
+        every transfer:
+            state     'complete' once all the expected files are downloaded, 'incomplete' otherwise
+            products  products requested
+            updated   UTC time of the last change
+            error     reason why the list of granules could not be made, if so
+            files     {filename: {'remote': path, 'size': bytes or None,
+                                  'status': 'pending', 'complete' or 'failed', 'error': reason}}
+        The pipeline (pipeline.py) marks the files whose values are stored as 'extracted'; they
+        count as complete, and are not downloaded again once deleted.
+    """
+    def __init__(self, dir_name, product_list = None):
+        self.file_name = os.path.join(dir_name, MANIFEST_FILE)
+        self.lock = threading.Lock()
+        self.products = product_list
+        self.error = None
+        self.files = {}
+        if os.path.isfile(self.file_name):
+            with open(self.file_name) as f:
+                content = json.load(f)
+            self.files = content['files']
+            self.products = product_list or content.get('products')
+
+    @property
+    def state(self):
+        if self.error is None and all(entry['status'] in ('complete', 'extracted') for entry in self.files.values()):
+            return 'complete'
+        return 'incomplete'
+
+    def expect(self, filename, remote_path, size):
+        """ Add a file to the manifest. A complete file is downloaded again if its size changed. """
+        with self.lock:
+            entry = self.files.get(filename)
+            if entry is None or entry['remote'] != remote_path or (size is not None and entry['size'] not in (None, size)):
+                entry = {'remote': remote_path, 'size': size, 'status': 'pending', 'error': None}
+            if size is not None:
+                entry['size'] = size
+            self.files[filename] = entry
+
+    def needs_download(self, filename):
+        """ Whether the file is not complete, or is missing or has the wrong size on disk. """
+        entry = self.files[filename]
+        if entry['status'] == 'extracted':
+            return False
+        local_path = os.path.join(os.path.dirname(self.file_name), filename)
+        return (entry['status'] != 'complete' or not os.path.isfile(local_path) or
+                (entry['size'] is not None and os.path.getsize(local_path) != entry['size']))
+
+    def set_status(self, filename, status, error = None):
+        with self.lock:
+            self.files[filename]['status'] = status
+            self.files[filename]['error'] = None if error is None else str(error)
+            if status == 'complete' and self.files[filename]['size'] is None:
+                self.files[filename]['size'] = os.path.getsize(os.path.join(os.path.dirname(self.file_name), filename))
+            self.save()
+
+    def save(self):
+        """ Write the manifest, under a temporary name first so that it is never half written. """
+        content = {'state': self.state, 'products': self.products, 'error': self.error,
+                   'updated': "{0} UTC".format(datetime.datetime.utcnow()), 'files': self.files}
+        with open(self.file_name + '.tmp', 'w') as f:
+            json.dump(content, f, indent=1, sort_keys=True)
+        os.replace(self.file_name + '.tmp', self.file_name)
+
+
+def grab_day(pool, downloads, date, product_list, boxes, hours, data_root,
+             retries = 3, backoff = 2.0, listings = None, geometa_cache = None, use_gring = False):
+    """ Download the granules of one day that are not complete yet. The transfers are submitted
+        to the downloads executor, shared by all the days. Returns True if the day is complete.
+    """
+    current_date = date.timetuple()
+    print("MG: ========================================================================================")
+    print("MG: Downloading products {0}, at date {1}-{2}-{3} [{4} th day of the year]".format(product_list, current_date.tm_year,
+                                                                                              current_date.tm_mon, current_date.tm_mday, current_date.tm_yday))
+    dir_name = day_directory(data_root, date)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    manifest = DayManifest(dir_name, product_list)
+
+    try:
+        transfers = prepare_day(pool, date, dir_name, product_list, boxes, hours,
+                                retries, backoff, listings, geometa_cache, use_gring)
+    except ftplib.all_errors as e:
+        print("MG: (EE) FTP Connection error: {0}\n MG: Cannot list the granules of {1}".format(e, dir_name))
+        manifest.error = str(e)
+        manifest.save()
+        return False
+
+    for remote_path, local_path, size in transfers:
+        manifest.expect(os.path.basename(local_path), remote_path, size)
+    manifest.save()
+    missing = [transfer for transfer in transfers if manifest.needs_download(os.path.basename(transfer[1]))]
+    print("MG: {0}: {1} granules, {2} to download".format(dir_name, len(transfers), len(missing)))
+
+    futures = dict((downloads.submit(download_file, pool, remote_path, local_path, size, retries, backoff),
+                    os.path.basename(local_path)) for remote_path, local_path, size in missing)
+    for future in as_completed(futures):
+        error = future.exception()
+        if error is not None:
+            print("MG: (EE) {0}: {1}".format(futures[future], error))
+        manifest.set_status(futures[future], 'complete' if error is None else 'failed', error)
+
+    if manifest.state == 'complete':
+        print("MG: Download success for {0} :)".format(dir_name))
+        return True
+    print("MG: (EE) {0} is incomplete, re-launch the grabber for this day".format(dir_name))
+    return False
+
+
+def grab(dates, product_list, boxes, hours = (2, 10), data_root = "../_data/",
+         address = 'ladsweb.nascom.nasa.gov', port = 21, max_connections = 4, max_days = 2,
+         retries = 3, backoff = 2.0, listing_cache_dir = None, listing_ttl = 24 * 3600,
+         geometa_cache_dir = "../_data/.geoMeta/", use_gring = False, metrics_file = None):
+    """ Download the days in parallel, sharing one pool of max_connections FTP connections.
+        boxes: [south, north, west, east] of the areas of interest, see site_boxes and
+        bounding_box_array. hours: UTC hours (first, last) of the granules, None for all.
+        The product directory listings are cached in listing_cache_dir, if given.
+        If metrics_file is given, one JSON record per downloaded file and one for the run are appended to it.
+        Returns {date: True if the day is completely downloaded}.
+    """
+    pool = FTPPool(address, max_connections, port)
+    listings = ListingCache(listing_cache_dir, listing_ttl) if listing_cache_dir else None
+    geometa_cache = GeoMetaCache(geometa_cache_dir, listing_ttl)
+    instrumentation.open_records(metrics_file)
+    start = time.time()
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_connections) as downloads, ThreadPoolExecutor(max_days) as days:
+            results = dict(zip(dates, days.map(lambda date: grab_day(pool, downloads, date, product_list, boxes, hours, data_root,
+                                                                     retries, backoff, listings, geometa_cache, use_gring), dates)))
+            return results
+    finally:
+        pool.close()
+        instrumentation.emit(dict(instrumentation.RUN.snapshot(), type='run', script='modisGrabber', days=len(dates),
+                                  complete=sum(results.values()), seconds=round(time.time() - start, 3)))
+        instrumentation.close_records()
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1):
+        input_date = sys.argv[1]
+    boxes = site_boxes(sites, site_margin) if sites else bounding_box_array(bounding_box)
+    hours = None if download_all_hours else time_window
+    results = grab(parse_dates(input_date), product_list, boxes, hours, data_root, ftp_address, max_connections=max_connections, max_days=max_days, retries=retries, backoff=backoff,
+                   listing_cache_dir=listing_cache_dir, listing_ttl=listing_ttl,
+                   geometa_cache_dir=geometa_cache_dir, use_gring=use_gring, metrics_file=metrics_file)
+    print("MG: {0} day(s) downloaded, {1} failed".format(sum(results.values()), len(results) - sum(results.values())))
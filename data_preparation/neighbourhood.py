@@ -0,0 +1,76 @@
+"""
+   Neighbourhood statistics of a class image (e.g. the decoded cloud mask quality flag) at many
+   scales at once. One integral image (summed-area table) is built per class; the number of
+   pixels of each class in any box is then read from its four corners, whatever the size of the
+   box, so that all the window sizes cost one pass over the image.
+"""
+import numpy as np
+
+# Quality flag of the cloud mask: 0 = cloud, 1 = 66% clear, 2 = 95% clear, 3 = 99% clear
+QUALITY_CLASSES = 4
+CLOUD_CLASS = 0
+
+
+def integral_image(values):
+    """ Summed-area table of the last two axes of values, with a leading row and column of zeros:
+        integral[..., i, j] is the sum of values[..., :i, :j].
+    """
+    values = np.asarray(values)
+    integral = np.zeros(values.shape[:-2] + (values.shape[-2] + 1, values.shape[-1] + 1),
+                        dtype=np.float64 if values.dtype.kind == 'f' else np.int64)
+    np.cumsum(values, axis=-2, out=integral[..., 1:, 1:])
+    np.cumsum(integral[..., 1:, 1:], axis=-1, out=integral[..., 1:, 1:])
+    return integral
+
+
+def box_sums(integral, rows, cols, size):
+    """ Sums of the size x size boxes centred on the pixels (rows, cols), clipped to the image.
+        Returns the sums (..., points), the number of pixels of each clipped box and whether the
+        box is complete.
+    """
+    height, width = integral.shape[-2] - 1, integral.shape[-1] - 1
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    row0 = np.clip(rows - size // 2, 0, height)
+    row1 = np.clip(rows - size // 2 + size, 0, height)
+    col0 = np.clip(cols - size // 2, 0, width)
+    col1 = np.clip(cols - size // 2 + size, 0, width)
+    sums = (integral[..., row1, col1] - integral[..., row0, col1]
+            - integral[..., row1, col0] + integral[..., row0, col0])
+    n_pixels = (row1 - row0) * (col1 - col0)
+    return sums, n_pixels, n_pixels == size * size
+
+
+def class_statistics(classes, rows, cols, sizes, n_classes = QUALITY_CLASSES, cloud_class = CLOUD_CLASS):
+    """ Per-class counts around the pixels (rows, cols) of the class image, for every window size.
+        classes: 2-D array of class indices in [0, n_classes)
+        sizes:   window sizes in pixels; None stands for the whole image
+        Returns {size: statistics}, with for each point:
+            counts          (points, n_classes) number of pixels of each class
+            n_pixels        pixels in the window, less than size**2 if clipped by the image
+            complete        whether the window is entirely inside of the image
+            cloud_fraction  fraction of the pixels of cloud_class
+            mean            mean class index
+    """
+    classes = np.asarray(classes)
+    one_hot = classes[None, :, :] == np.arange(n_classes)[:, None, None]
+    integral = integral_image(one_hot)
+    rows = np.atleast_1d(rows)
+    cols = np.atleast_1d(cols)
+
+    statistics = {}
+    for size in sizes:
+        if size is None:
+            counts = np.repeat(integral[:, -1, -1][:, None], len(rows), axis=1)
+            n_pixels = np.full(len(rows), classes.size, dtype=np.int64)
+            complete = np.ones(len(rows), dtype=bool)
+        else:
+            counts, n_pixels, complete = box_sums(integral, rows, cols, int(size))
+        counts = counts.T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            statistics[size] = {'counts': counts,
+                                'n_pixels': n_pixels,
+                                'complete': complete,
+                                'cloud_fraction': counts[:, cloud_class] / n_pixels,
+                                'mean': counts.dot(np.arange(n_classes)) / n_pixels}
+    return statistics
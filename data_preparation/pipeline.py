@@ -0,0 +1,362 @@
+#!/usr/bin/env ipython3
+"""
+   Streaming mode of the download -> extraction -> matching chain. Instead of filling _data/,
+   crawling it with cloudmask.py and matching everything in main.ipynb, each granule goes
+   through the stages as soon as it is downloaded:
+        download    modisGrabber, over the pool of FTP connections
+        extract     cloudmask.extract_granule, in a pool of processes
+        commit      the values are appended to the CloudMaskStore, the day manifest marks the
+                    granule 'extracted', and the raw HDF file is deleted if delete_raw
+        match       the MODIS observations of camera_site are matched with the sky camera
+                    coverage, see matchCoverage.update_match_table
+   The stages are connected by bounded queues, and at most max_granules HDF files are on the
+   scratch disk at any time: a download only starts once a granule has left the pipeline.
+   Re-running it for the same dates resumes where it stopped, the extracted granules are skipped.
+   If a stage fails (e.g. the extraction pool breaks), the others are stopped and run() raises the
+   error; the downloaded granules that were not extracted are kept for the next run.
+   The stage timers and counters of the downloads, of every granule and of the run go to
+   metrics_file, as JSON lines (see instrumentation.py).
+"""
+import csv
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import time
+import numpy as np
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.dirname(os.path.abspath(__file__)), ROOT]
+import instrumentation
+import modisGrabber
+from cloudMaskStore import cloud_fraction
+from cloudmask import (STATISTICS_HEADER, append_block, extract_task, granule_datetime, granule_record, open_store,
+                       statistics_rows)
+from sites import read_sites
+from matchCoverage import update_match_table
+
+dates = "2015-01-02--2015-01-08"               # Same format as modisGrabber.input_date
+products = ['MOD05_L2', 'MYD05_L2']
+sites = read_sites(names=['Singapore'])
+site_margin = 0.2
+roi_size = 50
+scales = []                                    # See cloudmask.scales
+
+data_root = "../_data/"
+store_path = 'cloudmask_store'
+failures_file = 'cloudmask_failures.csv'
+statistics_file = 'cloudmask_scales.csv'
+metrics_file = 'pipeline_metrics.jsonl'
+profile_dir = None                             # See cloudmask.profile_dir
+
+# Matching with the sky camera, None to skip it
+camera_site = 'Singapore'
+match_file = '../cmask_coverage_result/pipeline.txt'
+coverage_path = '../coverage_data/'
+tolerance = 900                                # Seconds
+camera_utc_offset = 8                          # Hours, the sky camera times are local (SGT), the store is in UTC
+
+delete_raw = True                              # Delete the HDF files once their values are stored
+max_granules = 16                              # HDF files on the scratch disk at most
+block_size = 8                                 # Granules committed to the store at a time
+flush_seconds = 30                             # Commit a partial block after this idle time
+max_connections = 4
+processes = None                               # Extraction processes, None for one per core
+
+_DONE = object()                               # End of a queue
+_POLL_SECONDS = 0.5                            # Waits on the queues and slots check for a stop this often
+MATCH_WINDOW = 3                               # Pixels around the site of the cloud_mask .mat files
+
+
+class Pipeline:
+    def __init__(self, sites, product_list = ('MOD05_L2', 'MYD05_L2'), roi_size = 50, scales = (),
+                 data_root = "../_data/", store_path = 'cloudmask_store', failures_file = 'cloudmask_failures.csv',
+                 statistics_file = 'cloudmask_scales.csv', camera_site = None, match_file = None,
+                 coverage_path = None, tolerance = 900, camera_utc_offset = 0, delete_raw = True, max_granules = 16,
+                 block_size = 8, flush_seconds = 30, site_margin = 0.2, hours = (2, 10),
+                 address = 'ladsweb.nascom.nasa.gov', port = 21, max_connections = 4, processes = None,
+                 retries = 3, backoff = 2.0, listing_cache_dir = None, listing_ttl = 24 * 3600,
+                 geometa_cache_dir = "../_data/.geoMeta/", metrics_file = None, profile_dir = None):
+        self.sites = sites
+        self.product_list = list(product_list)
+        self.roi_size = roi_size
+        self.scales = list(scales)
+        self.data_root = data_root
+        self.store = open_store(store_path, sites)
+        self.failures_file = failures_file
+        self.statistics_file = statistics_file
+        self.camera_site = camera_site
+        self.match_file = match_file
+        self.coverage_path = coverage_path
+        self.tolerance = tolerance
+        self.camera_utc_offset = np.timedelta64(int(camera_utc_offset * 3600), 's')
+        self.delete_raw = delete_raw
+        self.max_granules = max_granules
+        self.block_size = min(block_size, max_granules)
+        self.flush_seconds = flush_seconds
+        self.boxes = modisGrabber.site_boxes(sites, site_margin)
+        self.hours = hours
+        self.processes = processes
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics_file = metrics_file
+        self.profile_dir = profile_dir
+        if profile_dir and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+
+        self.pool = modisGrabber.FTPPool(address, max_connections, port)
+        self.max_connections = max_connections
+        self.listings = modisGrabber.ListingCache(listing_cache_dir, listing_ttl) if listing_cache_dir else None
+        self.geometa_cache = modisGrabber.GeoMetaCache(geometa_cache_dir, listing_ttl)
+
+        # Granules on the scratch disk, from the start of their download to their commit
+        self.slots = threading.BoundedSemaphore(max_granules)
+        self.downloaded = queue.Queue(max_granules)
+        self.extracted = queue.Queue(max_granules)
+        self.manifests = {}
+        self.counts = {'downloaded': 0, 'extracted': 0, 'failed': 0, 'matched': 0}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.errors = []
+
+    def run(self, dates):
+        """ Run the pipeline for the dates until all their granules are stored. Returns counts of
+            the downloaded, extracted and failed granules, and of the matched observations.
+        """
+        instrumentation.open_records(self.metrics_file)
+        start = time.time()
+        stages = [threading.Thread(target=self.stage, args=(self.download_stage, dates), name='download'),
+                  threading.Thread(target=self.stage, args=(self.extract_stage,), name='extract')]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+        try:
+            self.commit_stage()
+        finally:
+            self.stopped.set()
+            for stage in stages:
+                stage.join()
+            self.pool.close()
+            instrumentation.emit(dict(instrumentation.RUN.snapshot(), type='run', script='pipeline', days=len(dates),
+                                      seconds=round(time.time() - start, 3), **self.counts))
+            instrumentation.close_records()
+        if self.errors:
+            raise self.errors[0]
+        return dict(self.counts)
+
+    def stage(self, target, *args):
+        """ Run a stage in its thread. If it fails, the other stages are stopped, and run() raises
+            its error once they are.
+        """
+        try:
+            target(*args)
+        except BaseException as e:
+            print("PL: (EE) The {0} stage failed: {1}: {2}".format(threading.current_thread().name, type(e).__name__, e))
+            self.errors.append(e)
+            self.stopped.set()
+
+    def put(self, stage_queue, item):
+        """ Queue an item, unless the pipeline is stopped: nothing takes the items out then.
+            Returns whether it was queued.
+        """
+        while True:
+            try:
+                stage_queue.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                if self.stopped.is_set():
+                    return False
+
+    def acquire_slot(self):
+        """ Wait for room on the scratch disk. Returns False if the pipeline is stopped. """
+        while not self.slots.acquire(timeout=_POLL_SECONDS):
+            if self.stopped.is_set():
+                return False
+        return True
+
+    def download_stage(self, dates):
+        """ Download the granules of the dates, one day after the other, and queue them for the
+            extraction. The granules downloaded by an earlier run, but not extracted, are queued
+            directly.
+        """
+        try:
+            with ThreadPoolExecutor(self.max_connections) as downloads:
+                for date in dates:
+                    dir_name = modisGrabber.day_directory(self.data_root, date)
+                    if not os.path.exists(dir_name):
+                        os.makedirs(dir_name)
+                    manifest = modisGrabber.DayManifest(dir_name, self.product_list)
+                    try:
+                        transfers = modisGrabber.prepare_day(self.pool, date, dir_name, self.product_list, self.boxes,
+                                                             self.hours, self.retries, self.backoff, self.listings,
+                                                             self.geometa_cache)
+                    except modisGrabber.ftplib.all_errors as e:
+                        print("PL: (EE) Cannot list the granules of {0}: {1}".format(dir_name, e))
+                        manifest.error = str(e)
+                        manifest.save()
+                        continue
+                    for remote_path, local_path, size in transfers:
+                        manifest.expect(os.path.basename(local_path), remote_path, size)
+                    manifest.save()
+
+                    for remote_path, local_path, size in transfers:
+                        filename = os.path.basename(local_path)
+                        if manifest.files[filename]['status'] == 'extracted':
+                            continue
+                        if self.stopped.is_set() or not self.acquire_slot():
+                            return
+                        self.manifests[local_path] = manifest
+                        if manifest.needs_download(filename):
+                            future = downloads.submit(modisGrabber.download_file, self.pool, remote_path, local_path,
+                                                      size, self.retries, self.backoff)
+                            future.add_done_callback(lambda future, path=local_path: self.downloaded_granule(path, future.exception()))
+                        else:
+                            self.put(self.downloaded, local_path)
+        finally:
+            self.put(self.downloaded, _DONE)
+
+    def downloaded_granule(self, local_path, error):
+        manifest = self.manifests[local_path]
+        if error is None:
+            manifest.set_status(os.path.basename(local_path), 'complete')
+            with self.lock:
+                self.counts['downloaded'] += 1
+            self.put(self.downloaded, local_path)
+        else:
+            print("PL: (EE) {0}: {1}".format(os.path.basename(local_path), error))
+            manifest.set_status(os.path.basename(local_path), 'failed', error)
+            self.manifests.pop(local_path)
+            self.slots.release()
+
+    def extract_stage(self):
+        """ Extract the downloaded granules in a pool of processes, as they arrive. """
+        try:
+            with ProcessPoolExecutor(self.processes) as extraction:
+                while not self.stopped.is_set():
+                    try:
+                        local_path = self.downloaded.get(timeout=_POLL_SECONDS)
+                    except queue.Empty:
+                        continue
+                    if local_path is _DONE:
+                        break
+                    future = extraction.submit(extract_task, (local_path, self.sites, self.roi_size, self.scales, self.profile_dir))
+                    future.add_done_callback(lambda future, path=local_path: self.put(self.extracted, _task_result(path, future)))
+        finally:
+            self.put(self.extracted, _DONE)
+
+    def commit_stage(self):
+        """ Append the extracted values to the store, block_size granules at a time or after
+            flush_seconds without a new one, then release the granules and match the new values.
+            Stops once the extraction is done, or after committing the last block if the pipeline
+            is stopped.
+        """
+        block, committed = [], []
+        last = time.time()
+        write_header = not os.path.isfile(self.failures_file)
+        with open(self.failures_file, 'a', newline='') as failures, \
+             open(self.statistics_file if self.scales else os.devnull, 'a', newline='') as statistics_out:
+            failures_writer = csv.writer(failures)
+            statistics_writer = csv.writer(statistics_out)
+            if write_header:
+                failures_writer.writerow(['granule', 'reason'])
+            if self.scales and statistics_out.tell() == 0:
+                statistics_writer.writerow(STATISTICS_HEADER)
+
+            done = False
+            while not done:
+                try:
+                    result = self.extracted.get(timeout=_POLL_SECONDS)
+                    last = time.time()
+                except queue.Empty:
+                    if not self.stopped.is_set() and time.time() - last < self.flush_seconds:
+                        continue
+                    result = None       # Idle or stopped, commit the partial block
+                    last = time.time()
+                done = result is _DONE or (result is None and self.stopped.is_set())
+
+                if result is not None and not done:
+                    path, values, reason, metrics = result
+                    instrumentation.RUN.merge(metrics)
+                    instrumentation.emit(granule_record(path, values, reason, metrics))
+                    if reason is None:
+                        boxes, statistics, _ = values
+                        with instrumentation.timer('output_write'):
+                            statistics_writer.writerows(statistics_rows(path, statistics))
+                        for name, box in boxes.items():
+                            block.append((os.path.basename(path)[:3], name, granule_datetime(path), box))
+                        committed.append(path)
+                    else:
+                        failures_writer.writerow([path, reason])
+                        self.release(path, 'failed', reason)
+
+                if committed and (len(committed) >= self.block_size or result is None or done):
+                    append_block(self.store, block)
+                    failures.flush()
+                    statistics_out.flush()
+                    for path in committed:
+                        self.release(path, 'extracted')
+                    self.match(committed)
+                    block, committed = [], []
+
+    def release(self, local_path, status, error = None):
+        """ Mark a granule as done in its manifest, delete it if needed, and free its slot. """
+        manifest = self.manifests.pop(local_path)
+        manifest.set_status(os.path.basename(local_path), status, error)
+        with self.lock:
+            self.counts['extracted' if status == 'extracted' else 'failed'] += 1
+        if self.delete_raw and os.path.isfile(local_path):
+            os.remove(local_path)
+        self.slots.release()
+
+    def match(self, paths):
+        """ Match the values of camera_site just committed, those of the granules paths, with the
+            sky camera coverage. Only their time range is loaded from the store, and
+            update_match_table only matches the new observations, so this is cheap enough after
+            every commit. It keeps the observations matched earlier, and matches again those whose
+            coverage files were added, modified or removed since: a coverage file that arrives
+            after its granules is picked up at the next commit.
+        """
+        if self.match_file is None or self.camera_site is None:
+            return
+        times = {}
+        for path in paths:
+            times.setdefault(os.path.basename(path)[:3], []).append(np.datetime64(granule_datetime(path), 's'))
+        for satellite, satellite_times in sorted(times.items()):
+            series = self.store.load(min(satellite_times), max(satellite_times) + np.timedelta64(1, 's'),
+                                     sites=self.camera_site, satellites=satellite)
+            if len(series['time']):
+                added = update_match_table(self.match_file, satellite, series['time'] + self.camera_utc_offset,
+                                           match_fraction(series), self.coverage_path, self.tolerance)
+                self.counts['matched'] += added
+
+
+def match_fraction(series, size = MATCH_WINDOW):
+    """ Cloud fraction of the size x size pixels around the site, for rows loaded from the store:
+        the average of the cloud_mask .mat files, i.e. the notebook's cloudMaskForMODISTime (0 to
+        1). The mean of the store is over the whole box of the site, which may be larger. Rows
+        without a window (imported from the .mat files) keep their mean, already this value.
+    """
+    window = series['window']
+    first = max(window.shape[1] // 2 - size // 2, 0)
+    fraction = cloud_fraction(window[:, first:first + size, first:first + size], axis=(1, 2))
+    return np.where(np.isfinite(fraction), fraction, series['mean'])
+
+
+def _task_result(path, future):
+    """ Result of cloudmask.extract_task, or the failure of the process that ran it. """
+    error = future.exception()
+    if error is not None:
+        return (path, None, '{0}: {1}'.format(type(error).__name__, error), instrumentation.Metrics().snapshot())
+    return future.result()
+
+
+if __name__ == '__main__':
+    pipeline = Pipeline(sites, products, roi_size, scales, data_root, store_path, failures_file, statistics_file,
+                        camera_site, match_file, coverage_path, tolerance, camera_utc_offset, delete_raw, max_granules, block_size,
+                        flush_seconds, site_margin, modisGrabber.time_window, modisGrabber.ftp_address,
+                        max_connections=max_connections, processes=processes,
+                        listing_cache_dir=modisGrabber.listing_cache_dir, listing_ttl=modisGrabber.listing_ttl,
+                        geometa_cache_dir=modisGrabber.geometa_cache_dir, metrics_file=metrics_file, profile_dir=profile_dir)
+    counts = pipeline.run(modisGrabber.parse_dates(dates))
+    print("PL: {0} granules downloaded, {1} extracted, {2} failed, {3} observations matched".format(
+        counts['downloaded'], counts['extracted'], counts['failed'], counts['matched']))
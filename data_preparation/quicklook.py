@@ -0,0 +1,254 @@
+#!/usr/bin/env ipython3
+"""
+   Headless quick-look images of the granules, one PNG per granule, site and layer, e.g. the
+   cloud mask over the sky cameras for every overpass of a year:
+        <output_dir>/<site>/<granule>_<layer>.png
+   The map of each site (Lambert conformal projection and coastlines at `resolution`) is built
+   once and pickled in map_cache_dir, where the next runs load it instead of processing the
+   coastlines again. The granules are rendered by a pool of processes on Agg canvases (no window,
+   no display needed). Each process keeps one figure per site and layer with the coastlines, the
+   site and the colour bar already drawn, and only replaces the granule layer. A granule is read
+   and decoded once for all its sites and layers. Existing images are skipped, so a batch can be
+   resumed.
+"""
+import csv
+import multiprocessing
+import os
+import pickle
+import instrumentation
+from PrecipitableWaterProduct import PrecipitableWaterProduct
+from cloudmask import find_granules
+from geoIndex import GeoIndex
+from sites import read_sites
+
+satellites = ['MOD', 'MYD']
+products = ['05']
+extension = '.hdf'
+mask_path = 'data/data-2015-*-*'
+
+# Sites of sites.csv to draw, see cloudmask.sites
+sites = read_sites(names=['Singapore'])
+layers = ['CM']                 # See LAYERS
+roi_size = 200                  # km of the granule read around each site
+map_margin = (1.0, 0.5)         # Degrees of longitude and latitude around the site on the map
+resolution = 'h'                # Coastlines: 'c', 'l', 'i', 'h' or 'f'
+dpi = 100
+
+output_dir = 'quicklooks'
+map_cache_dir = 'quicklooks/.maps'
+failures_file = 'quicklook_failures.csv'
+metrics_file = None             # See cloudmask.metrics_file
+processes = None                # Number of worker processes, None for one per core
+
+# Layers: extractor of PrecipitableWaterProduct, colours of the values 0, 64, 128 and 192, their labels, title
+LAYERS = {
+    'CM': ('extractCloudMaskQA_QualityFlag', ['gray', 'green', 'red', 'blue'],
+           ['100% clouds', '60% cloud free', '92% cloud free', '98% cloud free'], 'Cloud Mask'),
+    'LC': ('extractCloudMaskQA_LandCoverFlag', ['blue', 'palegreen', 'red', 'green'],   # red for desert, palegreen for coastal
+           ['Water', 'Coastal', 'Desert', 'Land'], 'Land Cover Flag'),
+}
+BOUNDS = [0, 64, 128, 192, 256]
+TICKS = [32, 96, 160, 224]
+
+
+def map_key(site, margin = (1.0, 0.5), resolution = 'h'):
+    return '{0}_{1:.4f}_{2:.4f}_{3:g}x{4:g}_{5}'.format(site[0], site[1], site[2], margin[0], margin[1], resolution)
+
+
+def build_map(site, margin = (1.0, 0.5), resolution = 'h'):
+    """ Basemap (lambert conformal conic) of margin (longitude, latitude) degrees around the
+        (name, lat, lon, ...) site. The coastlines are processed here, this is the slow part.
+    """
+    from mpl_toolkits.basemap import Basemap
+    return Basemap(projection='lcc', resolution=resolution, area_thresh=0.1,
+                   llcrnrlon=site[2] - margin[0], llcrnrlat=site[1] - margin[1],
+                   urcrnrlon=site[2] + margin[0], urcrnrlat=site[1] + margin[1],
+                   lat_0=site[1], lon_0=site[2])
+
+
+# Maps of this process, by map_key
+_maps = {}
+
+
+def site_map(site, margin = (1.0, 0.5), resolution = 'h', cache_dir = None):
+    """ Map of the site, built once per process, and once for all if cache_dir is given: it is
+        then pickled there and loaded by the next runs.
+    """
+    key = map_key(site, margin, resolution)
+    if key in _maps:
+        return _maps[key]
+    cache_file = os.path.join(cache_dir, key + '.pickle') if cache_dir else None
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as f:
+            basemap = pickle.load(f)
+    else:
+        with instrumentation.timer('map_build'):
+            basemap = build_map(site, margin, resolution)
+        if cache_file:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(cache_file + '.tmp', 'wb') as f:
+                pickle.dump(basemap, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_file + '.tmp', cache_file)
+    _maps[key] = basemap
+    return basemap
+
+
+class QuickLook:
+    """ Figure of one site and layer. The coastlines, the site and the colour bar are drawn once;
+        render() draws a granule, writes the image and removes the granule again. The figure has
+        its own Agg canvas unless one is given, e.g. plt.figure() to display it.
+    """
+    def __init__(self, basemap, site, layer, dpi = 100, figure = None):
+        from matplotlib import colors, cm
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        _, colours, labels, self.title = LAYERS[layer]
+        if figure is None:
+            figure = Figure()
+            FigureCanvasAgg(figure)
+        self.figure = figure
+        self.figure.set_facecolor('white')
+        self.ax = self.figure.add_subplot(111)
+        self.basemap = basemap
+        self.dpi = dpi
+        self.cmap = colors.ListedColormap(colours)
+        self.norm = colors.BoundaryNorm(BOUNDS, self.cmap.N)
+
+        basemap.drawcoastlines(ax=self.ax, zorder=2)     # Above the granules
+        # Point for WSI position
+        basemap.scatter(site[2], site[1], s=100, facecolor='none', edgecolors='g', latlon=True, alpha=1, ax=self.ax, zorder=3)
+        cbar = self.figure.colorbar(cm.ScalarMappable(self.norm, self.cmap), ax=self.ax, ticks=TICKS)
+        cbar.ax.set_yticklabels(labels)
+        self.ax.set_title(' \n ' + self.title)
+        self.figure.tight_layout()
+
+    def render(self, longitude, latitude, values, name, path = None):
+        """ Draw the values on their grid, titled with the granule name, and save it as path. The
+            granule stays drawn if path is None.
+        """
+        with instrumentation.timer('render'):
+            mesh = self.basemap.pcolormesh(longitude, latitude, values, shading='nearest', cmap=self.cmap,
+                                           norm=self.norm, latlon=True, ax=self.ax)
+            self.ax.set_title(name + ' \n ' + self.title)
+        if path is None:
+            return mesh
+        with instrumentation.timer('output_write'):
+            self.figure.savefig(path, dpi=self.dpi)
+        mesh.remove()
+        return path
+
+
+# Figures of this process, by (map_key, layer)
+_quicklooks = {}
+
+
+def granule_name(path):
+    """ MOD05_L2.A2015002.0300.006 for .../MOD05_L2.A2015002.0300.006.2015010101010.hdf, the title of the images. """
+    return '.'.join(os.path.basename(path).split('.')[0:-2])
+
+
+def image_path(output_dir, site, path, layer):
+    return os.path.join(output_dir, site[0], '{0}_{1}.png'.format(granule_name(path), layer))
+
+
+def render_granule(path, sites, layers = ('CM',), output_dir = 'quicklooks', roi_size = 200, margin = (1.0, 0.5),
+                   resolution = 'h', cache_dir = None, dpi = 100, overwrite = False):
+    """ Draw the layers of the granule around each site it covers. The sites are located with one
+        query and each layer is read and decoded once, over the roi covering all of them; each
+        image shows the roi_size km around its site. Returns the written images.
+    """
+    todo = [(site, [layer for layer in layers if overwrite or not os.path.isfile(image_path(output_dir, site, path, layer))])
+            for site in sites]
+    todo = [(site, site_layers) for site, site_layers in todo if site_layers]
+    if not todo:
+        return []
+
+    product = PrecipitableWaterProduct(path, None, None, roi_size)
+    inside, _, _ = product.locateSites([site for site, _ in todo], roi_size)
+    if len(inside) == 0:
+        return []
+    todo = [todo[k] for k in inside]
+    grid = product.georef_grid1k
+    values = {}
+    # Each image shows the window locateSites would keep for its site alone: half 5k pixels around it
+    half = roi_size // 10 + 2
+    rows5k, cols5k, _ = GeoIndex(product.georef_grid).query([[site[1], site[2]] for site, _ in todo])
+    images = []
+    for k, (site, site_layers) in enumerate(todo):
+        rows = slice(max(5 * (rows5k[k] - half), 0), 5 * (rows5k[k] + half) + 1)
+        cols = slice(max(5 * (cols5k[k] - half), 0), 5 * (cols5k[k] + half) + 1)
+        for layer in site_layers:
+            key = (map_key(site, margin, resolution), layer)
+            if key not in _quicklooks:
+                _quicklooks[key] = QuickLook(site_map(site, margin, resolution, cache_dir), site, layer, dpi)
+            image = image_path(output_dir, site, path, layer)
+            if not os.path.isdir(os.path.dirname(image)):
+                os.makedirs(os.path.dirname(image))
+            if layer not in values:
+                values[layer] = getattr(product, LAYERS[layer][0])()
+            images.append(_quicklooks[key].render(grid[rows, cols, 1], grid[rows, cols, 0], values[layer][rows, cols],
+                                                  granule_name(path), image))
+    return images
+
+
+def render_task(task):
+    """ Run by the workers, like cloudmask.extract_task: returns (path, images, reason, metrics). """
+    path, arguments = task
+    with instrumentation.recording() as metrics:
+        try:
+            return (path, render_granule(path, *arguments), None, metrics.snapshot())
+        except Exception as e:
+            return (path, None, '{0}: {1}'.format(type(e).__name__, e), metrics.snapshot())
+
+
+def _start_worker(maps):
+    """ Pool initializer: headless backend, and the maps built by the parent. """
+    import matplotlib
+    matplotlib.use('Agg')
+    _maps.update(pickle.loads(maps))
+
+
+def render_batch(files, sites, layers = ('CM',), output_dir = 'quicklooks', roi_size = 200, margin = (1.0, 0.5),
+                 resolution = 'h', cache_dir = None, dpi = 100, processes = None,
+                 failures_file = 'quicklook_failures.csv', overwrite = False, metrics_file = None):
+    """ Render all the files with a pool of processes. The maps of the sites are built (or loaded
+        from cache_dir) here, once, and handed to the workers. The granules that could not be
+        rendered are written, with the reason, to failures_file. Returns the number of written
+        images and of failed granules.
+    """
+    maps = pickle.dumps(dict((map_key(site, margin, resolution), site_map(site, margin, resolution, cache_dir))
+                             for site in sites), pickle.HIGHEST_PROTOCOL)
+    arguments = (sites, list(layers), output_dir, roi_size, margin, resolution, None, dpi, overwrite)
+    n_images, n_failed = 0, 0
+    instrumentation.open_records(metrics_file)
+    pool = multiprocessing.Pool(processes, _start_worker, (maps,))
+    try:
+        with open(failures_file, 'w', newline='') as failures:
+            failures_writer = csv.writer(failures)
+            failures_writer.writerow(['granule', 'reason'])
+            for path, images, reason, metrics in pool.imap_unordered(render_task, [(path, arguments) for path in files]):
+                instrumentation.RUN.merge(metrics)
+                instrumentation.emit(dict(metrics, type='granule', granule=os.path.basename(path),
+                                          status='failed' if reason else 'ok', images=len(images or [])))
+                if reason is None:
+                    n_images += len(images)
+                else:
+                    failures_writer.writerow([path, reason])
+                    failures.flush()
+                    n_failed += 1
+    finally:
+        pool.close()
+        pool.join()
+        instrumentation.emit(dict(instrumentation.RUN.snapshot(), type='run', script='quicklook', granules=len(files),
+                                  images=n_images, failed=n_failed))
+        instrumentation.close_records()
+    return n_images, n_failed
+
+
+if __name__ == '__main__':
+    files = find_granules(mask_path, satellites, products, extension)
+    print('Rendering {0} files'.format(len(files)))
+    n_images, n_failed = render_batch(files, sites, layers, output_dir, roi_size, map_margin, resolution, map_cache_dir,
+                                      dpi, processes, failures_file, metrics_file=metrics_file)
+    print('Done: {0} images written, {1} granules failed (see {2})'.format(n_images, n_failed, failures_file))
@@ -0,0 +1,19 @@
+"""
+   Catalogue of the sites where the cloud mask is extracted. The catalogue is a CSV file with
+   the columns name, lat, lon and window (size of the box around the site, in 1k pixels), see
+   sites.csv for the sites used so far.
+"""
+import csv
+import os
+
+SITES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sites.csv')
+
+
+def read_sites(path = SITES_FILE, names = None):
+    """ List of (name, lat, lon, window) of the catalogue, restricted to names if given. """
+    sites = []
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            if names is None or row['name'] in names:
+                sites.append((row['name'], float(row['lat']), float(row['lon']), int(row['window'])))
+    return sites
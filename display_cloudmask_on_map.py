@@ -11,13 +11,17 @@ Created on Wed Oct 07 13:02:44 2015
 #/usr/bin ipython3
 
 """
-   This file is an example on how to use this modis framework. I provides various useful code snippets.
+   Displays the cloud mask of one granule around a location. The quality flag of the roi is read
+   once, the pixel closest to the location is found with geoIndex.GeoIndex, and the roi is drawn
+   on the cached map of quicklook.py, see PrecipitableWaterProduct.dispayOnMap. Use quicklook.py
+   to render many granules and sites at once.
 """
-from matplotlib.pyplot import imshow
-import numpy as np
-from utility import *
+import glob
+import os
+import sys
 
-# The three classes corresponding to the products.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_preparation'))
+from geoIndex import GeoIndex
 from PrecipitableWaterProduct import PrecipitableWaterProduct
 
 
@@ -27,9 +31,15 @@ roi_size = 50                     # km
 date = '2015-12-25'                  # Format YYYY-MM-DD. WARNING: if month or day is in one number, i.e 3, put 3, not 03.
 satellite = 'MYD'                   # Choices 'MYD' or 'MOD'
 product = '05'                      # Choices '35', 'O6' or '05'
+data_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '_data')    # See modisGrabber.data_root
+image_path = None                   # PNG file to write instead of opening a window
 
 
-path_to_file = findProductPath(date, satellite, product, indice=0)
+# Granules of the day, as downloaded by modisGrabber.py
+granules = sorted(glob.glob(os.path.join(data_root, 'data-' + date, satellite + product + '*.hdf')))
+if not granules:
+    raise IOError("No {0}{1} granule in {2}".format(satellite, product, os.path.join(data_root, 'data-' + date)))
+path_to_file = granules[0]
 print(path_to_file)
 # Remplace by the product you want to use. Once this stage is done, you have
 # created an object containing the file. You can now use the method associated with
@@ -41,12 +51,13 @@ precipitableWaterProduct = PrecipitableWaterProduct(path_to_file, location[0], l
 CM = precipitableWaterProduct.extractCloudMaskQA_QualityFlag()
 georef = precipitableWaterProduct.georef_grid1k
 
-grid_location = closest_point(georef, location)
+grid_location = GeoIndex(georef).closest_point(location)
 
 print("Center is: ", grid_location, 
       ", Value at center is: ", CM[grid_location[0], grid_location[1]])
       
-CM_subsample = CM[grid_location[0]-1: grid_location[0]+2,
-                    grid_location[1]-1: grid_location[1]+2 ]
+CM_subsample = CM[max(grid_location[0]-1, 0): grid_location[0]+2,
+                  max(grid_location[1]-1, 0): grid_location[1]+2 ]
+print("3x3 pixels around the center:\n", CM_subsample)
                     
-precipitableWaterProduct.dispayOnMap('CM_subsample')
+precipitableWaterProduct.dispayOnMap('CM', image_path)
@@ -0,0 +1,205 @@
+import csv
+import datetime
+import json
+import os
+
+import numpy as np
+
+from readCoverage import coverageFiles, readCoverageCached
+from nearest import nearest_batch
+
+
+
+# Columns of the match table. Tables written before the `satellite` column
+# existed can still be read, but not appended to. A row with an empty
+# timeImage retracts the earlier match of its observation.
+MATCH_HEADER = ["date", "timeMODIS", "timeImage", "cloudMaskForMODISTime", "coverageForMODISTime", "satellite"]
+
+
+
+def read_match_table(file_name):
+
+    # Reads the match table. A MODIS observation (satellite, timeMODIS) that
+    # was matched again appears several times, the last row is kept, and
+    # dropped if it retracts the match (empty timeImage). Tables without the
+    # satellite column were written in one go, all their rows are kept,
+    # keyed by ("", row number).
+    # Returns (header, {(satellite, timeMODIS): row}) in order of appearance.
+    rows = {}
+    if not os.path.isfile(file_name):
+        return (list(MATCH_HEADER), rows)
+
+    with open(file_name) as f:
+        input_file = csv.DictReader(f)
+        header = input_file.fieldnames or list(MATCH_HEADER)
+        for (number, row) in enumerate(input_file):
+            if "satellite" in header:
+                rows[(row["satellite"], row["timeMODIS"])] = row
+            else:
+                rows[("", number)] = row
+
+    return (header, dict((key, row) for (key, row) in rows.items() if row["timeImage"]))
+
+
+
+def _file_signature(file_path):
+
+    status = os.stat(file_path)
+    return [status.st_mtime_ns, status.st_size]
+
+
+
+def _time_range(datetime_COV):
+
+    # [first, last] timestamp of a coverage file in seconds, None if empty
+    if len(datetime_COV) == 0:
+        return None
+    return [int(datetime_COV.min().astype(np.int64)), int(datetime_COV.max().astype(np.int64))]
+
+
+
+def _overlapping(sorted_times, time_range, tolerance):
+
+    # Mask of the sorted MODIS times (in seconds) within tolerance of the range
+    if time_range is None:
+        return np.zeros(len(sorted_times), dtype=bool)
+    lo = np.searchsorted(sorted_times, time_range[0] - tolerance, side='left')
+    hi = np.searchsorted(sorted_times, time_range[1] + tolerance, side='right')
+    mask = np.zeros(len(sorted_times), dtype=bool)
+    mask[lo:hi] = True
+    return mask
+
+
+
+def _same_value(old, new):
+
+    # Whether the cloud mask value of a tried observation is unchanged
+    return old is not None and (old == new or (np.isnan(old) and np.isnan(new)))
+
+
+
+def update_match_table(file_name, satellite, modis_times, cmask_values, coverage_path, tolerance = 900):
+
+    # Incremental version of the notebook's matching step. The MODIS
+    # observations that were never tried (or whose cloud mask value
+    # changed), and all the observations tried before whose window (+/-
+    # tolerance seconds) overlaps a coverage file added, modified or removed
+    # since the last run for this satellite, are matched, against the
+    # coverage files overlapping their windows only. A row is appended when
+    # the observation is new or its match changed, and a retraction (empty
+    # timeImage, NaN coverage) when its match no longer exists. The
+    # signature and time range of each coverage file and the observations
+    # already tried, matched or not, with their cloud mask value, are kept in
+    # `file_name + '.state'`, so that a run costs in proportion to the new
+    # data, and the observations of earlier runs need not be passed again.
+    # Returns the number of appended rows.
+    (header, existing) = read_match_table(file_name)
+    if "satellite" not in header:
+        raise ValueError("%s has no satellite column, its MOD and MYD rows cannot be told apart: "
+                         "add the column (header %s) or start a new table" % (file_name, ",".join(MATCH_HEADER)))
+
+    state_file = file_name + ".state"
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {}
+
+    last_run = state.get(satellite, {})
+    if last_run.get("tolerance") != tolerance or not isinstance(last_run.get("tried"), dict):
+        last_run = {}
+    seen = last_run.get("coverage", {})
+    tried = last_run.get("tried", {})
+
+    # The observations passed and those of earlier runs, by time
+    given = np.asarray(modis_times, dtype='datetime64[s]')
+    given_strings = [str(t) for t in given.astype(datetime.datetime)]
+    given_values = np.asarray(cmask_values, dtype=np.float64)
+    observations = dict(tried)
+    observations.update(zip(given_strings, given_values.tolist()))
+    modis_strings = sorted(observations)
+    modis_times = np.array([t.replace(" ", "T") for t in modis_strings], dtype='datetime64[s]')
+    cmask_values = np.array([observations[t] for t in modis_strings], dtype=np.float64)
+    sorted_seconds = modis_times.astype(np.int64)
+
+    # Coverage files: (signature, time range); only the new or modified ones are read
+    files = [os.path.abspath(one_file) for one_file in coverageFiles(coverage_path)]
+    coverage = {}
+    dirty = np.zeros(len(modis_times), dtype=bool)
+    for one_file in files:
+        signature = _file_signature(one_file)
+        old = seen.get(one_file)
+        if old is not None and old[:2] == signature:
+            coverage[one_file] = old
+            continue
+        (datetime_COV,_) = readCoverageCached(one_file)
+        coverage[one_file] = signature + [_time_range(datetime_COV)]
+        dirty |= _overlapping(sorted_seconds, coverage[one_file][2], tolerance)
+        if old is not None:
+            dirty |= _overlapping(sorted_seconds, old[2], tolerance)
+    for one_file in set(seen) - set(coverage):
+        dirty |= _overlapping(sorted_seconds, seen[one_file][2], tolerance)     # Removed
+
+    dirty |= np.array([not _same_value(tried.get(t), observations[t]) for t in modis_strings], dtype=bool)
+    candidates = np.flatnonzero(dirty)
+
+    # Coverage of the files overlapping the windows of the candidates only
+    needed_seconds = sorted_seconds[candidates]
+    datetime_chunks = []
+    COV_chunks = []
+    for one_file in files:
+        if _overlapping(needed_seconds, coverage[one_file][2], tolerance).any():
+            (datetime_COV,COV_values) = readCoverageCached(one_file)
+            datetime_chunks.append(datetime_COV)
+            COV_chunks.append(COV_values)
+
+    within = np.zeros(len(candidates), dtype=bool)
+    if datetime_chunks:
+        datetime_series = np.concatenate(datetime_chunks)
+        COV_series = np.concatenate(COV_chunks)
+        (nearest_index, diff_ts, within) = nearest_batch(modis_times[candidates], datetime_series, tolerance)
+
+    new_rows = []
+    for (k, robin) in enumerate(candidates):
+        old = existing.get((satellite, modis_strings[robin]))
+        if not within[k]:
+            if old is not None:
+                new_rows.append({"date": modis_strings[robin],
+                                 "timeMODIS": modis_strings[robin],
+                                 "timeImage": "",
+                                 "cloudMaskForMODISTime": cmask_values[robin],
+                                 "coverageForMODISTime": np.nan,
+                                 "satellite": satellite})
+            continue
+
+        time_found = str(datetime_series[nearest_index[k]].astype(datetime.datetime))
+        coverage_item = COV_series[nearest_index[k]]
+        cmask_item = cmask_values[robin]
+        if (old is not None and old["timeImage"] == time_found and
+            np.isclose(float(old["coverageForMODISTime"]), coverage_item, atol = 1e-6) and
+            np.isclose(float(old["cloudMaskForMODISTime"]), cmask_item)):
+            continue
+
+        new_rows.append({"date": modis_strings[robin],
+                         "timeMODIS": modis_strings[robin],
+                         "timeImage": time_found,
+                         "cloudMaskForMODISTime": cmask_item,
+                         "coverageForMODISTime": coverage_item,
+                         "satellite": satellite})
+
+    if new_rows:
+        write_header = not os.path.isfile(file_name)
+        with open(file_name, "a") as text_file:
+            writer = csv.DictWriter(text_file, fieldnames = header, extrasaction = "ignore", lineterminator = "\n")
+            if write_header:
+                writer.writeheader()
+            writer.writerows(new_rows)
+
+    # The state is written last: after an interruption the same rows are
+    # matched again, and appended again only if they differ.
+    state[satellite] = {"tolerance": tolerance, "coverage": coverage, "tried": observations}
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_file + ".tmp", state_file)
+
+    return len(new_rows)
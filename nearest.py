@@ -13,8 +13,196 @@ def nearest(ts,s):
 	
 	
 	
+def nearest_batch(query_times, times, tolerance = None):
+
+	# Vectorized `nearest` for many timestamps at once. Both inputs are
+	# converted to datetime64[s] and may be unsorted; among duplicate
+	# timestamps the first occurrence in `times` is returned.
+	# Returns the index into `times` of the nearest timestamp, the signed
+	# difference (found - queried) in seconds and the mask of queries with
+	# abs(difference) < tolerance (in seconds, all True if no tolerance).
+	query_times = np.asarray(query_times, dtype='datetime64[s]')
+	times = np.asarray(times, dtype='datetime64[s]')
+	if times.size == 0:
+		raise ValueError("No timestamps to search in")
+
+	order = np.argsort(times, kind='mergesort')
+	s = times[order]
+
+	i = np.searchsorted(s, query_times)
+	before = np.clip(i - 1, 0, len(s) - 1)
+	after = np.clip(i, 0, len(s) - 1)
+	diff_before = (s[before] - query_times).astype(np.int64)
+	diff_after = (s[after] - query_times).astype(np.int64)
+
+	# Ties go to the earlier timestamp, like `nearest`
+	position = np.where(np.abs(diff_after) < np.abs(diff_before), after, before)
+	diff_timestamps = np.where(position == after, diff_after, diff_before)
+
+	# First occurrence of the found timestamp among duplicates
+	position = np.searchsorted(s, s[position])
+	nearest_index = order[position]
+
+	if tolerance is None:
+		within = np.ones(diff_timestamps.shape, dtype=bool)
+	else:
+		within = np.abs(diff_timestamps) < tolerance
+	return (nearest_index, diff_timestamps, within)
+
+
+
+def _window_medians(v, lo, hi, chunk_size):
+
+	# Medians of the non-empty windows v[lo[k]:hi[k]]. Long windows are
+	# partitioned one at a time, the short ones gathered and sorted together,
+	# about chunk_size values per chunk, so that memory does not grow with
+	# the total length of the windows.
+	count = hi - lo
+	median = np.empty(len(lo))
+	for k in np.flatnonzero(count > 1024):
+		median[k] = np.median(v[lo[k]:hi[k]])
+	short = np.flatnonzero(count <= 1024)
+	ends = np.cumsum(count[short])
+	start = 0
+	while start < len(short):
+		stop = max(np.searchsorted(ends, ends[start] - count[short[start]] + chunk_size, side='right'), start + 1)
+		k = short[start:stop]
+		c = count[k]
+		first = ends[start:stop] - c - (ends[start] - c[0])
+		segment = np.repeat(np.arange(len(c)), c)
+		gathered = v[np.arange(len(segment)) - first[segment] + lo[k][segment]]
+		gathered = gathered[np.lexsort((gathered, segment))]
+		median[k] = (gathered[first + (c - 1) // 2] + gathered[first + c // 2]) / 2.
+		start = stop
+	return median
+
+
+
+def window_statistics(query_times, times, values, widths, chunk_size = 1 << 20):
+
+	# Statistics of all `values` whose timestamp lies within +/- W seconds of
+	# each query, for every W in `widths`. Count, mean and (population) std
+	# come from cumulative sums over the sorted series, min and max from one
+	# reduceat over the window bounds, the median window by window or, for
+	# short windows, chunk_size values at a time: memory is O(N + M) for N
+	# values and M queries, whatever the widths. Empty windows give a count of 0 and NaN
+	# elsewhere.
+	# Returns {W: {'count', 'mean', 'median', 'min', 'max', 'std'}}.
+	query_times = np.asarray(query_times, dtype='datetime64[s]')
+	times = np.asarray(times, dtype='datetime64[s]')
+	values = np.asarray(values, dtype=np.float64)
+	if times.size == 0:
+		raise ValueError("No timestamps to search in")
+	if np.ndim(widths) == 0:
+		widths = [widths]
+
+	order = np.argsort(times, kind='mergesort')
+	s = times[order]
+	v = values[order]
+
+	# Centred values keep the cumulative sums accurate over long series
+	offset = v.mean()
+	csum = np.concatenate([[0.], np.cumsum(v - offset)])
+	csum2 = np.concatenate([[0.], np.cumsum((v - offset) ** 2)])
+	# Sorted queries have increasing window bounds, reduceat then only runs
+	# over the windows and the gaps between them. The NaN ends the last window.
+	query_order = np.argsort(query_times, kind='mergesort')
+	sorted_queries = query_times[query_order]
+	padded = np.append(v, np.nan)
+
+	statistics = {}
+	for W in widths:
+		delta = np.timedelta64(int(W), 's')
+		lo = np.searchsorted(s, sorted_queries - delta, side='left')
+		hi = np.searchsorted(s, sorted_queries + delta, side='right')
+		count = hi - lo
+		empty = count == 0
+
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean = (csum[hi] - csum[lo]) / count
+			std = np.sqrt(np.maximum((csum2[hi] - csum2[lo]) / count - mean * mean, 0.))
+			mean += offset
+
+		bounds = np.column_stack([lo, hi]).ravel()
+		w_min = np.minimum.reduceat(padded, bounds)[::2] if len(bounds) else np.empty(0)
+		w_max = np.maximum.reduceat(padded, bounds)[::2] if len(bounds) else np.empty(0)
+		w_median = np.full(len(lo), np.nan)
+		w_median[~empty] = _window_medians(v, lo[~empty], hi[~empty], chunk_size)
+		# Constant windows (e.g. a single value) are exactly 0, not the rounding of the sums
+		std[w_min == w_max] = 0.
+		for item in (mean, std, w_min, w_max):
+			item[empty] = np.nan
+
+		result = {'count': count, 'mean': mean, 'median': w_median, 'min': w_min, 'max': w_max, 'std': std}
+		for name, item in result.items():
+			unsorted = np.empty_like(item)
+			unsorted[query_order] = item
+			result[name] = unsorted
+		statistics[W] = result
+	return statistics
+
+
+
 def find_nearest_rainevent(time1_index, rain_array):
 
-	rain_points = np.where(rain_array!= 0)[0]
-	time2_index = np.argmin(numpy.abs(rain_points - time1_index))
+	# Index in rain_array of the rain event (non-zero value) nearest to
+	# time1_index, the earlier one on ties. See nearest_events for many queries.
+	rain_points = np.flatnonzero(rain_array)
+	time2_index = rain_points[np.argmin(np.abs(rain_points - time1_index))]
 	return (time2_index)
+
+
+
+def nearest_events(queries, event_series, times = None, direction = 'either', tolerance = None):
+
+	# Batch `find_nearest_rainevent`: the event (non-zero value of
+	# `event_series`, e.g. rain gauge readings) nearest to every query, with
+	# one searchsorted over the event positions. Queries are indices into the
+	# series, or timestamps if the `times` of its samples are given (they may
+	# be unsorted). direction is 'before' (last event at or before the
+	# query), 'after' (first event at or after it) or 'either' (the nearest,
+	# ties go to the earlier one, like `nearest`).
+	# Returns the index of the event in `event_series`, the signed distance
+	# (event - query, in samples or seconds) and the mask of the queries that
+	# have an event in that direction, closer than `tolerance` if given.
+	# Queries without an event in that direction get index -1 and distance 0.
+	if direction not in ('before', 'after', 'either'):
+		raise ValueError("direction must be 'before', 'after' or 'either', not %r" % (direction,))
+
+	positions = np.flatnonzero(np.asarray(event_series))
+	if times is None:
+		keys = positions.astype(np.int64)
+		query_keys = np.asarray(queries, dtype=np.int64)
+	else:
+		event_times = np.asarray(times, dtype='datetime64[s]')[positions]
+		order = np.argsort(event_times, kind='mergesort')
+		positions = positions[order]
+		keys = event_times[order].astype(np.int64)
+		query_keys = np.asarray(queries, dtype='datetime64[s]').astype(np.int64)
+
+	if len(keys) == 0:
+		return (np.full(query_keys.shape, -1, dtype=np.int64), np.zeros(query_keys.shape, dtype=np.int64),
+		        np.zeros(query_keys.shape, dtype=bool))
+
+	after = np.searchsorted(keys, query_keys, side='left')
+	before = np.searchsorted(keys, query_keys, side='right') - 1
+	has_after = after < len(keys)
+	has_before = before >= 0
+	diff_after = keys[np.minimum(after, len(keys) - 1)] - query_keys
+	diff_before = keys[np.maximum(before, 0)] - query_keys
+
+	if direction == 'before':
+		use_after = np.zeros(query_keys.shape, dtype=bool)
+		found = has_before
+	elif direction == 'after':
+		use_after = np.ones(query_keys.shape, dtype=bool)
+		found = has_after
+	else:
+		use_after = has_after & (~has_before | (np.abs(diff_after) < np.abs(diff_before)))
+		found = has_after | has_before
+
+	event = np.clip(np.where(use_after, after, before), 0, len(keys) - 1)
+	event_index = np.where(found, positions[event], -1)
+	diff_events = np.where(found, np.where(use_after, diff_after, diff_before), 0)
+	within = found if tolerance is None else found & (np.abs(diff_events) < tolerance)
+	return (event_index, diff_events, within)
@@ -1,17 +1,72 @@
 import numpy as np
 
-def normalize_array( a ):
-	
-	min_value = np.amin(a)
-	max_value = np.amax(a)
-	
-	norm_array = [None]*len(a)
-	
-	#print (a)
-	
-	for i in range(0,len(a)):
-		
-		norm_array[i] = (a[i]-min_value)/(max_value - min_value)
-	
-	#print (norm_array)
-	return(norm_array)
+
+
+def _axes(axis, ndim):
+
+	# Axes reduced by `axis`: all of them for None, an int or a tuple of ints
+	if axis is None:
+		return tuple(range(ndim))
+	return tuple(sorted(set(int(ax) % ndim for ax in np.atleast_1d(axis))))
+
+
+
+def _scale(a, min_value, max_value, out, constant):
+
+	# out = (a - min) / (max - min), written in place; slices with max == min
+	# are set to `constant` instead of dividing by zero.
+	span = max_value - min_value
+	flat = span == 0
+	np.subtract(a, min_value, out=out)
+	np.divide(out, np.where(flat, 1, span), out=out)
+	if np.any(flat):
+		np.copyto(out, constant, where=np.broadcast_to(flat, out.shape))
+	return out
+
+
+
+def normalize_array( a, axis = None, out = None, constant = 0., chunk_size = None ):
+
+	# Scales a into [0, 1]: (a - min) / (max - min), with min and max over the
+	# whole array, or per slice along `axis` (an int or a tuple). Works on N-D
+	# arrays without a Python loop and returns an array: float32 for float32 or
+	# small integer inputs, float64 otherwise, or the dtype of `out`.
+	#   out:        array to write the result to, e.g. `a` itself (in place,
+	#               if float) or a np.memmap
+	#   constant:   value of constant inputs (max == min), instead of NaN
+	#   chunk_size: two-pass mode for memory-mapped inputs larger than memory:
+	#               min and max are computed chunk_size rows (first axis) at a
+	#               time, then each chunk is scaled into `out`. Pass a memmap as
+	#               `out`, otherwise the result is allocated in memory.
+	a = np.asanyarray(a)
+	if out is None:
+		out = np.empty(a.shape, dtype=np.result_type(a.dtype, np.float32))
+	elif out.shape != a.shape:
+		raise ValueError("out has shape %s, expected %s" % (out.shape, a.shape))
+	if a.size == 0:
+		return out
+	axes = _axes(axis, a.ndim)
+
+	if chunk_size is None:
+		return _scale(a, np.amin(a, axis=axes, keepdims=True), np.amax(a, axis=axes, keepdims=True), out, constant)
+
+	chunks = [slice(start, start + chunk_size) for start in range(0, a.shape[0], chunk_size)]
+	if 0 not in axes:
+		# Rows are normalized independently, one pass per chunk
+		for rows in chunks:
+			_scale(a[rows], np.amin(a[rows], axis=axes, keepdims=True), np.amax(a[rows], axis=axes, keepdims=True),
+			       out[rows], constant)
+		return out
+
+	# First pass: min and max, over the first axis across the chunks
+	min_value = max_value = None
+	for rows in chunks:
+		chunk = a[rows]
+		chunk_min = np.amin(chunk, axis=axes, keepdims=True)
+		chunk_max = np.amax(chunk, axis=axes, keepdims=True)
+		min_value = chunk_min if min_value is None else np.minimum(min_value, chunk_min)
+		max_value = chunk_max if max_value is None else np.maximum(max_value, chunk_max)
+	# Second pass: scale
+	for rows in chunks:
+		_scale(a[rows], min_value, max_value, out[rows], constant)
+	return out
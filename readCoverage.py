@@ -1,5 +1,11 @@
 import csv
 import datetime
+from glob import glob
+import hashlib
+import io
+import os
+
+import numpy as np
 
 
 
@@ -49,4 +55,186 @@ def readingCOVERAGE(file_path):
             COV_values.append(COV_item)
     
 
-    return (datetime_COV,COV_values)
\ No newline at end of file
+    return (datetime_COV,COV_values)
+
+
+def coverageFiles(path, pattern = "*.txt"):
+    
+    # Resolves a directory (searched recursively for `pattern`), a glob
+    # expression, a single file or a list of files into a sorted file list.
+    if isinstance(path, (list, tuple)):
+        return sorted(path)
+    if os.path.isdir(path):
+        files = []
+        for direc,_,_ in os.walk(path):
+            files.extend(glob(os.path.join(direc,pattern)))
+        return sorted(files)
+    return sorted(glob(path))
+
+
+
+def readCoverageArrays(file_path):
+    
+    # Vectorized version of readingCOVERAGE for one file. Returns the
+    # timestamps as datetime64[s] and the coverage values as float32.
+    with open(file_path) as f:
+        f.readline()    # Header: Image, Date, Time, Cloud_Coverage
+        body = f.read()
+    
+    if not body.strip():
+        return (np.empty(0, dtype='datetime64[s]'), np.empty(0, dtype=np.float32))
+    
+    # Date and time fields are colon separated, turning the colons into commas
+    # lets numpy parse YEAR, MON, DAY, HH, MINT, SEC and coverage in one go.
+    columns = np.loadtxt(io.StringIO(body.replace(":", ",")), delimiter = ",",
+                         usecols = range(1, 8), ndmin = 2)
+    fields = columns[:, :6].astype(np.int64)
+    
+    months = (fields[:, 0] - 1970) * 12 + fields[:, 1] - 1
+    datetime_COV = (months.astype('datetime64[M]').astype('datetime64[D]')
+                    + (fields[:, 2] - 1).astype('timedelta64[D]')).astype('datetime64[s]')
+    datetime_COV += (fields[:, 3]*3600 + fields[:, 4]*60 + fields[:, 5]).astype('timedelta64[s]')
+    
+    COV_values = columns[:, 6].astype(np.float32)
+    
+    return (datetime_COV,COV_values)
+
+
+
+def readingCOVERAGE_bulk(path, pattern = "*.txt"):
+    
+    # Reads every coverage file of a directory (or glob) into two columnar
+    # arrays. The per-file chunks are collected and concatenated once at the
+    # end, instead of growing the series file by file.
+    datetime_chunks = []
+    COV_chunks = []
+    
+    for one_file in coverageFiles(path, pattern):
+        (datetime_COV,COV_values) = readCoverageArrays(one_file)
+        datetime_chunks.append(datetime_COV)
+        COV_chunks.append(COV_values)
+    
+    if not datetime_chunks:
+        return (np.empty(0, dtype='datetime64[s]'), np.empty(0, dtype=np.float32))
+    
+    return (np.concatenate(datetime_chunks), np.concatenate(COV_chunks))
+
+
+
+# Folder, next to the coverage files, holding the parsed columns as .npy files
+COVERAGE_CACHE_DIR = ".coverage_cache"
+
+
+
+def _hash(text):
+    
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+
+def _fileStamp(file_path):
+    
+    status = os.stat(file_path)
+    return "%d %d" % (status.st_mtime_ns, status.st_size)
+
+
+
+def readCoverageCached(file_path, cache_dir = None):
+    
+    # Same as readCoverageArrays, but the parsed columns are kept in a binary
+    # cache and memory-mapped on later calls. A cache entry is only valid for
+    # the modification time and size of the text file it was parsed from.
+    # In a cache_dir shared by several folders, the entries are keyed by a
+    # hash of the absolute path, as the same file names recur in each folder.
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(file_path), COVERAGE_CACHE_DIR)
+        base_name = os.path.join(cache_dir, os.path.basename(file_path))
+    else:
+        base_name = os.path.join(cache_dir, "%s.%s" % (os.path.basename(file_path),
+                                                       _hash(os.path.abspath(file_path))))
+    time_file = base_name + ".time.npy"
+    cov_file = base_name + ".cov.npy"
+    stamp_file = base_name + ".stamp"
+    
+    stamp = _fileStamp(file_path)
+    
+    try:
+        with open(stamp_file) as f:
+            if f.read() == stamp:
+                return (np.load(time_file, mmap_mode = "r"), np.load(cov_file, mmap_mode = "r"))
+    except (IOError, ValueError):
+        pass    # Missing or damaged cache entry, parse the file again
+    
+    (datetime_COV,COV_values) = readCoverageArrays(file_path)
+    
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # The stamp is written last, so an interrupted write leaves an invalid entry
+    np.save(time_file, datetime_COV)
+    np.save(cov_file, COV_values)
+    with open(stamp_file + ".tmp", "w") as f:
+        f.write(stamp)
+    os.replace(stamp_file + ".tmp", stamp_file)
+    
+    return (datetime_COV,COV_values)
+
+
+
+def readingCOVERAGE_cached(path, pattern = "*.txt", cache_dir = None):
+    
+    # Cached counterpart of readingCOVERAGE_bulk: only new or modified files
+    # are parsed, the others are read back from the .npy cache. The series of
+    # all the files is kept as one more cache entry, named after the stamps of
+    # the files, and returned memory-mapped: it is copied from the per-file
+    # entries one file at a time, so the archive is never held in memory.
+    files = coverageFiles(path, pattern)
+    if not files:
+        return (np.empty(0, dtype='datetime64[s]'), np.empty(0, dtype=np.float32))
+    
+    all_dir = cache_dir
+    if all_dir is None:
+        folder = path if isinstance(path, str) and os.path.isdir(path) else os.path.dirname(files[0])
+        all_dir = os.path.join(folder, COVERAGE_CACHE_DIR)
+    query = _hash(repr([os.path.abspath(one_file) for one_file in files] if isinstance(path, (list, tuple))
+                       else (os.path.abspath(path), pattern)))
+    stamps = "\n".join("%s %s" % (os.path.abspath(one_file), _fileStamp(one_file)) for one_file in files)
+    base_name = os.path.join(all_dir, "all-%s-%s" % (query, _hash(stamps)))
+    time_file = base_name + ".time.npy"
+    cov_file = base_name + ".cov.npy"
+    
+    try:
+        return (np.load(time_file, mmap_mode = "r"), np.load(cov_file, mmap_mode = "r"))
+    except (IOError, ValueError):
+        pass    # Files added or modified since, or first call
+    
+    # First pass: the per-file entries, built if needed, and their lengths.
+    # Second pass: their mmaps copied one after the other.
+    total = sum(len(readCoverageCached(one_file, cache_dir)[0]) for one_file in files)
+    if total == 0:
+        return (np.empty(0, dtype='datetime64[s]'), np.empty(0, dtype=np.float32))
+    
+    if not os.path.isdir(all_dir):
+        os.makedirs(all_dir)
+    # Written under temporary names, the coverage column last: an interrupted
+    # write leaves no entry. Older entries of the same files are then removed.
+    datetime_out = np.lib.format.open_memmap(time_file + ".tmp", mode = "w+", dtype = 'datetime64[s]', shape = (total,))
+    COV_out = np.lib.format.open_memmap(cov_file + ".tmp", mode = "w+", dtype = np.float32, shape = (total,))
+    start = 0
+    for one_file in files:
+        (datetime_COV,COV_values) = readCoverageCached(one_file, cache_dir)
+        datetime_out[start:start + len(datetime_COV)] = datetime_COV
+        COV_out[start:start + len(datetime_COV)] = COV_values
+        start += len(datetime_COV)
+    datetime_out.flush()
+    COV_out.flush()
+    del datetime_out, COV_out
+    os.replace(time_file + ".tmp", time_file)
+    os.replace(cov_file + ".tmp", cov_file)
+    for old_file in glob(os.path.join(all_dir, "all-%s-*.npy" % query)):
+        if not old_file.startswith(base_name):
+            try:
+                os.remove(old_file)
+            except OSError:
+                pass    # Still mapped by a reader (Windows), removed next time
+    
+    return (np.load(time_file, mmap_mode = "r"), np.load(cov_file, mmap_mode = "r"))
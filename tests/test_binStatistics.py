@@ -0,0 +1,94 @@
+"""
+   The binned statistics of binStatistics.py, against numpy and scipy bin by bin.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from binStatistics import StreamingBinStatistics, assign_bins, bin_statistics
+
+EDGES = np.linspace(0, 100, 11)
+
+
+def random_pairs(rng, n):
+    x = rng.uniform(-10, 110, n)
+    x[:20] = rng.choice(EDGES, 20)
+    x[20:25] = np.nan
+    # Rounded: ties in y, for the quantiles and the ranks
+    y = np.round(np.clip(x / 100 + rng.normal(0, 0.2, n), 0, 1), 2)
+    y[25:30] = np.nan
+    return x, y
+
+
+def brute_force_bin(x, edges, clip):
+    """ Bin of each x, one value at a time, -1 if it is not binned. """
+    bins = []
+    for value in x:
+        inside = [k for k in range(len(edges) - 1) if edges[k] <= value < edges[k + 1] or
+                  (k == len(edges) - 2 and value == edges[-1])]
+        if inside:
+            bins.append(inside[0])
+        elif clip and value < edges[0]:
+            bins.append(0)
+        elif clip and value > edges[-1]:
+            bins.append(len(edges) - 2)
+        else:
+            bins.append(-1)
+    return np.array(bins)
+
+
+def test_assign_bins():
+    x, _ = random_pairs(np.random.default_rng(0), 500)
+    x = x[~np.isnan(x)]
+    assert np.array_equal(assign_bins(x, EDGES), brute_force_bin(x, EDGES, True))
+    assert np.array_equal(assign_bins(x, EDGES, clip=False), brute_force_bin(x, EDGES, False))
+
+
+@pytest.mark.parametrize('clip', [True, False])
+def test_bin_statistics_match_numpy(clip):
+    stats = pytest.importorskip('scipy.stats')
+    x, y = random_pairs(np.random.default_rng(1), 2000)
+    result = bin_statistics(x, y, EDGES, quantiles=(0.05, 0.95), clip=clip)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    x, y = x[valid], y[valid]
+    bins = brute_force_bin(x, EDGES, clip)
+    for k in range(len(EDGES) - 1):
+        values, x_values = y[bins == k], x[bins == k]
+        assert result['count'][k] == len(values)
+        assert np.isclose(result['mean'][k], values.mean()) and np.isclose(result['std'][k], values.std())
+        assert np.isclose(result['pearson'][k], np.corrcoef(x_values, values)[0, 1])
+        q1, median, q3, q05, q95 = np.quantile(values, [0.25, 0.5, 0.75, 0.05, 0.95])
+        assert np.allclose([result['q1'][k], result['median'][k], result['q3'][k]], [q1, median, q3])
+        assert np.allclose(result['quantile_values'][k], [q05, q95])
+        assert result['min'][k] == values.min() and result['max'][k] == values.max()
+        # Whiskers of plt.boxplot: the most extreme values within 1.5 IQR of the quartiles
+        iqr = q3 - q1
+        whishi = max(values[values <= q3 + 1.5 * iqr].max(initial=-np.inf), q3)
+        whislo = min(values[values >= q1 - 1.5 * iqr].min(initial=np.inf), q1)
+        assert np.isclose(result['whishi'][k], whishi) and np.isclose(result['whislo'][k], whislo)
+        assert sorted(result['fliers'][k]) == sorted(values[(values < whislo) | (values > whishi)])
+
+    binned = bins >= 0
+    assert result['correlation']['count'] == binned.sum()
+    assert np.isclose(result['correlation']['pearson'], np.corrcoef(x[binned], y[binned])[0, 1])
+    assert np.isclose(result['correlation']['spearman'], stats.spearmanr(x[binned], y[binned])[0])
+
+
+def test_streaming_statistics():
+    rng = np.random.default_rng(2)
+    x, y = random_pairs(rng, 3000)
+    expected = bin_statistics(x, y, EDGES)
+    streaming = StreamingBinStatistics(EDGES, resolution=1000)
+    for chunk in np.array_split(np.arange(len(x)), 7):
+        streaming.update(x[chunk], y[chunk])
+    result = streaming.result()
+    # Moments exact, quantiles within one bucket of the histogram
+    assert np.array_equal(result['count'], expected['count'])
+    for name in ('mean', 'std', 'pearson', 'min', 'max'):
+        assert np.allclose(result[name], expected[name]), name
+    for name in ('q1', 'median', 'q3'):
+        assert np.all(np.abs(result[name] - expected[name]) <= 1e-3), name
+    assert np.isclose(result['correlation']['pearson'], expected['correlation']['pearson'])
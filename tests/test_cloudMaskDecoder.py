@@ -0,0 +1,50 @@
+"""
+   The bitwise decoding of cloudMaskDecoder.py, against the bits of each byte taken one by one.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_preparation'))
+from cloudMaskDecoder import CLOUD_MASK_FIELDS, CLOUD_MASK_QA_FIELDS, decode_bit_fields
+
+
+def field_value(byte_value, first_bit, n_bits):
+    """ Value of the field, bit by bit, from the bits of the byte listed least significant first. """
+    bits = [(int(byte_value) >> bit) & 1 for bit in range(8)]
+    return sum(bits[first_bit + k] << k for k in range(n_bits))
+
+
+def test_cloud_mask_qa_bytes():
+    # Signed bytes, as the Cloud_Mask_QA of MOD05 is read by GDAL
+    packed = np.arange(-128, 128, dtype=np.int8).reshape(16, 16)
+    decoded = decode_bit_fields(packed)
+    assert sorted(decoded.dtype.names) == sorted(CLOUD_MASK_QA_FIELDS)
+    for (row, col), value in np.ndenumerate(packed.view(np.uint8)):
+        for name in CLOUD_MASK_QA_FIELDS:
+            _, first_bit, n_bits = CLOUD_MASK_FIELDS[name]
+            assert decoded[name][row, col] == field_value(value, first_bit, n_bits)
+
+
+def test_bytes_along_an_axis():
+    rng = np.random.default_rng(0)
+    # Cloud_Mask: 6 bytes first
+    packed = rng.integers(0, 256, (6, 20, 30), dtype=np.uint8)
+    decoded = decode_bit_fields(packed, byte_axis=0)
+    assert decoded.shape == (20, 30) and sorted(decoded.dtype.names) == sorted(CLOUD_MASK_FIELDS)
+    for name, (byte, first_bit, n_bits) in CLOUD_MASK_FIELDS.items():
+        expected = [[field_value(packed[byte, row, col], first_bit, n_bits) for col in range(30)] for row in range(20)]
+        assert np.array_equal(decoded[name], expected)
+
+    # Quality_Assurance: 10 bytes last, with fields of its own
+    packed = rng.integers(0, 256, (20, 30, 10), dtype=np.uint8)
+    fields = {'usefulness': (0, 1, 3), 'confidence': (0, 4, 3), 'last_byte': (9, 0, 8)}
+    decoded = decode_bit_fields(packed, fields, byte_axis=-1)
+    for name, (byte, first_bit, n_bits) in fields.items():
+        expected = [[field_value(packed[row, col, byte], first_bit, n_bits) for col in range(30)] for row in range(20)]
+        assert np.array_equal(decoded[name], expected)
+
+    with pytest.raises(ValueError):
+        decode_bit_fields(packed[..., :1], ['shadow'], byte_axis=-1)
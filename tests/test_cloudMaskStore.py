@@ -0,0 +1,87 @@
+"""
+   The cloud mask store of cloudMaskStore.py.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_preparation'))
+from cloudMaskStore import CloudMaskStore, import_mat
+
+
+def test_import_mat_stores_utc(tmp_path):
+    sio = pytest.importorskip('scipy.io')
+    mat_file = str(tmp_path / 'CloudMask_2015_MOD.mat')
+    # Day of year, hour, minute (Singapore time), average, centre
+    sio.savemat(mat_file, {'DATA': np.array([[2, 10, 30, 4 / 9., 1], [3, 11, 5, 0, 0]])})
+    store = CloudMaskStore(str(tmp_path / 'store'))
+    assert import_mat(store, mat_file, 'MOD', 'Singapore', 2015) == 2
+
+    rows = store.load()
+    assert list(rows['time']) == [np.datetime64('2015-01-02T02:30:00'), np.datetime64('2015-01-03T03:05:00')]
+    assert np.allclose(rows['mean'], [4 / 9., 0]) and list(rows['centre']) == [1, 0]
+    assert np.isnan(rows['window']).all()
+
+    store = CloudMaskStore(str(tmp_path / 'store-utc'))
+    import_mat(store, mat_file, 'MOD', 'Singapore', 2015, utc_offset=0)
+    assert store.load()['time'][0] == np.datetime64('2015-01-02T10:30:00')
+
+
+def random_rows(rng, n, window_size):
+    sites = np.array(['Singapore', 'Wuhan', 'Japan', 'Beijing'])
+    windows = rng.choice([0, 64, 128, 192], (n, window_size, window_size)).astype(np.float32)
+    windows[rng.uniform(size=windows.shape) < 0.1] = np.nan
+    times = np.datetime64('2015-01-01T00:00:00') + rng.integers(0, 365 * 86400, n).astype('timedelta64[s]')
+    return rng.choice(['MOD', 'MYD'], n), rng.choice(sites, n), times, windows
+
+
+def value(x):
+    return None if np.isnan(x) else float(x)
+
+
+def as_rows(table):
+    """ Rows as comparable tuples: the window as bytes and NaN as None, so that they compare equal. """
+    return sorted(zip(table['satellite'].tolist(), table['site'].tolist(), table['time'].tolist(),
+                      [window.tobytes() for window in table['window']],
+                      [value(x) for x in table['mean']], [value(x) for x in table['centre']]))
+
+
+def brute_force(rows, start, end, sites, satellites):
+    return sorted(row for row in rows if (start is None or row[2] >= start) and (end is None or row[2] < end) and
+                  (sites is None or row[1] in sites) and (satellites is None or row[0] in satellites))
+
+
+def test_load_matches_brute_force(tmp_path):
+    rng = np.random.default_rng(0)
+    store = CloudMaskStore(str(tmp_path / 'store'), window_size=5, max_parts=4, part_rows=100)
+    rows = []
+    for n in rng.integers(0, 60, 12):
+        satellite, site, time, windows = random_rows(rng, n, 5)
+        assert store.append(satellite, site, time, windows) == n
+        for k in range(n):
+            # mean and centre: the share of cloudy pixels of the window and its centre, NaN excluded
+            finite = windows[k][np.isfinite(windows[k])]
+            mean = float(np.float32(np.sum(finite == 0) / len(finite))) if len(finite) else None
+            centre = float(windows[k][2, 2] == 0) if np.isfinite(windows[k][2, 2]) else None
+            rows.append((str(satellite[k]), str(site[k]), time[k].astype(object), windows[k].tobytes(), mean, centre))
+    # Merged automatically past max_parts
+    assert len(store.parts()) <= 5 and len(store) == len(rows)
+
+    queries = [(None, None, None, None), (None, None, 'Wuhan', None), (None, None, None, 'MYD')]
+    for _ in range(20):
+        start, end = np.sort(np.datetime64('2015-01-01T00:00:00') + rng.integers(0, 365 * 86400, 2).astype('timedelta64[s]'))
+        queries.append((start.astype(object), end.astype(object), list(rng.choice(['Singapore', 'Wuhan', 'Paris'], 2)),
+                        list(rng.choice(['MOD', 'MYD'], rng.integers(1, 3)))))
+    for start, end, sites, satellites in queries:
+        expected = brute_force(rows, start, end, [sites] if isinstance(sites, str) else sites,
+                               [satellites] if isinstance(satellites, str) else satellites)
+        table = store.load(start, end, sites, satellites)
+        assert as_rows(table) == expected, (start, end, sites, satellites)
+        assert np.all(np.lexsort((table['time'], table['site'])) == np.arange(len(table['time'])))
+
+    # Same rows after a full compaction, and from the store opened again
+    store.compact()
+    assert len(store.parts()) == 1
+    assert as_rows(CloudMaskStore(str(tmp_path / 'store')).load()) == sorted(rows)
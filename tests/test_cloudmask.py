@@ -0,0 +1,28 @@
+"""
+   The batch extraction of cloudmask.py: the store it writes to.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_preparation'))
+pytest.importorskip('gdal')
+from cloudMaskStore import CloudMaskStore
+from cloudmask import append_block, open_store
+
+SITES = [('Singapore', 1.34, 103.68, 5), ('Wuhan', 30.53, 114.36, 3)]
+
+
+def test_open_store_checks_the_window(tmp_path):
+    store_path = str(tmp_path / 'store')
+    store = open_store(store_path, SITES)
+    assert store.window_size == 5
+    append_block(store, [('MOD', 'Wuhan', np.datetime64('2015-01-02T03:00:00'), np.zeros((3, 3)))])
+    assert np.isnan(CloudMaskStore(store_path).load()['window'][0, 0]).all()
+
+    # Smaller boxes fit, padded; larger ones are refused before anything is extracted
+    assert open_store(store_path, SITES[1:]).window_size == 5
+    with pytest.raises(ValueError):
+        open_store(store_path, SITES + [('Beijing', 39.9, 116.4, 11)])
@@ -0,0 +1,80 @@
+"""
+   Closest pixel searches of geoIndex.py, against a brute force search over the whole grid.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_preparation'))
+pytest.importorskip('scipy')
+from geoIndex import EARTH_RADIUS_KM, GeoIndex, refine_closest_point
+
+
+def swath_grid(rows = 406, cols = 270):
+    """ 5 km grid whose pixels grow to about 2 x 5 km along the scan towards the swath edges. """
+    r, c = np.mgrid[0:rows, 0:cols].astype(np.float64)
+    x = (c - cols / 2.) / (cols / 2.)
+    along_scan = 0.045 * (cols / 2.) * (x + x ** 3 / 3.)        # Spacing 0.045 (1 + x^2) degrees
+    return np.dstack((-8 + 0.045 * r + 0.01 * x ** 2, 103.7 + along_scan + 0.002 * r))
+
+
+def brute_force(grid, point):
+    lat, lon = np.radians(grid[..., 0]), np.radians(grid[..., 1])
+    plat, plon = np.radians(point)
+    distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.sin((lat - plat) / 2) ** 2 +
+                                                       np.cos(lat) * np.cos(plat) * np.sin((lon - plon) / 2) ** 2))
+    k = np.argmin(distance)
+    return np.unravel_index(k, distance.shape) + (distance.ravel()[k],)
+
+
+def test_query_is_the_closest_pixel():
+    grid = swath_grid()
+    rng = np.random.default_rng(0)
+    points = np.column_stack((rng.uniform(-7, 9, 100), rng.uniform(96, 112, 100)))
+    rows, cols, distance = GeoIndex(grid).query(points)
+    for k, point in enumerate(points):
+        row, col, expected = brute_force(grid, point)
+        assert (rows[k], cols[k]) == (row, col)
+        assert np.isclose(distance[k], expected, atol=1e-6)
+
+
+def test_refine_from_a_wrong_guess():
+    grid = swath_grid()
+    read_window = lambda window: grid[window[0]:window[1], window[2]:window[3]]
+    rng = np.random.default_rng(1)
+    # Points near the swath edges included, and guesses anywhere on the grid
+    points = np.column_stack((rng.uniform(-7, 9, 30), np.concatenate((rng.uniform(95.8, 97, 10), rng.uniform(111, 112.3, 10),
+                                                                      rng.uniform(97, 111, 10)))))
+    guesses = np.column_stack((rng.integers(0, grid.shape[0], 30), rng.integers(0, grid.shape[1], 30)))
+    for point, guess in zip(points, guesses):
+        row, col, distance = refine_closest_point(read_window, grid.shape[:2], point, guess, 8)
+        expected = brute_force(grid, point)
+        assert (row, col) == expected[:2]
+        assert np.isclose(distance, expected[2], atol=1e-6)
+
+
+def test_half_diagonal_covers_the_swath():
+    grid = swath_grid()
+    index = GeoIndex(grid)
+    rng = np.random.default_rng(2)
+    # Anywhere in the swath, up to its edges, with bilinear interpolation between the pixel centres
+    r, c = rng.uniform(0, grid.shape[0] - 1, 200), rng.uniform(0, grid.shape[1] - 1, 200)
+    c[:50] = rng.choice([0, grid.shape[1] - 1], 50)
+    r0, c0 = np.minimum(r.astype(int), grid.shape[0] - 2), np.minimum(c.astype(int), grid.shape[1] - 2)
+    dr, dc = (r - r0)[:, None], (c - c0)[:, None]
+    points = ((1 - dr) * (1 - dc) * grid[r0, c0] + dr * (1 - dc) * grid[r0 + 1, c0] +
+              (1 - dr) * dc * grid[r0, c0 + 1] + dr * dc * grid[r0 + 1, c0 + 1])
+    rows, cols, distance = index.query(points)
+    assert np.all(distance <= index.half_diagonal(rows, cols))
+    # The edge pixels are about 5 x 10 km, those at nadir 5 x 5 km
+    assert np.isclose(index.half_diagonal(200, 0), np.hypot(5, 10) / 2, rtol=0.05)
+    assert np.isclose(index.half_diagonal(200, 135), np.hypot(5, 5) / 2, rtol=0.05)
+
+    # One and a half pixels beyond the swath edge: outside
+    rows = rng.integers(0, grid.shape[0], 50)
+    beyond = np.concatenate((grid[rows, 0] + 1.5 * (grid[rows, 0] - grid[rows, 1]),
+                             grid[rows, -1] + 1.5 * (grid[rows, -1] - grid[rows, -2])))
+    rows, cols, distance = index.query(beyond)
+    assert np.all(distance > index.half_diagonal(rows, cols))
@@ -0,0 +1,107 @@
+"""
+   The incremental matching of matchCoverage.py, against a brute force nearest search.
+"""
+import csv
+import datetime
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from matchCoverage import read_match_table, update_match_table
+
+START = datetime.datetime(2015, 4, 1)
+
+
+def write_day(folder, day, seconds, values):
+    """ Coverage file of the day (0 for START) with images at the given seconds of the day. """
+    date = START + datetime.timedelta(days=day)
+    with open(os.path.join(folder, 'undistort-coverage-data-{0:%Y-%m-%d}.txt'.format(date)), 'w') as f:
+        f.write('Image, Date, Time, Cloud_Coverage \n')
+        for second, value in zip(seconds, values):
+            time = date + datetime.timedelta(seconds=int(second))
+            f.write('{0:%Y-%m-%d-%H-%M-%S}.jpg,{0:%Y:%m:%d},{0:%H:%M:%S},{1}\n'.format(time, value))
+
+
+def brute_force(queries, coverage, tolerance):
+    """ {timeMODIS: (timeImage, coverage)} of the notebook's loop: nearest image of each query. """
+    times = np.array([t for t, _ in coverage], dtype='datetime64[s]')
+    matches = {}
+    for query in queries:
+        diff = np.abs((times - np.datetime64(query, 's')).astype(np.int64))
+        k = np.argmin(diff)
+        if diff[k] < tolerance:
+            matches[str(query)] = (str(times[k].astype(datetime.datetime)), coverage[k][1])
+    return matches
+
+
+def table(file_name, satellite):
+    _, rows = read_match_table(file_name)
+    return dict((row['timeMODIS'], (row['timeImage'], float(row['coverageForMODISTime'])))
+                for (sat, _), row in rows.items() if sat == satellite)
+
+
+def random_coverage(rng, folder, days):
+    # Images at 1 mod 4 seconds and queries at 0 mod 4: no ties, and no distance of exactly the tolerance
+    coverage = []
+    for day in days:
+        seconds = np.unique(rng.integers(6 * 3600, 18 * 3600, 60) // 4 * 4 + 1)
+        values = np.round(rng.uniform(0, 1, len(seconds)), 6)
+        write_day(folder, day, seconds, values)
+        coverage += [(START + datetime.timedelta(days=day, seconds=int(s)), v) for s, v in zip(seconds, values)]
+    return coverage
+
+
+def random_queries(rng, days, count):
+    return sorted(START + datetime.timedelta(days=int(day), seconds=int(second))
+                  for day, second in zip(rng.choice(days, count), rng.integers(6 * 3600, 18 * 3600, count) // 4 * 4))
+
+
+def test_matches_brute_force(tmp_path):
+    rng = np.random.default_rng(0)
+    folder = str(tmp_path / 'coverage')
+    os.makedirs(folder)
+    coverage = random_coverage(rng, folder, range(0, 10, 2))
+    queries = random_queries(rng, range(10), 200)
+    cmask = rng.uniform(0, 1, len(queries))
+
+    file_name = str(tmp_path / 'match.txt')
+    update_match_table(file_name, 'MOD', queries, cmask, folder)
+    expected = brute_force(queries, coverage, 900)
+    assert 0 < len(expected) < len(queries)
+    assert table(file_name, 'MOD') == expected
+    assert update_match_table(file_name, 'MOD', queries, cmask, folder) == 0
+
+    # Coverage of the other days added: the incremental table is the table of a full run
+    coverage += random_coverage(rng, folder, range(1, 10, 2))
+    update_match_table(file_name, 'MOD', queries, cmask, folder)
+    assert table(file_name, 'MOD') == brute_force(queries, coverage, 900)
+    full = str(tmp_path / 'full.txt')
+    update_match_table(full, 'MOD', queries, cmask, folder)
+    assert table(file_name, 'MOD') == table(full, 'MOD')
+
+
+def test_removed_coverage_retracts_the_match(tmp_path):
+    folder = str(tmp_path / 'coverage')
+    os.makedirs(folder)
+    write_day(folder, 0, [36000], [0.25])
+    write_day(folder, 1, [36000], [0.75])
+    queries = [START + datetime.timedelta(seconds=36060), START + datetime.timedelta(days=1, seconds=36060)]
+
+    file_name = str(tmp_path / 'match.txt')
+    assert update_match_table(file_name, 'MYD', queries, [0.5, 1.0], folder) == 2
+    assert sorted(table(file_name, 'MYD')) == ['2015-04-01 10:01:00', '2015-04-02 10:01:00']
+
+    # The observations are kept in the state: they need not be passed again
+    os.remove(os.path.join(folder, 'undistort-coverage-data-2015-04-02.txt'))
+    assert update_match_table(file_name, 'MYD', [], [], folder) == 1
+    assert table(file_name, 'MYD') == {'2015-04-01 10:01:00': ('2015-04-01 10:00:00', 0.25)}
+    with open(file_name) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 3 and rows[-1]['timeImage'] == '' and rows[-1]['timeMODIS'] == '2015-04-02 10:01:00'
+
+    # The day comes back: so does the match
+    write_day(folder, 1, [36030], [0.5])
+    assert update_match_table(file_name, 'MYD', [], [], folder) == 1
+    assert table(file_name, 'MYD')['2015-04-02 10:01:00'] == ('2015-04-02 10:00:30', 0.5)
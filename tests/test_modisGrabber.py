@@ -0,0 +1,228 @@
+"""
+   The downloader of modisGrabber.py against a local FTP server (pyftpdlib) serving the layout
+   of the MODIS server: /geoMeta/6/<platform>/<year>/ and /allData/6/<product>/<year>/<day>/.
+"""
+import datetime
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+pytest.importorskip('pyftpdlib')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_preparation'))
+import modisGrabber
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.ioloop import IOLoop
+from pyftpdlib.servers import ThreadedFTPServer
+
+DATE = datetime.date(2015, 1, 2)
+PRODUCTS = ['MOD05_L2', 'MYD05_L2']
+SINGAPORE = modisGrabber.site_boxes([('Singapore', 1.34, 103.68)])
+GRANULE_SIZE = 300000
+
+
+def build_server_tree(root):
+    """ geoMeta files of DATE with three granules over Singapore (0300, 0500 and 1500 UTC) and one
+        elsewhere, and the granules of PRODUCTS. Returns {name: content} of the granules.
+    """
+    day = DATE.timetuple().tm_yday
+    granules = {}
+    for platform, prefix in (('AQUA', 'MYD'), ('TERRA', 'MOD')):
+        folder = os.path.join(root, 'geoMeta', '6', platform, str(DATE.year))
+        os.makedirs(folder)
+        with open(os.path.join(folder, '{0}03_{1}.txt'.format(prefix, DATE.strftime('%Y-%m-%d'))), 'w') as f:
+            f.write('# header\n')
+            for hhmm, (south, north, west, east) in [('0300', (0, 5, 100, 110)), ('0500', (0, 5, 100, 110)),
+                                                     ('1500', (0, 5, 100, 110)), ('0400', (20, 30, 0, 10))]:
+                f.write('{0}03.A{1}{2:03d}.{3}.006.2015001.hdf,{4} {5}:{6},61,1,D,{7},{8},{9},{10},0,0,0,0,0,0,0,0\n'.format(
+                    prefix, DATE.year, day, hhmm, DATE.isoformat(), hhmm[:2], hhmm[2:], east, north, south, west))
+    for product in PRODUCTS:
+        folder = os.path.join(root, 'allData', '6', product, str(DATE.year), '{0:03d}'.format(day))
+        os.makedirs(folder)
+        for hhmm in ('0300', '0400', '0500', '1500'):
+            name = '{0}.A{1}{2:03d}.{3}.006.2015010101010.hdf'.format(product, DATE.year, day, hhmm)
+            granules[name] = os.urandom(GRANULE_SIZE)
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(granules[name])
+    return granules
+
+
+@pytest.fixture
+def server(tmp_path):
+    """ Anonymous FTP server on a free port. Its handler counts the logins and the RETR and REST
+        commands, and cuts the first transfer of the files listed in `interrupt` halfway.
+    """
+    root = str(tmp_path / 'server')
+    granules = build_server_tree(root)
+
+    class Handler(FTPHandler):
+        lock = threading.Lock()
+        logins = 0
+        retrieved = []
+        restarts = []
+        interrupt = set()
+
+        def on_login(self, username):
+            with Handler.lock:
+                Handler.logins += 1
+
+        def ftp_REST(self, line):
+            Handler.restarts.append(int(line))
+            return FTPHandler.ftp_REST(self, line)
+
+        def ftp_RETR(self, file):
+            name = os.path.basename(file)
+            with Handler.lock:
+                Handler.retrieved.append(name)
+                interrupted = name in Handler.interrupt
+                Handler.interrupt.discard(name)
+            if interrupted:
+                # Serve the first half only: the client sees a short transfer
+                half = file + '.half'
+                with open(file, 'rb') as source, open(half, 'wb') as f:
+                    f.write(source.read(os.path.getsize(file) // 2))
+                file = half
+            return FTPHandler.ftp_RETR(self, file)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    Handler.authorizer = authorizer
+    # An IOLoop of its own: close_all() closes it, the default one is shared by the servers
+    ftp_server = ThreadedFTPServer(('127.0.0.1', 0), Handler, ioloop=IOLoop())
+    stop = threading.Event()
+
+    def serve():
+        while not stop.is_set():
+            ftp_server.serve_forever(timeout=0.01, blocking=False)
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield {'port': ftp_server.address[1], 'handler': Handler, 'granules': granules, 'root': root}
+    finally:
+        # Closed once the loop has stopped, close_all() is not thread safe
+        stop.set()
+        thread.join()
+        ftp_server.close_all()
+
+
+def grab(server, data_root, cache_dir):
+    return modisGrabber.grab([DATE], PRODUCTS, SINGAPORE, (2, 10), data_root, '127.0.0.1', server['port'],
+                             max_connections=2, max_days=1, retries=2, backoff=0.01,
+                             geometa_cache_dir=cache_dir)
+
+
+def test_pool_reuses_connections(server):
+    pool = modisGrabber.FTPPool('127.0.0.1', 2, server['port'])
+    remote = '/allData/6/MOD05_L2/{0}/{1:03d}'.format(DATE.year, DATE.timetuple().tm_yday)
+    try:
+        threads = [threading.Thread(target=modisGrabber.list_directory, args=(pool, remote)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        listing = modisGrabber.list_directory(pool, remote)
+    finally:
+        pool.close()
+    assert len(listing) == 4 and set(listing.values()) == {GRANULE_SIZE}
+    assert server['handler'].logins <= 2
+
+
+def test_download_resumes_interrupted_transfer(server, tmp_path):
+    name = 'MOD05_L2.A2015002.0300.006.2015010101010.hdf'
+    remote = '/allData/6/MOD05_L2/2015/002/' + name
+    local = str(tmp_path / name)
+    server['handler'].interrupt.add(name)
+    pool = modisGrabber.FTPPool('127.0.0.1', 1, server['port'])
+    try:
+        modisGrabber.download_file(pool, remote, local, GRANULE_SIZE, retries=2, backoff=0.01)
+    finally:
+        pool.close()
+    with open(local, 'rb') as f:
+        assert f.read() == server['granules'][name]
+    assert not os.path.exists(local + '.part')
+    # The second attempt restarts from the end of the first half
+    assert server['handler'].retrieved.count(name) == 2
+    assert server['handler'].restarts == [GRANULE_SIZE // 2]
+
+
+def test_day_manifest_resumes_the_missing_files(server, tmp_path):
+    data_root = str(tmp_path / 'data') + '/'
+    cache_dir = str(tmp_path / 'geoMeta')
+    assert grab(server, data_root, cache_dir) == {DATE: True}
+
+    day = modisGrabber.day_directory(data_root, DATE)
+    with open(os.path.join(day, modisGrabber.MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    selected = sorted(name for name in server['granules'] if '.0300.' in name or '.0500.' in name)
+    assert manifest['state'] == 'complete'
+    assert sorted(manifest['files']) == selected
+    assert all(entry['status'] == 'complete' and entry['size'] == GRANULE_SIZE for entry in manifest['files'].values())
+    for name in selected:
+        with open(os.path.join(day, name), 'rb') as f:
+            assert f.read() == server['granules'][name]
+
+    # One file cut into a .part file, one deleted: only those two are transferred again
+    partial, missing = selected[0], selected[1]
+    os.rename(os.path.join(day, partial), os.path.join(day, partial + '.part'))
+    os.truncate(os.path.join(day, partial + '.part'), 1000)
+    os.remove(os.path.join(day, missing))
+    del server['handler'].retrieved[:]
+    del server['handler'].restarts[:]
+    assert grab(server, data_root, cache_dir) == {DATE: True}
+    assert sorted(server['handler'].retrieved) == sorted([partial, missing])
+    assert server['handler'].restarts == [1000]
+    for name in selected:
+        with open(os.path.join(day, name), 'rb') as f:
+            assert f.read() == server['granules'][name]
+
+    # Nothing left to do, and the geoMeta files come from the cache
+    del server['handler'].retrieved[:]
+    assert grab(server, data_root, cache_dir) == {DATE: True}
+    assert server['handler'].retrieved == []
+
+
+def test_plan_without_pool(server, tmp_path):
+    cache = modisGrabber.GeoMetaCache(str(tmp_path / 'geoMeta'))
+    with pytest.raises(ValueError):
+        modisGrabber.plan([DATE], SINGAPORE, geometa_cache=cache)
+
+    pool = modisGrabber.FTPPool('127.0.0.1', 1, server['port'])
+    try:
+        frames = modisGrabber.plan([DATE], SINGAPORE, geometa_cache=cache, pool=pool)
+    finally:
+        pool.close()
+    assert frames[DATE]['MOD'] == ['A2015002.0300.006', 'A2015002.0500.006']
+    # Cached now, planned without the network
+    assert modisGrabber.plan([DATE], SINGAPORE, geometa_cache=cache) == frames
+
+
+def test_local_errors_are_not_retried(server, tmp_path):
+    name = 'MOD05_L2.A2015002.0300.006.2015010101010.hdf'
+    remote = '/allData/6/MOD05_L2/2015/002/' + name
+    # The folder of the local file is a file: the .part file cannot be opened
+    blocker = str(tmp_path / 'blocker')
+    open(blocker, 'w').close()
+    pool = modisGrabber.FTPPool('127.0.0.1', 1, server['port'])
+    try:
+        with pytest.raises(modisGrabber.LocalFileError):
+            modisGrabber.download_file(pool, remote, os.path.join(blocker, name), GRANULE_SIZE, retries=2, backoff=0.01)
+        # The connection slot was given back
+        assert len(modisGrabber.list_directory(pool, '/allData/6/MOD05_L2/2015/002')) == 4
+    finally:
+        pool.close()
+    assert server['handler'].retrieved == []
+
+    # In a day: the granule fails at once, with the reason in the manifest
+    data_root = str(tmp_path / 'data') + '/'
+    day = modisGrabber.day_directory(data_root, DATE)
+    os.makedirs(os.path.join(day, name + '.part'))
+    assert grab(server, data_root, str(tmp_path / 'geoMeta')) == {DATE: False}
+    with open(os.path.join(day, modisGrabber.MANIFEST_FILE)) as f:
+        entry = json.load(f)['files'][name]
+    assert entry['status'] == 'failed' and 'Is a directory' in entry['error']
+    assert server['handler'].retrieved.count(name) == 0
@@ -0,0 +1,101 @@
+"""
+   The batch searches of nearest.py, against loops over every timestamp.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from nearest import find_nearest_rainevent, nearest_batch, nearest_events, window_statistics
+
+START = np.datetime64('2015-01-01T00:00:00')
+
+
+def random_times(rng, n, span):
+    # Whole minutes: duplicates, and queries halfway between two timestamps
+    return START + (rng.integers(0, span, n) * 60).astype('timedelta64[s]')
+
+
+def test_nearest_batch_matches_brute_force():
+    rng = np.random.default_rng(0)
+    times = random_times(rng, 300, 500)
+    queries = START + rng.integers(-3000, 33000, 500).astype('timedelta64[s]')
+    queries[:50] = times[:50] + np.timedelta64(30, 's')
+    index, diff, within = nearest_batch(queries, times, tolerance=600)
+    for k, query in enumerate(queries):
+        distance = (times - query).astype(np.int64)
+        best = np.abs(distance).min()
+        # Ties go to the earlier timestamp, duplicates to the first occurrence
+        candidates = np.flatnonzero(np.abs(distance) == best)
+        expected = candidates[np.lexsort((candidates, distance[candidates]))[0]]
+        assert index[k] == expected and diff[k] == distance[expected] and within[k] == (best < 600)
+
+
+def test_window_statistics_matches_brute_force():
+    rng = np.random.default_rng(1)
+    times = random_times(rng, 2000, 3000)
+    values = rng.uniform(0, 1, len(times))
+    values[:100] = 0.5
+    queries = START + rng.integers(-3600, 184000, 300).astype('timedelta64[s]')
+    widths = [0, 60, 900, 7200, 86400]
+    # A small chunk_size: the short windows are spread over several chunks. The day long ones are
+    # longer than 1024 values, their median is computed alone
+    statistics = window_statistics(queries, times, values, widths, chunk_size=64)
+    for W in widths:
+        for k, query in enumerate(queries):
+            window = values[np.abs((times - query).astype(np.int64)) <= W]
+            result = dict((name, item[k]) for name, item in statistics[W].items())
+            assert result['count'] == len(window)
+            if len(window) == 0:
+                assert all(np.isnan(result[name]) for name in ('mean', 'median', 'min', 'max', 'std'))
+                continue
+            assert np.isclose(result['mean'], window.mean()) and np.isclose(result['std'], window.std(), atol=1e-7)
+            assert result['median'] == np.median(window)
+            assert result['min'] == window.min() and result['max'] == window.max()
+
+
+def brute_force_event(query, keys, direction):
+    """ Index in keys of the nearest event in the direction, the earlier one on ties, or None. """
+    best = None
+    for k in np.argsort(keys, kind='mergesort'):
+        diff = keys[k] - query
+        if (direction == 'before' and diff > 0) or (direction == 'after' and diff < 0):
+            continue
+        if best is None or abs(diff) < abs(keys[best] - query):
+            best = k
+    return best
+
+
+@pytest.mark.parametrize('direction', ['before', 'after', 'either'])
+def test_nearest_events_match_brute_force(direction):
+    rng = np.random.default_rng(2)
+    series = np.where(rng.uniform(size=400) < 0.1, rng.uniform(0.1, 5, 400), 0.)
+    series[:5] = 0.
+    events = np.flatnonzero(series)
+
+    # Queries are sample indices, before, between and after the events
+    queries = np.concatenate((rng.integers(-10, 410, 200), events[:5], events[:5] + 1))
+    index, diff, within = nearest_events(queries, series, direction=direction, tolerance=6)
+    for k, query in enumerate(queries):
+        best = brute_force_event(query, events, direction)
+        if best is None:
+            assert (index[k], diff[k], within[k]) == (-1, 0, False)
+        else:
+            assert index[k] == events[best] and diff[k] == events[best] - query
+            assert within[k] == (abs(diff[k]) < 6)
+        if direction == 'either' and 0 <= query < len(series):
+            assert index[k] == find_nearest_rainevent(query, series)
+
+    # Queries are times, the samples being unsorted and at distinct seconds
+    times = START + rng.permutation(400 * 60)[:400].astype('timedelta64[s]')
+    queries = START + rng.integers(-600, 400 * 60 + 600, 200).astype('timedelta64[s]')
+    index, diff, within = nearest_events(queries, series, times, direction=direction)
+    event_times = times[events].astype(np.int64)
+    for k, query in enumerate(queries.astype(np.int64)):
+        best = brute_force_event(query, event_times, direction)
+        if best is None:
+            assert (index[k], diff[k], within[k]) == (-1, 0, False)
+        else:
+            assert index[k] == events[best] and diff[k] == event_times[best] - query and within[k]
@@ -0,0 +1,40 @@
+"""
+   The multi-scale statistics of neighbourhood.py, against the pixels of each window counted directly.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_preparation'))
+from neighbourhood import QUALITY_CLASSES, class_statistics, integral_image
+
+
+def test_integral_image():
+    values = np.random.default_rng(0).integers(0, 5, (2, 7, 9))
+    integral = integral_image(values)
+    for i in range(8):
+        for j in range(10):
+            assert np.array_equal(integral[:, i, j], values[:, :i, :j].sum(axis=(1, 2)))
+
+
+def test_class_statistics_match_the_windows():
+    rng = np.random.default_rng(1)
+    classes = rng.integers(0, QUALITY_CLASSES, (40, 60))
+    # Points near the corners and edges as well, whose windows are clipped
+    rows = np.concatenate((rng.integers(0, 40, 50), [0, 39, 0, 39, 2]))
+    cols = np.concatenate((rng.integers(0, 60, 50), [0, 59, 59, 0, 58]))
+    sizes = [1, 3, 5, 11, 50, None]
+    statistics = class_statistics(classes, rows, cols, sizes)
+    for size in sizes:
+        for k, (row, col) in enumerate(zip(rows, cols)):
+            if size is None:
+                window, complete = classes, True
+            else:
+                window = classes[max(row - size // 2, 0):row - size // 2 + size, max(col - size // 2, 0):col - size // 2 + size]
+                complete = window.size == size * size
+            result = dict((name, value[k]) for name, value in statistics[size].items())
+            assert list(result['counts']) == [np.sum(window == c) for c in range(QUALITY_CLASSES)]
+            assert result['n_pixels'] == window.size and result['complete'] == complete
+            assert np.isclose(result['cloud_fraction'], np.mean(window == 0))
+            assert np.isclose(result['mean'], window.mean())
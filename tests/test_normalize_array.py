@@ -0,0 +1,58 @@
+"""
+   normalize_array of normalize_array.py, against the min and max of each slice taken one at a time.
+"""
+import itertools
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from normalize_array import normalize_array
+
+
+def brute_force(a, axis, constant):
+    """ (a - min) / (max - min) of every slice along axis, each one in a loop. """
+    axes = range(a.ndim) if axis is None else [ax % a.ndim for ax in np.atleast_1d(axis)]
+    kept = [ax for ax in range(a.ndim) if ax not in axes]
+    expected = np.empty(a.shape)
+    for index in itertools.product(*[range(a.shape[ax]) if ax in kept else [slice(None)] for ax in range(a.ndim)]):
+        values = a[index].astype(np.float64)
+        low, high = values.min(), values.max()
+        expected[index] = constant if high == low else (values - low) / (high - low)
+    return expected
+
+
+@pytest.mark.parametrize('axis', [None, 0, 1, -1, (0, 2)])
+@pytest.mark.parametrize('chunk_size', [None, 3])
+def test_slices_match_brute_force(axis, chunk_size):
+    rng = np.random.default_rng(0)
+    a = rng.normal(0, 10, (7, 5, 6))
+    # Constant slices along every axis
+    a[2] = 1.5
+    a[:, 3] = -2.
+    a[..., 4] = 0.
+    result = normalize_array(a, axis=axis, constant=0.5, chunk_size=chunk_size)
+    assert result.dtype == np.float64
+    assert np.allclose(result, brute_force(a, axis, 0.5))
+
+
+def test_dtypes_and_out(tmp_path):
+    rng = np.random.default_rng(1)
+    for dtype, expected in ((np.uint8, np.float32), (np.int16, np.float32), (np.float32, np.float32),
+                            (np.int32, np.float64), (np.float64, np.float64)):
+        a = rng.integers(0, 100, (20, 8)).astype(dtype)
+        result = normalize_array(a, axis=1)
+        assert result.dtype == expected
+        assert np.allclose(result, brute_force(a, 1, 0.), atol=1e-6)
+
+    # In place, and chunk by chunk into a memory-mapped output
+    a = rng.uniform(-1, 1, (50, 4))
+    expected = brute_force(a, None, 0.)
+    assert normalize_array(a, out=a) is a and np.allclose(a, expected)
+    out = np.lib.format.open_memmap(str(tmp_path / 'out.npy'), mode='w+', dtype=np.float32, shape=a.shape)
+    normalize_array(a, out=out, chunk_size=7)
+    assert np.allclose(out, expected, atol=1e-6)
+    with pytest.raises(ValueError):
+        normalize_array(a, out=np.empty((4, 50)))
@@ -0,0 +1,56 @@
+"""
+   The cached coverage readers of readCoverage.py, against readingCOVERAGE_bulk.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from readCoverage import readCoverageCached, readingCOVERAGE_bulk, readingCOVERAGE_cached
+
+
+def write_day(folder, day, values):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    file_path = os.path.join(folder, 'undistort-coverage-data-2015-04-{0:02d}.txt'.format(day))
+    with open(file_path, 'w') as f:
+        f.write('Image, Date, Time, Cloud_Coverage \n')
+        for k, value in enumerate(values):
+            f.write('2015-04-{0:02d}-10-{1:02d}-00.jpg,2015:04:{0:02d},10:{1:02d}:00,{2}\n'.format(day, k, value))
+    return file_path
+
+
+def assert_same(result, expected):
+    assert np.array_equal(result[0], expected[0]) and np.array_equal(result[1], expected[1])
+
+
+def test_cached_series_is_one_memory_map(tmp_path):
+    folder = str(tmp_path / 'coverage')
+    for day in range(1, 6):
+        write_day(folder, day, np.linspace(0, 1, day + 2))
+    result = readingCOVERAGE_cached(folder)
+    assert_same(result, readingCOVERAGE_bulk(folder))
+    assert isinstance(result[0], np.memmap) and isinstance(result[1], np.memmap)
+    assert_same(readingCOVERAGE_cached(folder), result)
+
+    # A file modified and one added: a new entry replaces the old one
+    os.utime(write_day(folder, 2, [0.5]), ns=(0, 10 ** 18))
+    write_day(folder, 6, [0.25, 0.75])
+    assert_same(readingCOVERAGE_cached(folder), readingCOVERAGE_bulk(folder))
+    entries = [name for name in os.listdir(os.path.join(folder, '.coverage_cache')) if name.startswith('all-')]
+    assert len(entries) == 2
+
+
+def test_shared_cache_dir_keeps_the_folders_apart(tmp_path):
+    # The same file name in two folders, cached in one cache_dir, with the same size and time
+    cache_dir = str(tmp_path / 'cache')
+    first = write_day(str(tmp_path / 'camera1'), 1, [0.1, 0.2])
+    second = write_day(str(tmp_path / 'camera2'), 1, [0.9, 0.8])
+    for file_path in (first, second):
+        os.utime(file_path, ns=(0, 10 ** 18))
+    for file_path in (first, second, first):
+        assert np.array_equal(readCoverageCached(file_path, cache_dir)[1],
+                              readingCOVERAGE_bulk(file_path)[1])
+    assert_same(readingCOVERAGE_cached([first, second], cache_dir=cache_dir),
+                readingCOVERAGE_bulk([first, second]))